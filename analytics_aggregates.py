@@ -0,0 +1,365 @@
+# analytics_aggregates.py
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any, Iterable
+
+from lead_manager import lead_state
+from lead_signals import vehicles_in, intents_of
+from lead_snapshot import record_epoch
+from rebuild_queue import RebuildQueue
+
+log = logging.getLogger("fiat-whatsapp")
+
+AGGREGATES_DIR = "_analytics"
+AGGREGATES_FILE = "agregados.json"
+VERSION = 2
+
+# Cada alteração só anexa a diferença dos contadores a agregados.delta.jsonl; acima
+# deste tamanho o log é somado no JSON em segundo plano (mesmo esquema dos rollups)
+DELTA_SUFFIX = ".delta.jsonl"
+COMPACTING_SUFFIX = ".compactando"
+COMPACT_BYTES = int(os.getenv("AGGREGATES_COMPACT_BYTES", str(64 * 1024)))
+
+# O relatório só usa os últimos 7 dias de criados_por_dia; o resto é podado ao gravar
+CREATED_DAYS_KEPT = int(os.getenv("AGGREGATES_CREATED_DAYS", "90"))
+
+# Contadores com chaves fixas (as demais somem quando zeram)
+FIXED_KEYS = ("faixas_score", "engajamento")
+
+
+def empty_aggregates() -> Dict[str, Any]:
+    """Estrutura inicial dos agregados (base vazia)"""
+    return {
+        "versao": VERSION,
+        "atualizado_em": 0,
+        "leads": 0,
+        "status": {},
+        "score_total": 0,
+        "leads_quentes": 0,
+        "faixas_score": {"0-20": 0, "21-50": 0, "51-100": 0, "100+": 0},
+        "engajamento": {"Alto": 0, "Médio": 0, "Baixo": 0},
+        "interacoes": 0,
+        "leads_com_interacoes": 0,
+        "veiculos": {},          # menções em mensagens recebidas
+        "intencoes": {},         # leads distintos por intenção
+        "horas": {},             # hora local -> mensagens recebidas
+        "criados_por_dia": {},   # data local (ISO) -> leads criados
+        "automacoes": {"por_regra": {}, "leads": 0, "envios": 0}
+    }
+
+
+def _bump(counters: Dict[str, int], key: str, amount: int):
+    """Soma em um contador, removendo chaves zeradas"""
+    value = counters.get(key, 0) + amount
+    if value:
+        counters[key] = value
+    else:
+        counters.pop(key, None)
+
+
+def _score_range(score: int) -> str:
+    if score <= 20:
+        return "0-20"
+    elif score <= 50:
+        return "21-50"
+    elif score <= 100:
+        return "51-100"
+    return "100+"
+
+
+def _engagement_level(score: int, interactions: int) -> str:
+    if score >= 50 or interactions >= 5:
+        return "Alto"
+    elif score >= 20 or interactions >= 2:
+        return "Médio"
+    return "Baixo"
+
+
+def _contribute(aggregates: Dict[str, Any], state: Dict[str, Any], sign: int):
+    """Soma (sign=1) ou retira (sign=-1) a contribuição de um lead aos contadores"""
+    score = state["score"]
+    interactions = state["interacoes"]
+
+    aggregates["leads"] += sign
+    _bump(aggregates["status"], state["status"], sign)
+    aggregates["score_total"] += sign * score
+    if score >= 50:
+        aggregates["leads_quentes"] += sign
+    aggregates["faixas_score"][_score_range(score)] += sign
+    aggregates["engajamento"][_engagement_level(score, interactions)] += sign
+    aggregates["interacoes"] += sign * interactions
+    if interactions > 0:
+        aggregates["leads_com_interacoes"] += sign
+
+    if state["data_criacao_ts"] > 0:
+        day = datetime.fromtimestamp(state["data_criacao_ts"]).date().isoformat()
+        _bump(aggregates["criados_por_dia"], day, sign)
+
+    # Intenções contam leads distintos: máscara mantida nos contadores do lead
+    for intent in intents_of(state["intencoes"]):
+        _bump(aggregates["intencoes"], intent, sign)
+
+    automations = aggregates["automacoes"]
+    for rule_name in state["automacoes"]:
+        _bump(automations["por_regra"], rule_name, sign)
+    if state["automacoes"]:
+        automations["leads"] += sign
+    automations["envios"] += sign * state["envios_automacao"]
+
+
+def _count_message(aggregates: Dict[str, Any], interaction: Dict[str, Any]):
+    """Veículos e hora de uma mensagem recebida"""
+    for vehicle in vehicles_in(interaction.get("mensagem", "").lower()):
+        _bump(aggregates["veiculos"], vehicle, 1)
+    ts = record_epoch(interaction, "timestamp", "ts")
+    if ts > 0:
+        _bump(aggregates["horas"], str(datetime.fromtimestamp(ts).hour), 1)
+
+
+def add_lead(aggregates: Dict[str, Any], lead: Dict[str, Any]):
+    """Soma a contribuição completa de um lead (estado e mensagens) aos contadores"""
+    _contribute(aggregates, lead_state(lead), 1)
+    for interaction in lead.get("historico", []):
+        if interaction.get("direcao") == "Entrada":
+            _count_message(aggregates, interaction)
+
+
+def _sparse(delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Só os contadores que mudaram (linha do log de deltas)"""
+    changed = {}
+    for key, value in delta.items():
+        if key in ("versao", "atualizado_em"):
+            continue
+        if isinstance(value, dict):
+            value = _sparse(value)
+        if value:
+            changed[key] = value
+    return changed
+
+
+def _fold(aggregates: Dict[str, Any], delta: Dict[str, Any]):
+    """Soma uma linha do log de deltas nos agregados"""
+    for key, value in delta.items():
+        if key == "automacoes":
+            _fold(aggregates[key], value)
+        elif key in FIXED_KEYS:
+            for name, count in value.items():
+                aggregates[key][name] = aggregates[key].get(name, 0) + count
+        elif isinstance(value, dict):
+            for name, count in value.items():
+                _bump(aggregates[key], name, count)
+        else:
+            aggregates[key] += value
+
+
+def _prune(aggregates: Dict[str, Any]):
+    """Descarta de criados_por_dia os dias fora da janela guardada"""
+    cutoff = (datetime.now() - timedelta(days=CREATED_DAYS_KEPT)).date().isoformat()
+    created = aggregates["criados_por_dia"]
+    for day in [day for day in created if day < cutoff]:
+        del created[day]
+
+
+def merge_aggregates(total: Dict[str, Any], partial: Dict[str, Any]):
+    """Soma agregados parciais (ex.: de uma partição dos leads) em outros"""
+    for key, value in partial.items():
+        if key in ("versao", "atualizado_em"):
+            continue
+        if key == "automacoes":
+            merge_aggregates(total[key], value)
+        elif isinstance(value, dict):
+            for name, count in value.items():
+                total[key][name] = total[key].get(name, 0) + count
+        else:
+            total[key] += value
+
+
+class AnalyticsAggregates:
+    """Contadores do relatório mantidos a cada alteração de lead e persistidos em disco"""
+
+    def __init__(self, leads_dir: str = "leads"):
+        self.base_dir = os.path.join(leads_dir, AGGREGATES_DIR)
+        self.path = os.path.join(self.base_dir, AGGREGATES_FILE)
+        self.delta_path = self.path[:-len(".json")] + DELTA_SUFFIX
+        # Alterações durante rebuild/recálculo, somadas depois de gravado o resultado
+        self.queue = RebuildQueue(self.base_dir, AGGREGATES_FILE[:-len(".json")])
+        self._state_lock = threading.Lock()
+        self._compacting = False
+
+    def __eq__(self, other) -> bool:
+        # Um único observador por arquivo, mesmo com várias instâncias do engine
+        return isinstance(other, AnalyticsAggregates) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    @contextmanager
+    def _locked(self, shared: bool = False):
+        """flock entre threads e processos (workers do gunicorn): anexar deltas e ler
+        pedem o lock compartilhado; compactar e reconstruir, o exclusivo"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_compacted(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                aggregates = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.error(f"Agregados do analytics ilegíveis, reconstrua: {e}")
+            return None
+        return aggregates if aggregates.get("versao") == VERSION else None
+
+    def _pending_deltas(self, aggregates: Dict[str, Any]) -> List[str]:
+        """Logs ainda não somados no JSON: os de uma compactação interrompida (exceto
+        os que o JSON já registra como somados) e o log corrente"""
+        prefix = os.path.basename(self.delta_path) + "."
+        folded = set(aggregates.get("compactado", []))
+        paths = sorted(os.path.join(self.base_dir, name) for name in os.listdir(self.base_dir)
+                       if name.startswith(prefix) and name.endswith(COMPACTING_SUFFIX) and name not in folded)
+        return paths + [self.delta_path]
+
+    def _fold_deltas(self, aggregates: Dict[str, Any], paths: List[str]):
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                if line.endswith("\n"):  # sem quebra: ainda sendo anexada por outro processo
+                    _fold(aggregates, json.loads(line))
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Lê os agregados gravados mais os deltas anexados (None se ainda não foram construídos)"""
+        with self._locked(shared=True):
+            aggregates = self._load_compacted()
+            if aggregates is not None:
+                self._fold_deltas(aggregates, self._pending_deltas(aggregates))
+        if aggregates is not None:
+            aggregates.pop("compactado", None)
+        return aggregates
+
+    def _write(self, aggregates: Dict[str, Any]):
+        aggregates["atualizado_em"] = int(time.time())
+        _prune(aggregates)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(aggregates, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def on_lead_event(self, before: Optional[Dict[str, Any]], lead: Dict[str, Any],
+                      event_type: str, data: Dict[str, Any]):
+        """Ajusta os contadores com a diferença causada por uma alteração (O(1) na base)"""
+        after = lead_state(lead)
+        interaction = data.get("interacao") if event_type == "interaction" else None
+        inbound = interaction is not None and interaction.get("direcao") == "Entrada"
+        if before == after and not inbound:
+            return  # notas, telefone/e-mail etc. não mexem nos contadores
+
+        delta = empty_aggregates()
+        if before is not None:
+            _contribute(delta, before, -1)
+        _contribute(delta, after, 1)
+        if inbound:
+            _count_message(delta, interaction)
+        delta = _sparse(delta)
+        if not delta:
+            return
+
+        with self._locked(shared=True):
+            if self.queue.active():
+                self.queue.push(lead, delta)
+                return
+            if not os.path.exists(self.path):
+                return  # ainda não construídos: o rebuild inicial já lerá este lead
+            # Uma única escrita em modo append: linhas inteiras mesmo entre processos
+            with open(self.delta_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(delta, ensure_ascii=False) + "\n")
+                oversized = f.tell() >= COMPACT_BYTES
+        if oversized:
+            self._compact_in_background()
+
+    def _compact_in_background(self):
+        with self._state_lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self._background_compact, daemon=True).start()
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        except Exception as e:
+            log.error(f"Erro ao compactar os agregados do analytics: {e}")
+        finally:
+            with self._state_lock:
+                self._compacting = False
+
+    def compact(self) -> bool:
+        """Soma o log de deltas no JSON. O log é renomeado antes e o JSON registra os
+        nomes somados: se o processo cair antes de apagá-lo, não é somado de novo"""
+        with self._locked():
+            aggregates = self._load_compacted()
+            if aggregates is None:
+                return False
+            for folded in aggregates.get("compactado", []):
+                try:
+                    os.remove(os.path.join(self.base_dir, folded))
+                except FileNotFoundError:
+                    pass
+            paths = self._pending_deltas(aggregates)[:-1]
+            if os.path.exists(self.delta_path) and os.path.getsize(self.delta_path) > 0:
+                rotated = f"{self.delta_path}.{time.time_ns()}{COMPACTING_SUFFIX}"
+                os.replace(self.delta_path, rotated)
+                paths.append(rotated)
+            if not paths:
+                return False
+            self._fold_deltas(aggregates, paths)
+            aggregates["compactado"] = [os.path.basename(path) for path in paths]
+            self._write(aggregates)
+            for path in paths:
+                os.remove(path)
+        return True
+
+    def begin_rebuild(self):
+        """Antes de ler os leads: daqui até o replace as alterações vão para a fila"""
+        with self._locked():
+            self.queue.begin()
+
+    def rebuild(self, leads: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Reconstrução completa a partir dos leads (reparo ou primeira execução)"""
+        self.begin_rebuild()
+        aggregates = empty_aggregates()
+        revisions = {}
+        for lead in leads:
+            add_lead(aggregates, lead)
+            revisions[lead.get("telefone", "")] = lead.get("revisao", 0)
+        return self.replace(aggregates, revisions)
+
+    def replace(self, aggregates: Dict[str, Any], revisions: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """Grava agregados calculados por fora (rebuild ou recálculo paralelo). Com
+        begin_rebuild antes, revisions traz a revisão lida de cada lead e as alterações
+        posteriores da fila são somadas ao resultado"""
+        with self._locked():
+            for name in os.listdir(self.base_dir):
+                if name.startswith(os.path.basename(self.delta_path)):
+                    os.remove(os.path.join(self.base_dir, name))
+            aggregates.pop("compactado", None)
+            for delta in self.queue.drain(revisions or {}):
+                _fold(aggregates, delta)
+            self._write(aggregates)
+        log.info(f"Agregados do analytics reconstruídos: {aggregates['leads']} leads")
+        return aggregates
@@ -0,0 +1,638 @@
+# analytics_bench.py
+import os
+import json
+import time
+import heapq
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Tuple
+from collections import Counter, defaultdict
+from lead_snapshot import LeadHeader, record_epoch, lead_counters
+from lead_signals import HIGH_INTENT_MASK, SIGNAL_BUY, SIGNAL_TEST_DRIVE, vehicles_in, intents_of, signals_of
+from lead_manager import LeadManager
+from bench_data import generate_leads
+from analytics_engine import AnalyticsEngine, FUNNEL_STAGES
+
+
+class TopScores:
+    """Top N por score com heap limitado, sem ordenar a lista inteira"""
+    
+    def __init__(self, size: int = 10):
+        self.size = size
+        self._heap: List[Tuple[int, int, Any]] = []
+        self._seq = 0
+    
+    def push(self, score: int, item: Any):
+        # Em empate vence quem chegou primeiro, como no sort estável por score
+        entry = (score, -self._seq, item)
+        self._seq += 1
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+    
+    def items(self) -> List[Any]:
+        """Itens do maior para o menor score"""
+        return [item for _, _, item in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
+
+
+class MultipassReport:
+    """Relatório seção a seção a partir dos leads (referência para conferir a passada
+    única e os agregados no benchmark; o relatório em produção é o dos agregados)"""
+    
+    def __init__(self, engine: AnalyticsEngine):
+        self.engine = engine
+        self.lead_manager = engine.lead_manager
+    
+    def generate(self) -> Dict[str, Any]:
+        """Todas as seções, cada uma calculada à parte"""
+        # Seções que só dependem de status/score/datas usam os cabeçalhos
+        # compactos, que também trazem os sinais das mensagens (intenções,
+        # menções de preço, test drive) extraídos uma vez por lead; os documentos
+        # completos ficam para as contagens por mensagem
+        headers = self.lead_manager.get_lead_headers()
+        all_leads = self.lead_manager.get_all_leads()
+        leads_by_phone = {lead.get("telefone", ""): lead for lead in all_leads}
+        
+        return {
+            "overview": self._get_overview_metrics(headers),
+            "funnel": self._get_funnel_analysis(headers),
+            "engagement": self._get_engagement_analysis(headers),
+            "vehicles": self._get_vehicle_interest_analysis(all_leads, headers, leads_by_phone),
+            "opportunities": self._identify_sales_opportunities(headers, time.time(), leads_by_phone),
+            "performance": self._get_performance_metrics(headers),
+            "trends": self._get_trend_analysis(headers, all_leads)
+        }
+    
+    def _get_overview_metrics(self, leads: List[LeadHeader]) -> Dict[str, Any]:
+        """Métricas gerais de overview"""
+        total_leads = len(leads)
+        
+        if total_leads == 0:
+            return {
+                "total_leads": 0,
+                "conversion_rate": 0,
+                "avg_score": 0,
+                "hot_leads": 0,
+                "active_leads": 0
+            }
+        
+        # Contar por status
+        status_counts = Counter(lead.status for lead in leads)
+        
+        # Taxa de conversão
+        converted = status_counts.get("Vendido", 0)
+        conversion_rate = round((converted / total_leads) * 100, 1) if total_leads > 0 else 0
+        
+        # Score médio
+        scores = [lead.score for lead in leads]
+        avg_score = round(sum(scores) / len(scores), 1) if scores else 0
+        
+        # Leads quentes (score >= 50)
+        hot_leads = len([lead for lead in leads if lead.score >= 50])
+        
+        # Leads ativos (interação nas últimas 24h)
+        now = time.time()
+        active_leads = 0
+        for lead in leads:
+            if lead.ultima_interacao_ts > 0 and now - lead.ultima_interacao_ts < 86400:  # 24 horas
+                active_leads += 1
+        
+        return {
+            "total_leads": total_leads,
+            "conversion_rate": conversion_rate,
+            "avg_score": avg_score,
+            "hot_leads": hot_leads,
+            "active_leads": active_leads,
+            "status_distribution": dict(status_counts)
+        }
+    
+    def _get_funnel_analysis(self, leads: List[LeadHeader]) -> Dict[str, Any]:
+        """Análise do funil de vendas"""
+        stage_counts = {}
+        for stage in FUNNEL_STAGES:
+            stage_counts[stage] = len([lead for lead in leads if lead.status == stage])
+        
+        return self.engine._build_funnel(stage_counts)
+    
+    def _get_engagement_analysis(self, leads: List[LeadHeader]) -> Dict[str, Any]:
+        """Análise de engajamento dos leads"""
+        
+        # Distribuição de scores
+        score_ranges = {
+            "0-20": 0,
+            "21-50": 0,
+            "51-100": 0,
+            "100+": 0
+        }
+        
+        total_interactions = 0
+        leads_with_interactions = 0
+        
+        for lead in leads:
+            score = lead.score
+            
+            if score <= 20:
+                score_ranges["0-20"] += 1
+            elif score <= 50:
+                score_ranges["21-50"] += 1
+            elif score <= 100:
+                score_ranges["51-100"] += 1
+            else:
+                score_ranges["100+"] += 1
+            
+            # Contar interações
+            interactions = lead.total_interacoes
+            if interactions > 0:
+                total_interactions += interactions
+                leads_with_interactions += 1
+        
+        avg_interactions = round(total_interactions / leads_with_interactions, 1) if leads_with_interactions > 0 else 0
+        
+        return {
+            "score_distribution": score_ranges,
+            "avg_interactions_per_lead": avg_interactions,
+            "engagement_levels": self._classify_engagement_levels(leads)
+        }
+    
+    def _classify_engagement_levels(self, leads: List[LeadHeader]) -> Dict[str, int]:
+        """Classifica níveis de engajamento"""
+        levels = {
+            "Alto": 0,      # Score >= 50 e múltiplas interações
+            "Médio": 0,     # Score 20-49 ou algumas interações
+            "Baixo": 0      # Score < 20 e poucas interações
+        }
+        
+        for lead in leads:
+            score = lead.score
+            interactions = lead.total_interacoes
+            
+            if score >= 50 or interactions >= 5:
+                levels["Alto"] += 1
+            elif score >= 20 or interactions >= 2:
+                levels["Médio"] += 1
+            else:
+                levels["Baixo"] += 1
+        
+        return levels
+    
+    def _get_vehicle_interest_analysis(self, leads: List[Dict], headers: List[LeadHeader],
+                                       leads_by_phone: Dict[str, Dict] = None) -> Dict[str, Any]:
+        """Análise de interesse por veículos"""
+        vehicle_mentions = Counter()
+        for lead in leads:
+            # Analisar todas as mensagens do lead
+            for interaction in lead.get("historico", []):
+                if interaction.get("direcao") == "Entrada":  # Mensagens do cliente
+                    for vehicle in vehicles_in(interaction.get("mensagem", "").lower()):
+                        vehicle_mentions[vehicle] += 1
+        
+        # Intenções já extraídas por lead (leads distintos por intenção)
+        intent_distribution = Counter()
+        for header in headers:
+            for intent in intents_of(header.intencoes):
+                intent_distribution[intent] += 1
+        
+        return {
+            "vehicle_popularity": dict(vehicle_mentions.most_common()),
+            "intent_distribution": dict(intent_distribution),
+            "high_intent_leads": self._identify_high_intent_leads(headers, leads_by_phone)
+        }
+    
+    def _identify_high_intent_leads(self, headers: List[LeadHeader],
+                                    leads_by_phone: Dict[str, Dict] = None) -> List[Dict]:
+        """Identifica leads com alta intenção de compra"""
+        # Leads que mencionaram compra, urgência ou financiamento
+        top = TopScores(10)
+        for header in headers:
+            if header.telefone and header.intencoes & HIGH_INTENT_MASK:
+                top.push(header.score, header.telefone)
+        
+        return self.engine._high_intent_records(top.items(), leads_by_phone)
+    
+    def _identify_sales_opportunities(self, headers: List[LeadHeader], now: float,
+                                      leads_by_phone: Dict[str, Dict] = None) -> Dict[str, List[Dict]]:
+        """Identifica oportunidades de vendas específicas"""
+        opportunities = {
+            "ready_to_buy": TopScores(10),      # Prontos para comprar
+            "need_follow_up": TopScores(10),    # Precisam de follow-up
+            "price_sensitive": TopScores(10),   # Sensíveis a preço
+            "test_drive_ready": TopScores(10),  # Prontos para test drive
+            "lost_opportunities": TopScores(10) # Oportunidades perdidas
+        }
+        
+        for header in headers:
+            score = header.score
+            status = header.status
+            is_open = status not in ["Vendido", "Perdido"]
+            
+            # Ready to buy: alta pontuação + menções de compra/financiamento
+            if score >= 70 and header.sinais & SIGNAL_BUY and is_open:
+                opportunities["ready_to_buy"].push(score, (header.telefone, "Alta intenção de compra"))
+            
+            # Need follow-up: leads inativos com potencial
+            if header.ultima_interacao_ts > 0:
+                hours_inactive = (now - header.ultima_interacao_ts) / 3600
+                if hours_inactive > 48 and score >= 30 and is_open:
+                    opportunities["need_follow_up"].push(score, (header.telefone, f"Inativo há {int(hours_inactive)}h"))
+            
+            # Price sensitive: mencionaram preço múltiplas vezes
+            if header.mencoes_preco >= 2 and is_open:
+                opportunities["price_sensitive"].push(score, (header.telefone, f"{header.mencoes_preco} menções de preço"))
+            
+            # Test drive ready: interessados mas não agendaram
+            if header.sinais & SIGNAL_TEST_DRIVE and status not in ["Agendado", "Vendido", "Perdido"]:
+                opportunities["test_drive_ready"].push(score, (header.telefone, "Interesse em test drive"))
+            
+            # Lost opportunities: leads quentes que viraram perdidos
+            if status == "Perdido" and score >= 50:
+                opportunities["lost_opportunities"].push(score, (header.telefone, f"Lead quente perdido (score: {score})"))
+        
+        # Até 10 itens por categoria, já ordenados por score
+        return self.engine._opportunity_records({category: top.items() for category, top in opportunities.items()},
+                                         leads_by_phone)
+    
+    def _get_performance_metrics(self, leads: List[LeadHeader]) -> Dict[str, Any]:
+        """Métricas de performance do sistema"""
+        
+        return {
+            **self.engine._response_time_metrics(),
+            "leads_by_period": self._leads_by_period(leads, time.time()),
+            "automation_stats": self._get_automation_performance()
+        }
+    
+    def _leads_by_period(self, leads: List[LeadHeader], now: float) -> Dict[str, int]:
+        """Leads criados hoje, nos últimos 7 e nos últimos 30 dias"""
+        start_of_today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        periods = {
+            "today": 0,
+            "this_week": 0,
+            "this_month": 0
+        }
+        
+        for lead in leads:
+            created_ts = lead.data_criacao_ts
+            if created_ts <= 0:
+                continue
+            
+            if start_of_today <= created_ts < start_of_today + 86400:
+                periods["today"] += 1
+            
+            days_ago = (now - created_ts) // 86400
+            if days_ago <= 7:
+                periods["this_week"] += 1
+            
+            if days_ago <= 30:
+                periods["this_month"] += 1
+        
+        return periods
+    
+    def _get_automation_performance(self) -> Dict[str, Any]:
+        """Performance das automações"""
+        # Importar aqui para evitar dependência circular
+        try:
+            from automation_engine import automation_engine
+            return automation_engine.get_automation_stats()
+        except:
+            return {
+                "total_automations_sent": 0,
+                "automations_by_rule": {},
+                "leads_with_automations": 0
+            }
+    
+    def _get_trend_analysis(self, headers: List[LeadHeader], leads: List[Dict]) -> Dict[str, Any]:
+        """Análise de tendências"""
+        
+        # Tendência de criação de leads (últimos 7 dias)
+        daily_leads = defaultdict(int)
+        now = datetime.now()
+        
+        for i in range(7):
+            date = (now - timedelta(days=i)).date()
+            daily_leads[date.isoformat()] = 0
+        
+        for lead in headers:
+            if lead.data_criacao_ts <= 0:
+                continue
+            created_date = datetime.fromtimestamp(lead.data_criacao_ts).date().isoformat()
+            if created_date in daily_leads:
+                daily_leads[created_date] += 1
+        
+        # Tendência de conversão
+        conversion_trend = self._calculate_conversion_trend(headers)
+        
+        return {
+            "daily_leads_last_7_days": dict(daily_leads),
+            "conversion_trend": conversion_trend,
+            "peak_hours": self._analyze_peak_hours(leads)
+        }
+    
+    def _calculate_conversion_trend(self, leads: List[LeadHeader]) -> str:
+        """Calcula tendência de conversão"""
+        # Simplificado - comparar últimos 7 dias com 7 dias anteriores
+        now = time.time()
+        
+        recent_converted = 0
+        recent_total = 0
+        previous_converted = 0
+        previous_total = 0
+        
+        for lead in leads:
+            if lead.data_criacao_ts <= 0:
+                continue
+            days_ago = (now - lead.data_criacao_ts) // 86400
+            
+            if days_ago <= 7:
+                recent_total += 1
+                if lead.status == "Vendido":
+                    recent_converted += 1
+            elif 8 <= days_ago <= 14:
+                previous_total += 1
+                if lead.status == "Vendido":
+                    previous_converted += 1
+        
+        return self.engine._trend_label(recent_converted, recent_total, previous_converted, previous_total)
+    
+    def _analyze_peak_hours(self, leads: List[Dict]) -> List[int]:
+        """Analisa horários de pico de atividade"""
+        hour_counts = defaultdict(int)
+        # Deslocamento do fuso local, para obter a hora com aritmética inteira
+        utc_offset = int(datetime.now().astimezone().utcoffset().total_seconds())
+        
+        for lead in leads:
+            for interaction in lead.get("historico", []):
+                if interaction.get("direcao") == "Entrada":
+                    ts = record_epoch(interaction, "timestamp", "ts")
+                    if ts > 0:
+                        hour_counts[(ts + utc_offset) // 3600 % 24] += 1
+        
+        return self.engine._top_hours(hour_counts)
+
+
+class FusedReportBuilder:
+    """Acumuladores do relatório completo, alimentados em uma única passada"""
+    
+    def __init__(self, engine: AnalyticsEngine, now: float = None):
+        self.engine = engine
+        self.now = now if now is not None else time.time()
+        self.utc_offset = int(datetime.now().astimezone().utcoffset().total_seconds())
+        self.today = int(self.now + self.utc_offset) // 86400
+        
+        self.total_leads = 0
+        self.status_counts = Counter()
+        self.stage_counts = {stage: 0 for stage in FUNNEL_STAGES}
+        self.score_sum = 0
+        self.hot_leads = 0
+        self.active_leads = 0
+        
+        self.score_ranges = {"0-20": 0, "21-50": 0, "51-100": 0, "100+": 0}
+        self.engagement_levels = {"Alto": 0, "Médio": 0, "Baixo": 0}
+        self.total_interactions = 0
+        self.leads_with_interactions = 0
+        
+        self.vehicle_mentions = Counter()
+        self.intent_counts = Counter()
+        self.high_intent = TopScores(10)
+        self.opportunities = {
+            "ready_to_buy": TopScores(10),
+            "need_follow_up": TopScores(10),
+            "price_sensitive": TopScores(10),
+            "test_drive_ready": TopScores(10),
+            "lost_opportunities": TopScores(10)
+        }
+        
+        self.periods = {"today": 0, "this_week": 0, "this_month": 0}
+        self.daily_leads = {}
+        for i in range(7):
+            self.daily_leads[self.today - i] = (datetime.now() - timedelta(days=i)).date().isoformat()
+        self.daily_counts = defaultdict(int)
+        self.trend = [0, 0, 0, 0]  # recentes vendidos/total, anteriores vendidos/total
+        self.hour_counts = defaultdict(int)
+        
+        self.automation_stats = {
+            "total_automations_sent": 0,
+            "automations_by_rule": {},
+            "leads_with_automations": 0
+        }
+    
+    def add_lead(self, lead: Dict[str, Any]):
+        """Visita um lead (e cada interação dele) uma única vez"""
+        phone = lead.get("telefone", "")
+        status = lead.get("status", "Novo")
+        score = lead.get("score", 0)
+        historico = lead.get("historico", [])
+        
+        # Overview e funil
+        self.total_leads += 1
+        self.status_counts[status] += 1
+        if lead.get("status") in self.stage_counts:
+            self.stage_counts[lead.get("status")] += 1
+        self.score_sum += score
+        if score >= 50:
+            self.hot_leads += 1
+        last_interaction = record_epoch(lead, "ultima_interacao")
+        if last_interaction > 0 and self.now - last_interaction < 86400:
+            self.active_leads += 1
+        
+        # Engajamento
+        if score <= 20:
+            self.score_ranges["0-20"] += 1
+        elif score <= 50:
+            self.score_ranges["21-50"] += 1
+        elif score <= 100:
+            self.score_ranges["51-100"] += 1
+        else:
+            self.score_ranges["100+"] += 1
+        
+        interactions = len(historico)
+        if interactions > 0:
+            self.total_interactions += interactions
+            self.leads_with_interactions += 1
+        if score >= 50 or interactions >= 5:
+            self.engagement_levels["Alto"] += 1
+        elif score >= 20 or interactions >= 2:
+            self.engagement_levels["Médio"] += 1
+        else:
+            self.engagement_levels["Baixo"] += 1
+        
+        # Mensagens do cliente: veículos e horários contam por mensagem
+        messages = []
+        for interaction in historico:
+            if interaction.get("direcao") != "Entrada":
+                continue
+            message = interaction.get("mensagem", "").lower()
+            messages.append(message)
+            for vehicle in vehicles_in(message):
+                self.vehicle_mentions[vehicle] += 1
+            ts = record_epoch(interaction, "timestamp", "ts")
+            if ts > 0:
+                self.hour_counts[(ts + self.utc_offset) // 3600 % 24] += 1
+        
+        # Sinais do lead (os mesmos gravados no cabeçalho), usados por intenções,
+        # alta intenção e oportunidades
+        intents, signals, price_mentions = signals_of(messages)
+        for intent in intents_of(intents):
+            self.intent_counts[intent] += 1
+        if phone and intents & HIGH_INTENT_MASK:
+            self.high_intent.push(score, lead)
+        
+        opportunities = self.opportunities
+        is_open = status not in ["Vendido", "Perdido"]
+        if score >= 70 and signals & SIGNAL_BUY and is_open:
+            opportunities["ready_to_buy"].push(score, (lead, "Alta intenção de compra"))
+        if last_interaction > 0:
+            hours_inactive = (self.now - last_interaction) / 3600
+            if hours_inactive > 48 and score >= 30 and is_open:
+                opportunities["need_follow_up"].push(score, (lead, f"Inativo há {int(hours_inactive)}h"))
+        if price_mentions >= 2 and is_open:
+            opportunities["price_sensitive"].push(score, (lead, f"{price_mentions} menções de preço"))
+        if signals & SIGNAL_TEST_DRIVE and status not in ["Agendado", "Vendido", "Perdido"]:
+            opportunities["test_drive_ready"].push(score, (lead, "Interesse em test drive"))
+        if status == "Perdido" and score >= 50:
+            opportunities["lost_opportunities"].push(score, (lead, f"Lead quente perdido (score: {score})"))
+        
+        # Períodos e tendências (datas de criação)
+        created = record_epoch(lead, "data_criacao")
+        if created > 0:
+            created_day = (created + self.utc_offset) // 86400
+            if created_day == self.today:
+                self.periods["today"] += 1
+            days_ago = (self.now - created) // 86400
+            if days_ago <= 7:
+                self.periods["this_week"] += 1
+            if days_ago <= 30:
+                self.periods["this_month"] += 1
+            if created_day in self.daily_leads:
+                self.daily_counts[created_day] += 1
+            
+            is_sold = lead.get("status") == "Vendido"
+            if days_ago <= 7:
+                self.trend[1] += 1
+                self.trend[0] += is_sold
+            elif 8 <= days_ago <= 14:
+                self.trend[3] += 1
+                self.trend[2] += is_sold
+        
+        # Automações já executadas
+        automations = lead.get("automations", {})
+        if automations:
+            self.automation_stats["leads_with_automations"] += 1
+            by_rule = self.automation_stats["automations_by_rule"]
+            for rule_name in automations:
+                by_rule[rule_name] = by_rule.get(rule_name, 0) + 1
+            self.automation_stats["total_automations_sent"] += sum(lead_counters(lead)["por_regra"].values())
+    
+    def build(self) -> Dict[str, Any]:
+        """Monta o relatório no mesmo formato de generate_full_report"""
+        engine = self.engine
+        total_leads = self.total_leads
+        
+        if total_leads == 0:
+            overview = {
+                "total_leads": 0,
+                "conversion_rate": 0,
+                "avg_score": 0,
+                "hot_leads": 0,
+                "active_leads": 0
+            }
+        else:
+            overview = {
+                "total_leads": total_leads,
+                "conversion_rate": round((self.status_counts.get("Vendido", 0) / total_leads) * 100, 1),
+                "avg_score": round(self.score_sum / total_leads, 1),
+                "hot_leads": self.hot_leads,
+                "active_leads": self.active_leads,
+                "status_distribution": dict(self.status_counts)
+            }
+        
+        avg_interactions = (round(self.total_interactions / self.leads_with_interactions, 1)
+                            if self.leads_with_interactions > 0 else 0)
+        
+        high_intent_leads = []
+        for lead in self.high_intent.items():
+            high_intent_leads.append({
+                "phone": lead.get("telefone", ""),
+                "name": lead.get("nome_cliente", "Cliente"),
+                "status": lead.get("status", "Novo"),
+                "score": lead.get("score", 0),
+                "last_interaction": lead.get("ultima_interacao", "")
+            })
+        
+        opportunities = {}
+        for category, top in self.opportunities.items():
+            opportunities[category] = [engine._create_opportunity_record(lead, reason) for lead, reason in top.items()]
+        
+        return {
+            "overview": overview,
+            "funnel": engine._build_funnel(self.stage_counts),
+            "engagement": {
+                "score_distribution": self.score_ranges,
+                "avg_interactions_per_lead": avg_interactions,
+                "engagement_levels": self.engagement_levels
+            },
+            "vehicles": {
+                "vehicle_popularity": dict(self.vehicle_mentions.most_common()),
+                "intent_distribution": dict(self.intent_counts),
+                "high_intent_leads": high_intent_leads
+            },
+            "opportunities": opportunities,
+            "performance": {
+                **engine._response_time_metrics(),
+                "leads_by_period": self.periods,
+                "automation_stats": self.automation_stats
+            },
+            "trends": {
+                "daily_leads_last_7_days": {iso: self.daily_counts[day] for day, iso in self.daily_leads.items()},
+                "conversion_trend": engine._trend_label(*self.trend),
+                "peak_hours": engine._top_hours(self.hour_counts)
+            }
+        }
+
+
+def fused_report(engine: AnalyticsEngine) -> Dict[str, Any]:
+    """Relatório recalculado do zero em uma única passada pelos leads"""
+    # Cada lead e cada interação são visitados uma vez, alimentando todos
+    # os acumuladores do relatório
+    builder = FusedReportBuilder(engine)
+    for lead in engine.lead_manager.iter_leads():
+        builder.add_lead(lead)
+    return builder.build()
+
+
+def run_benchmark(total_leads: int = 10_000, repeat: int = 3):
+    """Compara seção a seção, passada única e agregados na mesma base sintética"""
+    base = tempfile.mkdtemp(prefix="bench-analytics-")
+    try:
+        leads_dir = os.path.join(base, "leads")
+        generate_leads(leads_dir, total_leads)
+        engine = AnalyticsEngine(LeadManager(leads_dir, store_mode="arquivos"))
+        
+        # Estado de regime: agregados e snapshot de cabeçalhos já construídos
+        started = time.perf_counter()
+        engine.rebuild_aggregates()
+        engine.lead_manager.snapshot.refresh()
+        print(f"Construção inicial de agregados + cabeçalhos: {time.perf_counter() - started:.3f}s")
+        
+        timings = {}
+        reports = {}
+        for name, build in (("seção a seção", MultipassReport(engine).generate),
+                            ("passada única", lambda: fused_report(engine)),
+                            ("agregados", engine.generate_full_report)):
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                reports[name] = build()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            print(f"{name}: {best:.3f}s ({total_leads} leads, melhor de {repeat})")
+        
+        # O relatório seção a seção lê as automações da base global (não a sintética)
+        for report in reports.values():
+            report["performance"].pop("automation_stats")
+        same = len({json.dumps(r, sort_keys=True, ensure_ascii=False) for r in reports.values()}) == 1
+        print(f"Speedup: passada única {timings['seção a seção'] / timings['passada única']:.2f}x, "
+              f"agregados {timings['seção a seção'] / timings['agregados']:.2f}x | relatórios idênticos: {same}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
@@ -0,0 +1,130 @@
+# analytics_cohorts.py
+import os
+import json
+import time
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Any, Iterable
+
+from analytics_aggregates import AGGREGATES_DIR
+from lead_snapshot import LeadHeader
+
+log = logging.getLogger("fiat-whatsapp")
+
+COHORTS_FILE = "coortes.json"
+VERSION = 1
+
+# Marco -> campo do cabeçalho com a primeira vez em que o lead chegou lá
+MILESTONES = {"agendado": "agendado_ts", "vendido": "vendido_ts"}
+WEEK = 7 * 86400
+
+
+def week_of(ts: int) -> date:
+    """Segunda-feira (local) da semana de um epoch"""
+    day = datetime.fromtimestamp(ts).date()
+    return day - timedelta(days=day.weekday())
+
+
+def _week_epoch(week: date) -> float:
+    return datetime(week.year, week.month, week.day).timestamp()
+
+
+class CohortAnalysis:
+    """Coortes semanais de criação: quantos chegaram a cada marco até a semana W+k"""
+
+    def __init__(self, leads_dir: str = "leads", max_age: int = 12):
+        self.path = os.path.join(leads_dir, AGGREGATES_DIR, COHORTS_FILE)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    def _is_closed(self, week: date, current_week: date) -> bool:
+        # Todas as idades 0..max_age já passaram: a linha não muda mais
+        return week + timedelta(weeks=self.max_age) < current_week
+
+    def _load_closed(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning(f"Cache de coortes ignorado: {e}")
+            return {}
+        if cache.get("versao") != VERSION or cache.get("idade_maxima") != self.max_age:
+            return {}
+        return cache.get("semanas", {})
+
+    def _save_closed(self, rows: Dict[str, Dict[str, Any]]):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"versao": VERSION, "idade_maxima": self.max_age,
+                       "atualizado_em": int(time.time()), "semanas": rows}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def invalidate(self):
+        """Descarta as coortes fechadas (ex.: após um recálculo completo)"""
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def build(self, headers: Iterable[LeadHeader], weeks: int = 12, today: Optional[date] = None) -> Dict[str, Any]:
+        """Matriz coorte × idade das últimas `weeks` semanas (fechadas vêm do cache)"""
+        today = today or date.today()
+        current_week = today - timedelta(days=today.weekday())
+        wanted = [current_week - timedelta(weeks=i) for i in range(weeks - 1, -1, -1)]
+
+        with self._lock:
+            closed = self._load_closed()
+            # Só as coortes abertas (ou fechadas ainda fora do cache) passam pelos leads
+            counts = {week: {"size": 0, **{name: [0] * (self.max_age + 1) for name in MILESTONES}}
+                      for week in wanted if week.isoformat() not in closed}
+
+            if counts:
+                starts = {week: _week_epoch(week) for week in counts}
+                for header in headers:
+                    if header.data_criacao_ts <= 0:
+                        continue
+                    week = week_of(header.data_criacao_ts)
+                    row = counts.get(week)
+                    if row is None:
+                        continue
+                    row["size"] += 1
+                    for name, field in MILESTONES.items():
+                        ts = getattr(header, field)
+                        if ts > 0:
+                            age = max(int((ts - starts[week]) // WEEK), 0)
+                            if age <= self.max_age:
+                                row[name][age] += 1
+
+            newly_closed = {}
+            for week, row in counts.items():
+                for name in MILESTONES:
+                    cumulative = 0
+                    for age, count in enumerate(row[name]):
+                        cumulative += count
+                        row[name][age] = cumulative
+                if self._is_closed(week, current_week):
+                    newly_closed[week.isoformat()] = row
+            if newly_closed:
+                closed.update(newly_closed)
+                self._save_closed(closed)
+
+        cohorts = []
+        for week in wanted:
+            row = closed.get(week.isoformat()) or counts[week]
+            elapsed = (current_week - week).days // 7   # idades futuras ficam None
+            cohort = {"week": week.isoformat(), "size": row["size"]}
+            for name in MILESTONES:
+                reached = [count if age <= elapsed else None for age, count in enumerate(row[name])]
+                cohort[name] = reached
+                cohort[f"{name}_pct"] = [
+                    round(count / row["size"] * 100, 1) if count is not None and row["size"] else None
+                    for count in reached
+                ]
+            cohorts.append(cohort)
+
+        return {"max_age_weeks": self.max_age, "cohorts": cohorts}
@@ -1,103 +1,337 @@
 # analytics_engine.py
-import re
-from datetime import datetime, timedelta
+import os
+import time
+from datetime import date, datetime, timedelta
 from typing import Dict, List, Any, Tuple
 from collections import Counter, defaultdict
 from lead_manager import lead_manager
+from lead_signals import VEHICLE_KEYWORDS, INTENT_KEYWORDS
+from analytics_aggregates import AnalyticsAggregates
+from analytics_rollups import (AnalyticsRollups, CUBE_METRICS, DIMENSIONS, empty_bucket,
+                               merge_buckets, split_cube_key)
+from analytics_cohorts import CohortAnalysis
+import log_histogram
+from lead_columns import LeadColumns
+
+FUNNEL_STAGES = ["Novo", "Em Atendimento", "Proposta Enviada", "Agendado", "Vendido", "Perdido"]
+
+# Dimensões aceitas pela consulta (query) em cada métrica dos rollups
+LATENCY_METRICS = ("tempo_resposta", "primeira_resposta")
+QUERY_DIMENSIONS = {
+    **{metric: tuple(d for d in DIMENSIONS if d != "veiculo" or metric == "mencoes_veiculo") + ("dia", "hora")
+       for metric in CUBE_METRICS},
+    **{metric: ("vendedor", "dia", "hora") for metric in LATENCY_METRICS}
+}
 
 class AnalyticsEngine:
     """Sistema de analytics e relatórios para identificar oportunidades de vendas"""
     
-    def __init__(self):
-        self.vehicle_keywords = {
-            "pulse": ["pulse"],
-            "toro": ["toro"],
-            "strada": ["strada"],
-            "argo": ["argo"],
-            "cronos": ["cronos"],
-            "fastback": ["fastback"],
-            "mobi": ["mobi"],
-            "fiorino": ["fiorino"],
-            "ducato": ["ducato"]
-        }
+    def __init__(self, manager=None):
+        self.lead_manager = manager or lead_manager
+        self.vehicle_keywords = VEHICLE_KEYWORDS
+        self.intent_keywords = INTENT_KEYWORDS
         
-        self.intent_keywords = {
-            "compra": ["comprar", "adquirir", "levar", "fechar negócio", "finalizar"],
-            "financiamento": ["financiar", "financiamento", "parcelar", "entrada", "prestação"],
-            "test_drive": ["test drive", "teste", "dirigir", "experimentar", "conhecer"],
-            "preco": ["preço", "preco", "valor", "custa", "quanto"],
-            "troca": ["trocar", "troca", "dar entrada", "usado"],
-            "urgencia": ["urgente", "rápido", "hoje", "agora", "logo"]
-        }
+        # Contadores atualizados a cada interação/mudança de status do lead
+        self.aggregates = AnalyticsAggregates(self.lead_manager.leads_dir)
+        self.lead_manager.add_observer(self.aggregates)
+        
+        # Contadores por hora/dia para tendências de meses sem reler o histórico
+        self.rollups = AnalyticsRollups(self.lead_manager.leads_dir)
+        self.lead_manager.add_observer(self.rollups)
+        
+        # Coortes semanais (as fechadas ficam em cache e não são recalculadas)
+        self.cohorts = CohortAnalysis(self.lead_manager.leads_dir)
     
     def generate_full_report(self) -> Dict[str, Any]:
         """Gera relatório completo de analytics"""
-        all_leads = lead_manager.get_all_leads()
+        # Contadores (funil, engajamento, veículos, horários) vêm dos agregados;
+        # janelas de tempo e oportunidades, das colunas do snapshot de cabeçalhos
+        # (com os sinais das mensagens já extraídos). Nenhum histórico é relido aqui
+        aggregates = self.aggregates.load()
+        if aggregates is None:
+            aggregates = self.rebuild_aggregates()
+        columns = LeadColumns.from_snapshot(self.lead_manager.snapshot)
+        return self._build_report(aggregates, columns)
+    
+    def get_automation_stats(self) -> Dict[str, Any]:
+        """Envios de automação por regra, direto dos agregados (sem ler os leads)"""
+        aggregates = self.aggregates.load()
+        if aggregates is None:
+            aggregates = self.rebuild_aggregates()
+        return self._automation_stats(aggregates)
+    
+    def _automation_stats(self, aggregates: Dict[str, Any]) -> Dict[str, Any]:
+        automations = aggregates["automacoes"]
+        return {
+            "total_automations_sent": automations["envios"],
+            "automations_by_rule": dict(automations["por_regra"]),
+            "leads_with_automations": automations["leads"]
+        }
+    
+    def rebuild_aggregates(self) -> Dict[str, Any]:
+        """Reconstrói os agregados percorrendo todos os leads"""
+        return self.aggregates.rebuild(self.lead_manager.iter_leads())
+    
+    def rebuild_rollups(self) -> int:
+        """Reconstrói os rollups por hora/dia a partir do histórico dos leads"""
+        return self.rollups.rebuild(self.lead_manager.iter_leads())
+    
+    def get_trends(self, start: date, end: date, granularity: str = "dia") -> Dict[str, Any]:
+        """Série de contadores (novos leads, mensagens, transições, automações) no intervalo"""
+        if not self.rollups.is_built():
+            self.rebuild_rollups()
+        
+        totals = empty_bucket()
+        series = []
+        for period, bucket in self.rollups.series(start, end, granularity):
+            merge_buckets(totals, bucket)
+            # O cubo de dimensões fica para a consulta (query)
+            series.append({"periodo": period, **{k: v for k, v in bucket.items() if k != "cubo"}})
+        totals.pop("cubo")
         
         return {
-            "overview": self._get_overview_metrics(all_leads),
-            "funnel": self._get_funnel_analysis(all_leads),
-            "engagement": self._get_engagement_analysis(all_leads),
-            "vehicles": self._get_vehicle_interest_analysis(all_leads),
-            "opportunities": self._identify_sales_opportunities(all_leads),
-            "performance": self._get_performance_metrics(all_leads),
-            "trends": self._get_trend_analysis(all_leads)
+            "inicio": start.isoformat(),
+            "fim": end.isoformat(),
+            "granularidade": granularity,
+            "totais": totals,
+            "serie": series
         }
     
-    def _get_overview_metrics(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Métricas gerais de overview"""
-        total_leads = len(leads)
+    def get_funnel_flow(self, start: date, end: date) -> Dict[str, Any]:
+        """Transições reais de status no intervalo: matriz, conversão e tempo em cada estágio"""
+        if not self.rollups.is_built():
+            self.rebuild_rollups()
+        totals = self.rollups.totals(start, end)
+        
+        matrix = defaultdict(dict)
+        for key, count in totals["transicoes"].items():
+            old_status, new_status = key.split(" → ", 1)
+            matrix[old_status][new_status] = count
+        
+        # Conversão de A para B: fração das saídas de A que foram para B
+        stage_conversion = {}
+        for old_status, targets in matrix.items():
+            exits = sum(targets.values())
+            for new_status, count in targets.items():
+                stage_conversion[f"{old_status}_to_{new_status}"] = round(count / exits * 100, 1)
+        
+        dwell_hours = {}
+        for status, histogram in totals["permanencia"].items():
+            dwell_hours[status] = {
+                "median": round(log_histogram.quantile(histogram, 0.5) / 3600, 1),
+                "p90": round(log_histogram.quantile(histogram, 0.9) / 3600, 1),
+                "samples": log_histogram.count(histogram)
+            }
+        
+        return {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "transitions": dict(matrix),
+            "stage_conversion": stage_conversion,
+            "dwell_hours": dwell_hours
+        }
+    
+    def get_cohorts(self, weeks: int = 12) -> Dict[str, Any]:
+        """Coortes semanais: dos criados na semana W, quantos chegaram a Agendado/Vendido até W+k"""
+        return self.cohorts.build(self.lead_manager.get_lead_headers(), weeks)
+    
+    def get_response_times(self, start: date, end: date, by_day: bool = False) -> Dict[str, Any]:
+        """Espera do cliente até a resposta (p50/p90/p99) no intervalo, geral e por vendedor"""
+        if not self.rollups.is_built():
+            self.rebuild_rollups()
+        
+        overall, first = {}, {}
+        by_seller = defaultdict(dict)
+        days = {}
+        for day, bucket in self.rollups.series(start, end):
+            day_histogram = {}
+            for seller, histogram in bucket["tempo_resposta"].items():
+                log_histogram.merge(by_seller[seller], histogram)
+                log_histogram.merge(day_histogram, histogram)
+            for histogram in bucket["primeira_resposta"].values():
+                log_histogram.merge(first, histogram)
+            log_histogram.merge(overall, day_histogram)
+            days[day] = day_histogram
+        
+        result = {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "overall": self._latency_summary(overall),
+            "first_response": self._latency_summary(first),
+            "by_seller": {seller: self._latency_summary(h) for seller, h in sorted(by_seller.items())}
+        }
+        if by_day:
+            result["by_day"] = {day: self._latency_summary(h) for day, h in days.items()}
+        return result
+    
+    @staticmethod
+    def _filter_values(name: str, values: List[str]) -> List[Any]:
+        """Valores de filtro validados e no tipo dos rollups (ValueError com mensagem legível)"""
+        values = [str(value).strip() for value in values if str(value).strip()]
+        if name == "hora":
+            for value in values:
+                if not (value.isdigit() and int(value) < 24):
+                    raise ValueError(f"Hora inválida: '{value}' (use 0 a 23)")
+            return [int(value) for value in values]
+        if name == "dia":
+            for value in values:
+                try:
+                    date.fromisoformat(value)
+                except ValueError:
+                    raise ValueError(f"Dia inválido: '{value}' (use AAAA-MM-DD)")
+        elif name == "veiculo":
+            for value in values:
+                if value not in VEHICLE_KEYWORDS:
+                    raise ValueError(f"Veículo desconhecido: '{value}' (use {', '.join(VEHICLE_KEYWORDS)})")
+        return values
+
+    def query(self, metric: str, start: date, end: date, group_by: List[str] = None,
+              filters: Dict[str, List[str]] = None) -> Dict[str, Any]:
+        """Uma métrica no intervalo, agrupada e filtrada por dimensões, direto dos rollups"""
+        group_by = list(group_by or [])
+        filters = {name: values for name, values in (filters or {}).items() if values}
+        allowed = QUERY_DIMENSIONS.get(metric)
+        if allowed is None:
+            raise ValueError(f"Métrica desconhecida: {metric} (use {', '.join(QUERY_DIMENSIONS)})")
+        for name in group_by + list(filters):
+            if name not in allowed:
+                raise ValueError(f"Dimensão '{name}' indisponível para {metric} (use {', '.join(allowed)})")
+        wanted = {name: set(self._filter_values(name, values)) for name, values in filters.items()}
+        if not self.rollups.is_built():
+            self.rebuild_rollups()
+        
+        latency = metric in LATENCY_METRICS
+        hourly = "hora" in group_by or "hora" in wanted
+        groups = {}
+        for period, bucket in self.rollups.series(start, end, "hora" if hourly else "dia"):
+            moment = {"dia": period[:10], "hora": int(period[11:13]) if hourly else None}
+            if any(moment[name] not in wanted[name] for name in ("dia", "hora") if name in wanted):
+                continue
+            if latency:
+                cells = (({"vendedor": seller}, histogram) for seller, histogram in bucket[metric].items())
+            else:
+                cells = ((split_cube_key(key), count) for key, count in bucket["cubo"].get(metric, {}).items())
+            for dims, value in cells:
+                if any(dims[name] not in wanted[name] for name in dims if name in wanted):
+                    continue
+                dims.update(moment)
+                key = tuple(dims[name] for name in group_by)
+                if latency:
+                    log_histogram.merge(groups.setdefault(key, {}), value)
+                else:
+                    groups[key] = groups.get(key, 0) + value
+        
+        if latency:
+            overall = {}
+            for histogram in groups.values():
+                log_histogram.merge(overall, histogram)
+            total = self._latency_summary(overall)
+            rows = [{**dict(zip(group_by, key)), **self._latency_summary(h)} for key, h in groups.items()]
+            by_size = lambda row: -row["samples"]
+        else:
+            total = sum(groups.values())
+            rows = [{**dict(zip(group_by, key)), "valor": count} for key, count in groups.items()]
+            by_size = lambda row: -row["valor"]
+        # Agrupado por tempo: ordem cronológica; senão, maiores primeiro
+        if "dia" in group_by or "hora" in group_by:
+            rows.sort(key=lambda row: tuple(row[name] for name in group_by))
+        else:
+            rows.sort(key=lambda row: (by_size(row), tuple(row[name] for name in group_by)))
+        
+        return {
+            "metrica": metric,
+            "inicio": start.isoformat(),
+            "fim": end.isoformat(),
+            "agrupar_por": group_by,
+            "filtros": filters,
+            "total": total,
+            "linhas": rows
+        }
+    
+    def _latency_summary(self, histogram: Dict[str, int]) -> Dict[str, Any]:
+        """Percentis (em horas) de um histograma de tempos de resposta em segundos"""
+        samples = log_histogram.count(histogram)
+        if samples == 0:
+            return {"samples": 0}
+        return {
+            "p50_hours": round(log_histogram.quantile(histogram, 0.5) / 3600, 2),
+            "p90_hours": round(log_histogram.quantile(histogram, 0.9) / 3600, 2),
+            "p99_hours": round(log_histogram.quantile(histogram, 0.99) / 3600, 2),
+            "avg_hours": round(log_histogram.mean(histogram) / 3600, 2),
+            "samples": samples
+        }
+    
+    def _response_time_metrics(self) -> Dict[str, Any]:
+        """Seção de tempo de resposta do relatório: últimos 30 dias dos rollups"""
+        today = date.today()
+        response_times = self.get_response_times(today - timedelta(days=29), today)
+        return {
+            "avg_response_time_hours": response_times["overall"].get("avg_hours", 0),
+            "response_time_last_30_days": response_times
+        }
+    
+    def _build_report(self, aggregates: Dict[str, Any], columns: LeadColumns) -> Dict[str, Any]:
+        """Monta o relatório a partir dos agregados e das colunas dos cabeçalhos"""
+        now = time.time()
+        window = columns.metrics(now)
+        total_leads = aggregates["leads"]
+        status_counts = aggregates["status"]
         
         if total_leads == 0:
-            return {
+            overview = {
                 "total_leads": 0,
                 "conversion_rate": 0,
                 "avg_score": 0,
                 "hot_leads": 0,
                 "active_leads": 0
             }
+        else:
+            overview = {
+                "total_leads": total_leads,
+                "conversion_rate": round((status_counts.get("Vendido", 0) / total_leads) * 100, 1),
+                "avg_score": round(aggregates["score_total"] / total_leads, 1),
+                "hot_leads": aggregates["leads_quentes"],
+                "active_leads": window["active_leads"],
+                "status_distribution": dict(status_counts)
+            }
         
-        # Contar por status
-        status_counts = Counter(lead.get("status", "Novo") for lead in leads)
-        
-        # Taxa de conversão
-        converted = status_counts.get("Vendido", 0)
-        conversion_rate = round((converted / total_leads) * 100, 1) if total_leads > 0 else 0
-        
-        # Score médio
-        scores = [lead.get("score", 0) for lead in leads]
-        avg_score = round(sum(scores) / len(scores), 1) if scores else 0
-        
-        # Leads quentes (score >= 50)
-        hot_leads = len([lead for lead in leads if lead.get("score", 0) >= 50])
+        with_interactions = aggregates["leads_com_interacoes"]
+        avg_interactions = round(aggregates["interacoes"] / with_interactions, 1) if with_interactions > 0 else 0
         
-        # Leads ativos (interação nas últimas 24h)
-        now = datetime.now()
-        active_leads = 0
-        for lead in leads:
-            try:
-                last_interaction = datetime.fromisoformat(lead.get("ultima_interacao", ""))
-                if (now - last_interaction).total_seconds() < 86400:  # 24 horas
-                    active_leads += 1
-            except:
-                continue
+        daily_leads = {}
+        for i in range(7):
+            date = (datetime.now() - timedelta(days=i)).date().isoformat()
+            daily_leads[date] = aggregates["criados_por_dia"].get(date, 0)
         
         return {
-            "total_leads": total_leads,
-            "conversion_rate": conversion_rate,
-            "avg_score": avg_score,
-            "hot_leads": hot_leads,
-            "active_leads": active_leads,
-            "status_distribution": dict(status_counts)
+            "overview": overview,
+            "funnel": self._build_funnel({stage: status_counts.get(stage, 0) for stage in FUNNEL_STAGES}),
+            "engagement": {
+                "score_distribution": aggregates["faixas_score"],
+                "avg_interactions_per_lead": avg_interactions,
+                "engagement_levels": aggregates["engajamento"]
+            },
+            "vehicles": {
+                "vehicle_popularity": dict(Counter(aggregates["veiculos"]).most_common()),
+                "intent_distribution": dict(aggregates["intencoes"]),
+                "high_intent_leads": self._high_intent_records(columns.high_intent(10))
+            },
+            "opportunities": self._opportunity_records(columns.opportunities(now)),
+            "performance": {
+                **self._response_time_metrics(),
+                "leads_by_period": window["leads_by_period"],
+                "automation_stats": self._automation_stats(aggregates)
+            },
+            "trends": {
+                "daily_leads_last_7_days": daily_leads,
+                "conversion_trend": self._trend_label(*window["trend"]),
+                "peak_hours": self._top_hours({int(hour): count for hour, count in aggregates["horas"].items()})
+            }
         }
     
-    def _get_funnel_analysis(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Análise do funil de vendas"""
-        funnel_stages = ["Novo", "Em Atendimento", "Proposta Enviada", "Agendado", "Vendido", "Perdido"]
-        
-        stage_counts = {}
-        for stage in funnel_stages:
-            stage_counts[stage] = len([lead for lead in leads if lead.get("status") == stage])
+    def _build_funnel(self, stage_counts: Dict[str, int]) -> Dict[str, Any]:
+        """Monta a seção do funil a partir das contagens por estágio"""
+        funnel_stages = FUNNEL_STAGES
         
         # Calcular taxas de conversão entre estágios
         conversion_rates = {}
@@ -115,10 +349,13 @@ class AnalyticsEngine:
             
             conversion_rates[f"{current_stage}_to_{next_stage}"] = rate
         
+        today = date.today()
         return {
             "stage_counts": stage_counts,
             "conversion_rates": conversion_rates,
-            "bottlenecks": self._identify_bottlenecks(stage_counts, conversion_rates)
+            "bottlenecks": self._identify_bottlenecks(stage_counts, conversion_rates),
+            # Razões entre populações acima; o fluxo abaixo vem das mudanças de status
+            "flow_last_30_days": self.get_funnel_flow(today - timedelta(days=29), today)
         }
     
     def _identify_bottlenecks(self, stage_counts: Dict, conversion_rates: Dict) -> List[str]:
@@ -140,111 +377,11 @@ class AnalyticsEngine:
         
         return bottlenecks
     
-    def _get_engagement_analysis(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Análise de engajamento dos leads"""
-        
-        # Distribuição de scores
-        score_ranges = {
-            "0-20": 0,
-            "21-50": 0,
-            "51-100": 0,
-            "100+": 0
-        }
-        
-        total_interactions = 0
-        leads_with_interactions = 0
-        
-        for lead in leads:
-            score = lead.get("score", 0)
-            
-            if score <= 20:
-                score_ranges["0-20"] += 1
-            elif score <= 50:
-                score_ranges["21-50"] += 1
-            elif score <= 100:
-                score_ranges["51-100"] += 1
-            else:
-                score_ranges["100+"] += 1
-            
-            # Contar interações
-            interactions = len(lead.get("historico", []))
-            if interactions > 0:
-                total_interactions += interactions
-                leads_with_interactions += 1
-        
-        avg_interactions = round(total_interactions / leads_with_interactions, 1) if leads_with_interactions > 0 else 0
-        
-        return {
-            "score_distribution": score_ranges,
-            "avg_interactions_per_lead": avg_interactions,
-            "engagement_levels": self._classify_engagement_levels(leads)
-        }
-    
-    def _classify_engagement_levels(self, leads: List[Dict]) -> Dict[str, int]:
-        """Classifica níveis de engajamento"""
-        levels = {
-            "Alto": 0,      # Score >= 50 e múltiplas interações
-            "Médio": 0,     # Score 20-49 ou algumas interações
-            "Baixo": 0      # Score < 20 e poucas interações
-        }
-        
-        for lead in leads:
-            score = lead.get("score", 0)
-            interactions = len(lead.get("historico", []))
-            
-            if score >= 50 or interactions >= 5:
-                levels["Alto"] += 1
-            elif score >= 20 or interactions >= 2:
-                levels["Médio"] += 1
-            else:
-                levels["Baixo"] += 1
-        
-        return levels
-    
-    def _get_vehicle_interest_analysis(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Análise de interesse por veículos"""
-        vehicle_mentions = Counter()
-        intent_analysis = defaultdict(list)
-        
-        for lead in leads:
-            phone = lead.get("telefone", "")
-            
-            # Analisar todas as mensagens do lead
-            for interaction in lead.get("historico", []):
-                if interaction.get("direcao") == "Entrada":  # Mensagens do cliente
-                    message = interaction.get("mensagem", "").lower()
-                    
-                    # Contar menções de veículos
-                    for vehicle, keywords in self.vehicle_keywords.items():
-                        if any(keyword in message for keyword in keywords):
-                            vehicle_mentions[vehicle] += 1
-                    
-                    # Analisar intenções
-                    for intent, keywords in self.intent_keywords.items():
-                        if any(keyword in message for keyword in keywords):
-                            intent_analysis[intent].append(phone)
-        
-        # Remover duplicatas nas intenções
-        for intent in intent_analysis:
-            intent_analysis[intent] = list(set(intent_analysis[intent]))
-        
-        return {
-            "vehicle_popularity": dict(vehicle_mentions.most_common()),
-            "intent_distribution": {intent: len(phones) for intent, phones in intent_analysis.items()},
-            "high_intent_leads": self._identify_high_intent_leads(intent_analysis)
-        }
-    
-    def _identify_high_intent_leads(self, intent_analysis: Dict) -> List[Dict]:
-        """Identifica leads com alta intenção de compra"""
+    def _high_intent_records(self, phones: List[str], leads_by_phone: Dict[str, Dict] = None) -> List[Dict]:
+        """Registros dos leads de alta intenção selecionados (documento só desses)"""
         high_intent_leads = []
-        
-        # Leads que mencionaram compra ou urgência
-        high_intent_phones = set()
-        for intent in ["compra", "urgencia", "financiamento"]:
-            high_intent_phones.update(intent_analysis.get(intent, []))
-        
-        for phone in high_intent_phones:
-            lead = lead_manager.get_lead(phone)
+        for phone in phones:
+            lead = self._lead_for(phone, leads_by_phone)
             if lead:
                 high_intent_leads.append({
                     "phone": phone,
@@ -254,72 +391,25 @@ class AnalyticsEngine:
                     "last_interaction": lead.get("ultima_interacao", "")
                 })
         
-        # Ordenar por score
-        high_intent_leads.sort(key=lambda x: x["score"], reverse=True)
-        
-        return high_intent_leads[:10]  # Top 10
+        return high_intent_leads
     
-    def _identify_sales_opportunities(self, leads: List[Dict]) -> Dict[str, List[Dict]]:
-        """Identifica oportunidades de vendas específicas"""
-        opportunities = {
-            "ready_to_buy": [],      # Prontos para comprar
-            "need_follow_up": [],    # Precisam de follow-up
-            "price_sensitive": [],   # Sensíveis a preço
-            "test_drive_ready": [],  # Prontos para test drive
-            "lost_opportunities": [] # Oportunidades perdidas
-        }
-        
-        now = datetime.now()
-        
-        for lead in leads:
-            phone = lead.get("telefone", "")
-            score = lead.get("score", 0)
-            status = lead.get("status", "Novo")
-            
-            # Analisar mensagens para identificar padrões
-            messages = []
-            for interaction in lead.get("historico", []):
-                if interaction.get("direcao") == "Entrada":
-                    messages.append(interaction.get("mensagem", "").lower())
-            
-            all_messages = " ".join(messages)
-            
-            # Ready to buy: alta pontuação + menções de compra/financiamento
-            if (score >= 70 and 
-                any(keyword in all_messages for keyword in ["comprar", "financiar", "fechar"]) and
-                status not in ["Vendido", "Perdido"]):
-                opportunities["ready_to_buy"].append(self._create_opportunity_record(lead, "Alta intenção de compra"))
-            
-            # Need follow-up: leads inativos com potencial
-            try:
-                last_interaction = datetime.fromisoformat(lead.get("ultima_interacao", ""))
-                hours_inactive = (now - last_interaction).total_seconds() / 3600
-                
-                if (hours_inactive > 48 and score >= 30 and 
-                    status not in ["Vendido", "Perdido"]):
-                    opportunities["need_follow_up"].append(self._create_opportunity_record(lead, f"Inativo há {int(hours_inactive)}h"))
-            except:
-                pass
-            
-            # Price sensitive: mencionaram preço múltiplas vezes
-            price_mentions = all_messages.count("preço") + all_messages.count("preco") + all_messages.count("valor")
-            if price_mentions >= 2 and status not in ["Vendido", "Perdido"]:
-                opportunities["price_sensitive"].append(self._create_opportunity_record(lead, f"{price_mentions} menções de preço"))
-            
-            # Test drive ready: interessados mas não agendaram
-            if (any(keyword in all_messages for keyword in ["test", "dirigir", "conhecer"]) and
-                status not in ["Agendado", "Vendido", "Perdido"]):
-                opportunities["test_drive_ready"].append(self._create_opportunity_record(lead, "Interesse em test drive"))
-            
-            # Lost opportunities: leads quentes que viraram perdidos
-            if status == "Perdido" and score >= 50:
-                opportunities["lost_opportunities"].append(self._create_opportunity_record(lead, f"Lead quente perdido (score: {score})"))
-        
-        # Limitar a 10 itens por categoria e ordenar por score
-        for category in opportunities:
-            opportunities[category] = sorted(opportunities[category], key=lambda x: x["score"], reverse=True)[:10]
-        
-        return opportunities
+    def _opportunity_records(self, selected: Dict[str, List[Tuple[str, str]]],
+                             leads_by_phone: Dict[str, Dict] = None) -> Dict[str, List[Dict]]:
+        """Registros das oportunidades selecionadas, (telefone, motivo) por categoria"""
+        records = {}
+        for category, items in selected.items():
+            records[category] = []
+            for phone, reason in items:
+                lead = self._lead_for(phone, leads_by_phone)
+                if lead:
+                    records[category].append(self._create_opportunity_record(lead, reason))
+        return records
+    
+    def _lead_for(self, phone: str, leads_by_phone: Dict[str, Dict] = None) -> Dict:
+        """Documento do lead: o já carregado em memória ou, sem ele, lido do disco"""
+        if leads_by_phone is not None:
+            return leads_by_phone.get(phone)
+        return self.lead_manager.get_lead(phone)
     
     def _create_opportunity_record(self, lead: Dict, reason: str) -> Dict:
         """Cria registro de oportunidade"""
@@ -332,108 +422,9 @@ class AnalyticsEngine:
             "last_interaction": lead.get("ultima_interacao", "")
         }
     
-    def _get_performance_metrics(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Métricas de performance do sistema"""
-        
-        # Tempo médio de resposta (simulado - seria calculado com timestamps reais)
-        avg_response_time = 0.5  # Assumindo 30 minutos em média
-        
-        # Leads por período
-        now = datetime.now()
-        periods = {
-            "today": 0,
-            "this_week": 0,
-            "this_month": 0
-        }
-        
-        for lead in leads:
-            try:
-                created_date = datetime.fromisoformat(lead.get("data_criacao", ""))
-                
-                if created_date.date() == now.date():
-                    periods["today"] += 1
-                
-                if (now - created_date).days <= 7:
-                    periods["this_week"] += 1
-                
-                if (now - created_date).days <= 30:
-                    periods["this_month"] += 1
-            except:
-                continue
-        
-        return {
-            "avg_response_time_hours": avg_response_time,
-            "leads_by_period": periods,
-            "automation_stats": self._get_automation_performance()
-        }
-    
-    def _get_automation_performance(self) -> Dict[str, Any]:
-        """Performance das automações"""
-        # Importar aqui para evitar dependência circular
-        try:
-            from automation_engine import automation_engine
-            return automation_engine.get_automation_stats()
-        except:
-            return {
-                "total_automations_sent": 0,
-                "automations_by_rule": {},
-                "leads_with_automations": 0
-            }
-    
-    def _get_trend_analysis(self, leads: List[Dict]) -> Dict[str, Any]:
-        """Análise de tendências"""
-        
-        # Tendência de criação de leads (últimos 7 dias)
-        daily_leads = defaultdict(int)
-        now = datetime.now()
-        
-        for i in range(7):
-            date = (now - timedelta(days=i)).date()
-            daily_leads[date.isoformat()] = 0
-        
-        for lead in leads:
-            try:
-                created_date = datetime.fromisoformat(lead.get("data_criacao", "")).date()
-                if created_date.isoformat() in daily_leads:
-                    daily_leads[created_date.isoformat()] += 1
-            except:
-                continue
-        
-        # Tendência de conversão
-        conversion_trend = self._calculate_conversion_trend(leads)
-        
-        return {
-            "daily_leads_last_7_days": dict(daily_leads),
-            "conversion_trend": conversion_trend,
-            "peak_hours": self._analyze_peak_hours(leads)
-        }
-    
-    def _calculate_conversion_trend(self, leads: List[Dict]) -> str:
-        """Calcula tendência de conversão"""
-        # Simplificado - comparar últimos 7 dias com 7 dias anteriores
-        now = datetime.now()
-        
-        recent_converted = 0
-        recent_total = 0
-        previous_converted = 0
-        previous_total = 0
-        
-        for lead in leads:
-            try:
-                created_date = datetime.fromisoformat(lead.get("data_criacao", ""))
-                days_ago = (now - created_date).days
-                
-                if days_ago <= 7:
-                    recent_total += 1
-                    if lead.get("status") == "Vendido":
-                        recent_converted += 1
-                elif 8 <= days_ago <= 14:
-                    previous_total += 1
-                    if lead.get("status") == "Vendido":
-                        previous_converted += 1
-            except:
-                continue
-        
+    def _trend_label(self, recent_converted: int, recent_total: int,
+                     previous_converted: int, previous_total: int) -> str:
+        """Compara a conversão dos últimos 7 dias com a dos 7 anteriores"""
         if previous_total > 0 and recent_total > 0:
             recent_rate = (recent_converted / recent_total) * 100
             previous_rate = (previous_converted / previous_total) * 100
@@ -447,19 +438,8 @@ class AnalyticsEngine:
         
         return "Dados insuficientes"
     
-    def _analyze_peak_hours(self, leads: List[Dict]) -> List[int]:
-        """Analisa horários de pico de atividade"""
-        hour_counts = defaultdict(int)
-        
-        for lead in leads:
-            for interaction in lead.get("historico", []):
-                if interaction.get("direcao") == "Entrada":
-                    try:
-                        timestamp = datetime.fromisoformat(interaction.get("timestamp", ""))
-                        hour_counts[timestamp.hour] += 1
-                    except:
-                        continue
-        
+    def _top_hours(self, hour_counts: Dict[int, int]) -> List[int]:
+        """Top 3 horários por volume de mensagens recebidas"""
         # Retornar top 3 horários
         top_hours = sorted(hour_counts.items(), key=lambda x: x[1], reverse=True)[:3]
         return [hour for hour, count in top_hours]
@@ -467,3 +447,45 @@ class AnalyticsEngine:
 # Instância global
 analytics_engine = AnalyticsEngine()
 
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Analytics de leads")
+    parser.add_argument("command", choices=["bench", "rebuild-aggregates", "rebuild-rollups", "trends", "cohorts", "query"])
+    parser.add_argument("--leads", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--days", type=int, default=365, help="trends/query: dias até hoje")
+    parser.add_argument("--weeks", type=int, default=12, help="cohorts: semanas até a atual")
+    parser.add_argument("--metrica", default="mensagens_entrada", help="query: métrica dos rollups")
+    parser.add_argument("--agrupar", default="", help="query: dimensões separadas por vírgula")
+    args = parser.parse_args()
+    
+    if args.command in ("rebuild-aggregates", "rebuild-rollups"):
+        import logging
+        logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+    
+    if args.command == "rebuild-aggregates":
+        aggregates = analytics_engine.rebuild_aggregates()
+        print(f"Agregados reconstruídos: {aggregates['leads']} leads, {aggregates['interacoes']} interações")
+    elif args.command == "rebuild-rollups":
+        print(f"Rollups reconstruídos: {analytics_engine.rebuild_rollups()} meses")
+    elif args.command == "trends":
+        import json
+        today = date.today()
+        trends = analytics_engine.get_trends(today - timedelta(days=args.days - 1), today)
+        print(json.dumps(trends["totais"], ensure_ascii=False, indent=2))
+    elif args.command == "query":
+        import json
+        today = date.today()
+        group_by = [name for name in args.agrupar.split(",") if name]
+        result = analytics_engine.query(args.metrica, today - timedelta(days=args.days - 1), today, group_by)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    elif args.command == "cohorts":
+        for cohort in analytics_engine.get_cohorts(args.weeks)["cohorts"]:
+            reached = " ".join("-" if pct is None else f"{pct:5.1f}" for pct in cohort["vendido_pct"])
+            print(f"{cohort['week']}  {cohort['size']:6d}  vendido %: {reached}")
+    else:
+        # Relatórios de referência (seção a seção e passada única) só existem no benchmark
+        from analytics_bench import run_benchmark
+        run_benchmark(args.leads, args.repeat)
+
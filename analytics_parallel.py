@@ -0,0 +1,173 @@
+# analytics_parallel.py
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Tuple
+
+from analytics_aggregates import empty_aggregates, add_lead as aggregate_lead, merge_aggregates
+from analytics_rollups import add_lead as rollup_lead, merge_rollups
+from lead_snapshot import LeadHeader, pack_header
+
+log = logging.getLogger("fiat-whatsapp")
+
+# Partições por worker: mais partições que workers equilibram arquivos de tamanhos diferentes
+CHUNKS_PER_WORKER = 4
+
+
+def default_workers() -> int:
+    return max(1, int(os.getenv("ANALYTICS_WORKERS", str(os.cpu_count() or 1))))
+
+
+def _lead_files(leads_dir: str) -> List[str]:
+    """Arquivos de lead na ordem do diretório (a mesma do refresh do snapshot)"""
+    with os.scandir(leads_dir) as entries:
+        return [entry.name for entry in entries if entry.name.endswith(".json")]
+
+
+def _shard_partial(job: Tuple[str, List[str]]) -> Tuple[Dict[str, Any], Dict[str, Any], List[bytes], Dict[str, int]]:
+    """Executado nos workers: agregados, rollups, cabeçalhos e revisões lidas de uma partição"""
+    leads_dir, names = job
+    aggregates = empty_aggregates()
+    months: Dict[str, Any] = {}
+    records: List[bytes] = []
+    revisions: Dict[str, int] = {}
+    for name in names:
+        path = os.path.join(leads_dir, name)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with open(path, "r", encoding="utf-8") as f:
+                lead = json.load(f)
+        except Exception as e:
+            log.error(f"Erro ao ler lead {name}: {e}")
+            continue
+        aggregate_lead(aggregates, lead)
+        rollup_lead(months, lead)
+        records.append(pack_header(LeadHeader.from_lead(lead), mtime_ns))
+        revisions[lead.get("telefone", "")] = lead.get("revisao", 0)
+    return aggregates, months, records, revisions
+
+
+def compute(leads_dir: str, workers: int = 1) -> Tuple[Dict[str, Any], Dict[str, Any], List[bytes], Dict[str, int]]:
+    """Lê todos os leads em partições paralelas e reduz os parciais em um só resultado"""
+    names = _lead_files(leads_dir)
+    workers = max(1, workers)
+    size = max(1, -(-len(names) // (workers * CHUNKS_PER_WORKER)))
+    # Partições contíguas e map() em ordem: os cabeçalhos saem na ordem do diretório
+    jobs = [(leads_dir, names[i:i + size]) for i in range(0, len(names), size)]
+
+    aggregates = empty_aggregates()
+    months: Dict[str, Any] = {}
+    records: List[bytes] = []
+    revisions: Dict[str, int] = {}
+
+    def reduce(partials):
+        for partial_aggregates, partial_months, partial_records, partial_revisions in partials:
+            merge_aggregates(aggregates, partial_aggregates)
+            merge_rollups(months, partial_months)
+            records.extend(partial_records)
+            revisions.update(partial_revisions)
+
+    if workers == 1:
+        reduce(map(_shard_partial, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            reduce(pool.map(_shard_partial, jobs))
+    return aggregates, months, records, revisions
+
+
+def recompute(engine=None, workers: int = None) -> Dict[str, Any]:
+    """Recalcula agregados, rollups e snapshot de cabeçalhos a partir de todos os leads"""
+    if engine is None:
+        from analytics_engine import analytics_engine as engine  # evita dependência circular
+    manager = engine.lead_manager
+    workers = workers or default_workers()
+    started = time.perf_counter()
+
+    if manager.event_store is not None:
+        # No modo eventos os leads são materializados em memória pelo próprio store
+        log.info("Modo eventos: recálculo serial a partir do log")
+        aggregates = engine.rebuild_aggregates()
+        engine.rebuild_rollups()
+        manager.snapshot.refresh()
+        workers = 1
+    else:
+        # Alterações feitas durante a leitura vão para as filas e entram no replace
+        engine.aggregates.begin_rebuild()
+        engine.rollups.begin_rebuild()
+        aggregates, months, records, revisions = compute(manager.leads_dir, workers)
+        engine.aggregates.replace(aggregates, revisions)
+        engine.rollups.replace(months, revisions)
+        manager.snapshot.replace(records)
+    engine.cohorts.invalidate()
+
+    elapsed = time.perf_counter() - started
+    log.info(f"Recálculo completo do analytics: {aggregates['leads']} leads em {elapsed:.2f}s ({workers} workers)")
+    return {"leads": aggregates["leads"], "workers": workers, "seconds": round(elapsed, 3)}
+
+
+def run_benchmark(total_leads: int = 20_000, worker_counts: List[int] = None, repeat: int = 1):
+    """Mede a escala do recálculo com 1..N workers e confere que o resultado não muda"""
+    import shutil
+    import tempfile
+    from bench_data import generate_leads
+
+    worker_counts = worker_counts or sorted({1, 2, default_workers()})
+    base = tempfile.mkdtemp(prefix="bench-paralelo-")
+    try:
+        leads_dir = os.path.join(base, "leads")
+        generate_leads(leads_dir, total_leads)
+        print(f"{total_leads} leads sintéticos, {os.cpu_count()} CPUs")
+
+        # Referência: as três reconstruções seriais, cada uma relendo todos os leads
+        from analytics_engine import AnalyticsEngine
+        from lead_manager import LeadManager
+        engine = AnalyticsEngine(LeadManager(leads_dir, store_mode="arquivos"))
+        started = time.perf_counter()
+        engine.rebuild_aggregates()
+        engine.rebuild_rollups()
+        engine.lead_manager.snapshot.refresh()
+        print(f"Reconstruções separadas (serial): {time.perf_counter() - started:.2f}s")
+
+        reference = None
+        serial = None
+        for workers in worker_counts:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                aggregates, months, records, _ = compute(leads_dir, workers)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            result = (json.dumps(aggregates, sort_keys=True), json.dumps(months, sort_keys=True), records)
+            reference = reference or result
+            serial = serial or best
+            print(f"{workers} workers: {best:.2f}s ({total_leads / best:,.0f} leads/s, "
+                  f"speedup {serial / best:.2f}x) | igual ao primeiro: {result == reference}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recálculo paralelo do analytics (agregados, rollups, cabeçalhos)")
+    parser.add_argument("command", choices=["recompute", "bench"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[default_workers()],
+                        help="recompute: usa o primeiro valor; bench: mede cada um")
+    parser.add_argument("--leads", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    if args.command == "bench":
+        run_benchmark(args.leads, args.workers if len(args.workers) > 1 else None, args.repeat)
+        return 0
+
+    stats = recompute(workers=args.workers[0])
+    print(f"{stats['leads']} leads recalculados em {stats['seconds']}s com {stats['workers']} workers")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,484 @@
+# analytics_rollups.py
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Any, Iterable, Tuple
+
+import log_histogram
+from lead_signals import vehicles_in
+from lead_snapshot import STATUS_NOTE, record_epoch, to_epoch
+from rebuild_queue import RebuildQueue
+
+log = logging.getLogger("fiat-whatsapp")
+
+ROLLUPS_DIR = os.path.join("_analytics", "rollups")
+META_FILE = "meta.json"
+VERSION = 4
+
+# Cada evento só anexa uma linha ao log de deltas do mês (AAAA-MM.delta.jsonl);
+# acima deste tamanho o log é compactado no JSON do mês em segundo plano
+DELTA_SUFFIX = ".delta.jsonl"
+COMPACTING_SUFFIX = ".compactando"
+COMPACT_BYTES = int(os.getenv("ROLLUP_COMPACT_BYTES", str(256 * 1024)))
+
+# Contadores de cada balde (hora ou dia)
+METRICS = ("novos_leads", "mensagens_entrada", "mensagens_saida", "transicoes", "automacoes",
+           "permanencia", "tempo_resposta", "primeira_resposta", "cubo")
+
+# Métricas guardadas como histogramas logarítmicos por chave (segundos)
+HISTOGRAMS = ("permanencia", "tempo_resposta", "primeira_resposta")
+
+# Cubo de cada balde: contagem por métrica e combinação vendedor/status/veículo,
+# com o status do lead no momento do evento (veículo só em mencoes_veiculo)
+DIMENSIONS = ("vendedor", "status", "veiculo")
+CUBE_METRICS = ("novos_leads", "mensagens_entrada", "mensagens_saida", "mencoes_veiculo",
+                "transicoes", "automacoes")
+
+
+def empty_bucket() -> Dict[str, Any]:
+    """Contadores zerados de um balde"""
+    return {
+        "novos_leads": 0,
+        "mensagens_entrada": 0,
+        "mensagens_saida": 0,
+        "transicoes": {},     # "de → para" -> mudanças de status
+        "automacoes": {},     # regra -> envios
+        "permanencia": {},    # status de saída -> histograma do tempo no status (s)
+        "tempo_resposta": {},     # vendedor -> histograma da espera do cliente (s)
+        "primeira_resposta": {},  # vendedor -> idem, só a primeira resposta do lead
+        "cubo": {}                # métrica -> "vendedor\tstatus\tveículo" -> ocorrências
+    }
+
+
+def cube_key(seller: str, status: str, vehicle: str = "") -> str:
+    return f"{seller}\t{status}\t{vehicle}"
+
+
+def split_cube_key(key: str) -> Dict[str, str]:
+    """Dimensões de uma célula do cubo"""
+    return dict(zip(DIMENSIONS, key.split("\t")))
+
+
+def transition_key(old_status: str, new_status: str) -> str:
+    return f"{old_status} → {new_status}"
+
+
+def _add(bucket: Dict[str, Any], metric: str, key: Any = None):
+    if metric in HISTOGRAMS:
+        name, seconds = key
+        log_histogram.add(bucket[metric].setdefault(name, {}), seconds)
+    elif metric == "cubo":
+        name, cell = key
+        cube = bucket["cubo"].setdefault(name, {})
+        cube[cell] = cube.get(cell, 0) + 1
+    elif key is None:
+        bucket[metric] += 1
+    else:
+        bucket[metric][key] = bucket[metric].get(key, 0) + 1
+
+
+def merge_buckets(total: Dict[str, Any], bucket: Dict[str, Any]):
+    """Soma um balde em outro"""
+    for metric in METRICS:
+        if metric in HISTOGRAMS:
+            for name, histogram in bucket.get(metric, {}).items():
+                log_histogram.merge(total[metric].setdefault(name, {}), histogram)
+        elif metric == "cubo":
+            for name, cells in bucket.get(metric, {}).items():
+                cube = total[metric].setdefault(name, {})
+                for cell, count in cells.items():
+                    cube[cell] = cube.get(cell, 0) + count
+        elif isinstance(total[metric], dict):
+            for key, count in bucket.get(metric, {}).items():
+                total[metric][key] = total[metric].get(key, 0) + count
+        else:
+            total[metric] += bucket.get(metric, 0)
+
+
+def _bucket_keys(ts: int) -> Tuple[str, str, str]:
+    """Mês (arquivo), dia e hora locais de um epoch"""
+    moment = datetime.fromtimestamp(ts)
+    return moment.strftime("%Y-%m"), moment.strftime("%Y-%m-%d"), moment.strftime("%Y-%m-%dT%H")
+
+
+def _months(start: date, end: date) -> List[str]:
+    """Meses (AAAA-MM) que cobrem o intervalo"""
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _seller(lead: Dict[str, Any]) -> str:
+    return lead.get("vendedor_responsavel") or "Sem vendedor"
+
+
+def _response_counts(lead: Dict[str, Any], reply_ts: int, waiting_since: int,
+                     first: bool) -> List[Tuple[int, str, Any]]:
+    """Espera do cliente: da primeira mensagem ainda sem resposta até a resposta"""
+    if reply_ts <= 0 or waiting_since <= 0:
+        return []
+    latency = (_seller(lead), max(reply_ts - waiting_since, 0))
+    counts = [(reply_ts, "tempo_resposta", latency)]
+    if first:
+        counts.append((reply_ts, "primeira_resposta", latency))
+    return counts
+
+
+def _cube(ts: int, metric: str, lead: Dict[str, Any], status: str, vehicle: str = "") -> Tuple[int, str, Any]:
+    return ts, "cubo", (metric, cube_key(_seller(lead), status, vehicle))
+
+
+def _message_counts(lead: Dict[str, Any], interaction: Dict[str, Any], ts: int, status: str) -> List[Tuple[int, str, Any]]:
+    """Contadores de uma mensagem, com o status do lead quando ela chegou/saiu"""
+    if interaction.get("direcao") == "Entrada":
+        counts = [(ts, "mensagens_entrada", None), _cube(ts, "mensagens_entrada", lead, status)]
+        for vehicle in vehicles_in(interaction.get("mensagem", "").lower()):
+            counts.append(_cube(ts, "mencoes_veiculo", lead, status, vehicle))
+        return counts
+    return [(ts, "mensagens_saida", None), _cube(ts, "mensagens_saida", lead, status)]
+
+
+def _event_counts(event_type: str, data: Dict[str, Any], lead: Dict[str, Any]) -> List[Tuple[int, str, Any]]:
+    """(epoch, métrica, chave) que um evento do LeadManager soma nos rollups"""
+    status = lead.get("status", "Novo")
+    if event_type == "lead_created":
+        ts = record_epoch(data, "data_criacao")
+        return [(ts, "novos_leads", None), _cube(ts, "novos_leads", lead, data.get("status", "Novo"))]
+    if event_type == "interaction":
+        interaction = data.get("interacao", {})
+        ts = record_epoch(interaction, "timestamp", "ts")
+        counts = _message_counts(lead, interaction, ts, status)
+        if interaction.get("direcao") == "Entrada":
+            return counts
+        # Volta pelo histórico só até a resposta anterior (a interação nova é a última)
+        waiting_since = None
+        first = True
+        for previous in reversed(lead.get("historico", [])[:-1]):
+            if previous.get("direcao") != "Entrada":
+                first = False
+                break
+            waiting_since = record_epoch(previous, "timestamp", "ts")
+        if waiting_since is not None:
+            counts.extend(_response_counts(lead, ts, waiting_since, first))
+        return counts
+    if event_type == "status" and data.get("de") != data.get("para"):
+        ts = record_epoch(data, "timestamp", "ts")
+        counts = [(ts, "transicoes", transition_key(data.get("de"), data.get("para"))),
+                  _cube(ts, "transicoes", lead, data.get("para"))]
+        if "permanencia_s" in data:
+            counts.append((ts, "permanencia", (data.get("de"), data["permanencia_s"])))
+        return counts
+    if event_type == "automation":
+        ts = to_epoch(data.get("timestamp"))
+        return [(ts, "automacoes", data.get("regra", "")), _cube(ts, "automacoes", lead, status)]
+    return []
+
+
+def _status_changes(lead: Dict[str, Any]) -> List[Tuple[int, str, str]]:
+    """(epoch, de, para) das mudanças de status registradas nas notas do sistema"""
+    changes = []
+    for note in lead.get("notas", []):
+        match = STATUS_NOTE.match(note.get("texto", ""))
+        if match and note.get("autor") == "Sistema" and match.group(1) != match.group(2):
+            changes.append((to_epoch(note.get("timestamp")), match.group(1), match.group(2)))
+    return changes
+
+
+def _lead_counts(lead: Dict[str, Any]) -> Iterable[Tuple[int, str, Any]]:
+    """Mesmo que _event_counts, reconstruído a partir do documento do lead"""
+    changes = _status_changes(lead)
+    # Status em cada instante: o de origem da primeira mudança até ela, depois o de cada nota
+    change_times = [ts for ts, _, _ in changes]
+    statuses = [changes[0][1] if changes else lead.get("status", "Novo")] + [new for _, _, new in changes]
+
+    def status_at(ts: int) -> str:
+        return statuses[bisect_right(change_times, ts)]
+
+    created_ts = record_epoch(lead, "data_criacao")
+    yield created_ts, "novos_leads", None
+    yield _cube(created_ts, "novos_leads", lead, statuses[0])
+    waiting_since = None
+    first = True
+    for interaction in lead.get("historico", []):
+        ts = record_epoch(interaction, "timestamp", "ts")
+        yield from _message_counts(lead, interaction, ts, status_at(ts))
+        if interaction.get("direcao") == "Entrada":
+            if waiting_since is None:
+                waiting_since = ts
+        else:
+            if waiting_since is not None:
+                yield from _response_counts(lead, ts, waiting_since, first)
+            waiting_since = None
+            first = False
+    # Cada status dura da mudança anterior (ou da criação) até a nota seguinte
+    entered_ts = created_ts
+    for ts, old_status, new_status in changes:
+        yield ts, "transicoes", transition_key(old_status, new_status)
+        yield _cube(ts, "transicoes", lead, new_status)
+        if entered_ts > 0 and ts > 0:
+            yield ts, "permanencia", (old_status, max(ts - entered_ts, 0))
+        entered_ts = ts
+    # O lead guarda só o último envio de cada regra
+    for rule_name, sent_at in lead.get("automations", {}).items():
+        ts = to_epoch(sent_at)
+        yield ts, "automacoes", rule_name
+        yield _cube(ts, "automacoes", lead, status_at(ts))
+
+
+def _apply(months: Dict[str, Dict[str, Any]], ts: int, metric: str, key: Any):
+    """Soma uma ocorrência nos baldes da hora e do dia"""
+    month, day, hour = _bucket_keys(ts)
+    rollup = months.setdefault(month, {"horas": {}, "dias": {}})
+    _add(rollup["horas"].setdefault(hour, empty_bucket()), metric, key)
+    _add(rollup["dias"].setdefault(day, empty_bucket()), metric, key)
+
+
+def add_lead(months: Dict[str, Dict[str, Any]], lead: Dict[str, Any]):
+    """Soma todo o histórico de um lead nos rollups em memória ({mês: baldes})"""
+    for ts, metric, key in _lead_counts(lead):
+        if ts > 0:
+            _apply(months, ts, metric, key)
+
+
+def merge_rollups(total: Dict[str, Dict[str, Any]], partial: Dict[str, Dict[str, Any]]):
+    """Soma rollups parciais (ex.: de uma partição dos leads) em outros"""
+    for month, rollup in partial.items():
+        target = total.setdefault(month, {"horas": {}, "dias": {}})
+        for level, buckets in rollup.items():
+            for key, bucket in buckets.items():
+                merge_buckets(target[level].setdefault(key, empty_bucket()), bucket)
+
+
+class AnalyticsRollups:
+    """Contadores por hora e por dia (um arquivo por mês) para tendências de longo prazo"""
+
+    def __init__(self, leads_dir: str = "leads"):
+        self.base_dir = os.path.join(leads_dir, ROLLUPS_DIR)
+        # Alterações durante rebuild/recálculo, somadas depois de gravado o resultado
+        self.queue = RebuildQueue(self.base_dir, "rollups")
+        self._state_lock = threading.Lock()
+        self._compacting = set()
+
+    def __eq__(self, other) -> bool:
+        # Um único observador por diretório, mesmo com várias instâncias do engine
+        return isinstance(other, AnalyticsRollups) and other.base_dir == self.base_dir
+
+    def __hash__(self) -> int:
+        return hash(self.base_dir)
+
+    def _month_path(self, month: str) -> str:
+        return os.path.join(self.base_dir, f"{month}.json")
+
+    def _delta_path(self, month: str) -> str:
+        return os.path.join(self.base_dir, month + DELTA_SUFFIX)
+
+    @contextmanager
+    def _locked(self, shared: bool = False):
+        """flock entre threads e processos (workers do gunicorn): anexar deltas e ler
+        pedem o lock compartilhado; compactar e reconstruir, o exclusivo"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_built(self) -> bool:
+        """Rollups já construídos (rebuild inicial feito, na versão atual)"""
+        try:
+            with open(os.path.join(self.base_dir, META_FILE), "r", encoding="utf-8") as f:
+                return json.load(f).get("versao") == VERSION
+        except Exception:
+            return False
+
+    def _load_month(self, month: str) -> Dict[str, Any]:
+        try:
+            with open(self._month_path(month), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"horas": {}, "dias": {}}
+
+    def _pending_deltas(self, month: str, rollup: Dict[str, Any]) -> List[str]:
+        """Logs do mês ainda não somados no JSON: os de uma compactação interrompida
+        (exceto os que o JSON já registra como somados) e o log corrente"""
+        prefix = month + "."
+        folded = set(rollup.get("compactado", []))
+        paths = sorted(os.path.join(self.base_dir, name) for name in os.listdir(self.base_dir)
+                       if name.startswith(prefix) and name.endswith(COMPACTING_SUFFIX) and name not in folded)
+        return paths + [self._delta_path(month)]
+
+    def _apply_deltas(self, months: Dict[str, Dict[str, Any]], paths: List[str]):
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                if not line.endswith("\n"):
+                    continue  # linha ainda sendo anexada por outro processo
+                for ts, metric, key in json.loads(line):
+                    _apply(months, ts, metric, tuple(key) if isinstance(key, list) else key)
+
+    def _read_month(self, month: str) -> Dict[str, Any]:
+        """JSON compactado do mês mais os deltas anexados depois dele"""
+        with self._locked(shared=True):
+            rollup = self._load_month(month)
+            self._apply_deltas({month: rollup}, self._pending_deltas(month, rollup))
+        return rollup
+
+    def _write_json(self, path: str, data: Dict[str, Any]):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def on_lead_event(self, before: Optional[Dict[str, Any]], lead: Dict[str, Any],
+                      event_type: str, data: Dict[str, Any]):
+        """Soma o evento nos baldes da hora e do dia em que ocorreu"""
+        counts = [count for count in _event_counts(event_type, data, lead) if count[0] > 0]
+        if not counts:
+            return  # notas, atualizações cadastrais etc. não entram nos rollups
+
+        by_month: Dict[str, List[Tuple[int, str, Any]]] = {}
+        for count in counts:
+            by_month.setdefault(_bucket_keys(count[0])[0], []).append(count)
+
+        oversized = []
+        with self._locked(shared=True):
+            if self.queue.active():
+                self.queue.push(lead, counts)
+                return
+            if not self.is_built():
+                return  # ainda não construídos: o rebuild inicial já lerá este lead
+            for month, month_counts in by_month.items():
+                # Uma única escrita em modo append por mês: linhas inteiras mesmo entre processos
+                with open(self._delta_path(month), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(month_counts, ensure_ascii=False) + "\n")
+                    if f.tell() >= COMPACT_BYTES:
+                        oversized.append(month)
+        for month in oversized:
+            self._compact_in_background(month)
+
+    def _compact_in_background(self, month: str):
+        with self._state_lock:
+            if month in self._compacting:
+                return
+            self._compacting.add(month)
+        threading.Thread(target=self._background_compact, args=(month,), daemon=True).start()
+
+    def _background_compact(self, month: str):
+        try:
+            self.compact(month)
+        except Exception as e:
+            log.error(f"Erro ao compactar os rollups de {month}: {e}")
+        finally:
+            with self._state_lock:
+                self._compacting.discard(month)
+
+    def compact(self, month: Optional[str] = None) -> int:
+        """Soma os logs de deltas no JSON do mês (ou de todos); retorna os meses compactados.
+        O log é renomeado antes e o JSON registra os nomes somados: se o processo cair
+        entre gravar o JSON e apagar o log, a próxima compactação não soma duas vezes"""
+        compacted = 0
+        with self._locked():
+            if month is None:
+                months = sorted({name.split(".")[0] for name in os.listdir(self.base_dir)
+                                 if name.endswith(DELTA_SUFFIX) or name.endswith(COMPACTING_SUFFIX)})
+            else:
+                months = [month]
+            for name in months:
+                rollup = self._load_month(name)
+                for folded in rollup.get("compactado", []):
+                    try:
+                        os.remove(os.path.join(self.base_dir, folded))
+                    except FileNotFoundError:
+                        pass
+                paths = self._pending_deltas(name, rollup)[:-1]
+                delta_path = self._delta_path(name)
+                if os.path.exists(delta_path) and os.path.getsize(delta_path) > 0:
+                    rotated = f"{name}.{time.time_ns()}{COMPACTING_SUFFIX}"
+                    os.replace(delta_path, os.path.join(self.base_dir, rotated))
+                    paths.append(os.path.join(self.base_dir, rotated))
+                if not paths:
+                    continue
+                self._apply_deltas({name: rollup}, paths)
+                rollup["compactado"] = [os.path.basename(path) for path in paths]
+                self._write_json(self._month_path(name), rollup)
+                for path in paths:
+                    os.remove(path)
+                compacted += 1
+        return compacted
+
+    def begin_rebuild(self):
+        """Antes de ler os leads: daqui até o replace as alterações vão para a fila"""
+        with self._locked():
+            self.queue.begin()
+
+    def rebuild(self, leads: Iterable[Dict[str, Any]]) -> int:
+        """Reconstrução completa a partir do histórico dos leads; retorna os meses gravados"""
+        self.begin_rebuild()
+        months: Dict[str, Dict[str, Any]] = {}
+        revisions = {}
+        for lead in leads:
+            add_lead(months, lead)
+            revisions[lead.get("telefone", "")] = lead.get("revisao", 0)
+        return self.replace(months, revisions)
+
+    def replace(self, months: Dict[str, Dict[str, Any]], revisions: Optional[Dict[str, int]] = None) -> int:
+        """Grava rollups calculados por fora (rebuild ou recálculo paralelo). Com
+        begin_rebuild antes, revisions traz a revisão lida de cada lead e as alterações
+        posteriores da fila são somadas ao resultado"""
+        with self._locked():
+            for counts in self.queue.drain(revisions or {}):
+                for ts, metric, key in counts:
+                    _apply(months, ts, metric, tuple(key) if isinstance(key, list) else key)
+            for name in os.listdir(self.base_dir):
+                stale = name.endswith(".json") and name != META_FILE and name[:-5] not in months
+                if stale or name.endswith(DELTA_SUFFIX) or name.endswith(COMPACTING_SUFFIX):
+                    os.remove(os.path.join(self.base_dir, name))
+            for month, rollup in months.items():
+                self._write_json(self._month_path(month), rollup)
+            self._write_json(os.path.join(self.base_dir, META_FILE),
+                             {"versao": VERSION, "construido_em": int(time.time())})
+        log.info(f"Rollups do analytics reconstruídos: {len(months)} meses")
+        return len(months)
+
+    def series(self, start: date, end: date, granularity: str = "dia") -> List[Tuple[str, Dict[str, Any]]]:
+        """Baldes do intervalo [start, end] em ordem, inclusive os vazios (O(baldes))"""
+        if granularity not in ("dia", "hora"):
+            raise ValueError(f"Granularidade inválida: {granularity}")
+
+        level = "dias" if granularity == "dia" else "horas"
+        stored = {}
+        for month in _months(start, end):
+            stored.update(self._read_month(month)[level])
+
+        buckets = []
+        day = start
+        while day <= end:
+            if granularity == "dia":
+                keys = [day.isoformat()]
+            else:
+                keys = [f"{day.isoformat()}T{hour:02d}" for hour in range(24)]
+            for key in keys:
+                buckets.append((key, stored.get(key) or empty_bucket()))
+            day += timedelta(days=1)
+        return buckets
+
+    def totals(self, start: date, end: date) -> Dict[str, Any]:
+        """Soma dos contadores no intervalo [start, end], a partir dos baldes diários"""
+        total = empty_bucket()
+        for _, bucket in self.series(start, end):
+            merge_buckets(total, bucket)
+        return total
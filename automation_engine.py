@@ -1,97 +1,131 @@
 # automation_engine.py
 import os
+import re
 import json
+import copy
+import fcntl
+import heapq
 import logging
 import threading
 import time
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
-from flask import current_app
 from lead_manager import lead_manager
+from lead_snapshot import LeadHeader
 from ai_humanizer import ai_humanizer
+from message_outbox import message_outbox
+from automation_rules import (CompiledRule, LeadIndex, DEFAULT_RULES, compile_rules, load_rules,
+                              rules_path, rules_stamp)
+from leader_lease import LeaderLease, data_dir
 
 log = logging.getLogger("fiat-whatsapp")
 
+# Nota gravada por /api/schedule-appointment
+APPOINTMENT_NOTE = re.compile(r"^Test drive agendado para (\d{2}/\d{2}/\d{4}) às (\d{2}:\d{2})")
+RULE_COOLDOWN = 24 * 3600  # a mesma regra no máximo uma vez por dia
+# no_recent_qualification: a regra de qualificação não se repete ao lead nesta janela
+QUALIFICATION_WINDOW = 7 * 24 * 3600
+# Envio enfileirado e ainda não entregue segura as outras regras do lead até este prazo
+IN_FLIGHT_TTL = 3600
+# Telefones alterados nos workers de reserva, lidos pelo líder (uma linha por alteração)
+CHANGES_FILE = "automacao_mudancas.log"
+CHANGES_POLL = 2.0
+CHANGES_MAX_BYTES = 1 << 20
+RULES_POLL = 5.0  # verificação do mtime do arquivo de regras
+
+def appointment_ts(lead: Dict) -> Optional[float]:
+    """Epoch do último test drive agendado registrado nas notas (None se não houver)"""
+    for note in reversed(lead.get("notas", [])):
+        match = APPOINTMENT_NOTE.match(note.get("texto", ""))
+        if match:
+            try:
+                return datetime.strptime(" ".join(match.groups()), "%d/%m/%Y %H:%M").timestamp()
+            except ValueError:
+                return None
+    return None
+
 class AutomationEngine:
     """Sistema de automação de follow-up e engajamento"""
     
-    def __init__(self):
+    def __init__(self, manager=None):
+        self.lead_manager = manager or lead_manager
+        # Regras declarativas em DATA_DIR, recarregadas quando o arquivo muda
+        self.rules_path = rules_path()
+        self._rules_stamp = None
         self.automation_rules = self._load_automation_rules()
+        # Condições compiladas em predicados sobre o cabeçalho, uma vez por carga de regras
+        self.compiled_rules = compile_rules(self.automation_rules)
         self.running = False
         self.thread = None
+        # Agenda: heap de (prazo, telefone, regra); _due guarda o prazo vigente de
+        # cada par e invalida as entradas antigas do heap (remoção preguiçosa)
+        self._heap: List[tuple] = []
+        self._due: Dict[tuple, float] = {}
+        self._wakeup = threading.Condition()
+        # Mudanças feitas por outros processos não chegam pelo observador
+        self.resync_interval = int(os.getenv("AUTOMATION_RESYNC_SECONDS", "3600"))
+        # Intervalo mínimo entre mensagens automáticas (de qualquer regra) ao mesmo lead
+        self.min_gap = float(os.getenv("AUTOMATION_MIN_GAP_HOURS", "1")) * 3600
+        # Telefone -> epoch do envio enfileirado que o outbox ainda não entregou
+        self._in_flight: Dict[str, float] = {}
+        # Só o processo líder roda o agendador; os de reserva repassam as alterações de leads
+        self.lease = LeaderLease("automacao", on_elected=self.start_automation,
+                                 on_demoted=self.stop_automation, healthy=self._healthy)
+        self.changes_path = os.path.join(data_dir(), CHANGES_FILE)
+        self._changes_offset = 0
         
     def _load_automation_rules(self) -> List[Dict[str, Any]]:
-        """Carrega regras de automação"""
-        return [
-            {
-                "name": "follow_up_inativo_5h",
-                "description": "Follow-up para leads inativos há 5 horas",
-                "condition": {
-                    "inactive_hours": 5,
-                    "status_not_in": ["Vendido", "Perdido"],
-                    "max_follow_ups": 3
-                },
-                "action": {
-                    "type": "send_message",
-                    "templates": [
-                        "Oi! Só passando para saber se você teve a chance de ver as informações que te enviei. Alguma dúvida que posso esclarecer?",
-                        "Olá! Notei que conversamos mais cedo sobre os carros. Tem alguma pergunta que posso ajudar a responder?",
-                        "Oi! Queria saber se você gostaria de mais detalhes sobre algum modelo específico que conversamos.",
-                        "Olá! Caso tenha ficado alguma dúvida sobre nossas ofertas, estou aqui para ajudar!"
-                    ]
-                }
-            },
-            {
-                "name": "lembrete_test_drive",
-                "description": "Lembrete 24h antes do test drive",
-                "condition": {
-                    "status": "Agendado",
-                    "hours_before_appointment": 24
-                },
-                "action": {
-                    "type": "send_message",
-                    "templates": [
-                        "Oi! Só para confirmar seu test drive amanhã. Nosso endereço é Av. Osvaldo Reis, 1515 - Itajaí. Estamos te esperando!",
-                        "Olá! Lembrete do seu test drive marcado para amanhã. Qualquer imprevisto, é só me avisar!",
-                        "Oi! Confirmando seu test drive de amanhã. Vai ser ótimo te conhecer pessoalmente!"
-                    ]
-                }
-            },
-            {
-                "name": "reativacao_lead_frio",
-                "description": "Reativação de leads frios (7 dias sem interação)",
-                "condition": {
-                    "inactive_hours": 168,  # 7 dias
-                    "status_not_in": ["Vendido", "Perdido"],
-                    "score_min": 10
-                },
-                "action": {
-                    "type": "send_message",
-                    "templates": [
-                        "Oi! Faz um tempo que não conversamos. Temos algumas ofertas especiais novas que podem te interessar. Quer dar uma olhada?",
-                        "Olá! Apareceram algumas condições especiais de financiamento que talvez sejam interessantes para você. Posso te contar?",
-                        "Oi! Chegaram alguns carros novos na loja que podem ser do seu perfil. Quer que eu te mande as informações?"
-                    ]
-                }
-            },
-            {
-                "name": "qualificacao_lead_quente",
-                "description": "Qualificação de leads com alto score",
-                "condition": {
-                    "score_min": 50,
-                    "status": "Novo",
-                    "no_recent_qualification": True
-                },
-                "action": {
-                    "type": "send_message",
-                    "templates": [
-                        "Oi! Vejo que você tem bastante interesse em nossos carros. Que tal agendarmos um test drive para você conhecer melhor?",
-                        "Olá! Pelo seu interesse, acredito que temos o carro ideal para você. Podemos conversar sobre as condições?",
-                        "Oi! Notei seu interesse em nossos veículos. Quer que eu prepare uma proposta personalizada para você?"
-                    ]
-                }
-            }
-        ]
+        """Carrega as regras do arquivo em DATA_DIR (sem arquivo, as regras padrão)"""
+        self._rules_stamp = rules_stamp(self.rules_path)
+        if self._rules_stamp is None:
+            return DEFAULT_RULES
+        try:
+            rules = load_rules(self.rules_path)
+            log.info(f"Regras de automação carregadas de {self.rules_path}: {len(rules)}")
+            return rules
+        except (OSError, ValueError) as e:
+            # Arquivo com erro não vira regra padrão: nada é enviado até ser corrigido
+            log.error(f"Arquivo de regras inválido ({self.rules_path}), automação sem regras: {e}")
+            return []
+    
+    def reload_rules(self) -> bool:
+        """Relê o arquivo de regras se ele mudou. Só as regras novas ou com condição
+        alterada são reagendadas; mudança só de textos não mexe na agenda"""
+        stamp = rules_stamp(self.rules_path)
+        if stamp == self._rules_stamp:
+            return False
+        self._rules_stamp = stamp
+        try:
+            rules = load_rules(self.rules_path) if stamp is not None else DEFAULT_RULES
+            compiled = compile_rules(rules)
+        except (OSError, ValueError) as e:
+            log.error(f"Arquivo de regras inválido ({self.rules_path}), mantendo as regras atuais: {e}")
+            return False
+        
+        previous = {rule.name: rule.rule["condition"] for rule in self.compiled_rules}
+        changed = [rule for rule in compiled if previous.get(rule.name) != rule.rule["condition"]]
+        names = {rule.name for rule in compiled}
+        removed = set(previous) - names
+        self.automation_rules = rules
+        self.compiled_rules = compiled
+        if self.running:
+            stale = removed | {rule.name for rule in changed}
+            with self._wakeup:
+                self._due = {key: due for key, due in self._due.items() if key[1] not in stale}
+            if changed:
+                self._schedule_rules(changed)
+        log.info(f"Regras de automação recarregadas: {len(compiled)} ({len(changed)} novas/alteradas, "
+                 f"{len(removed)} removidas)")
+        return True
+    
+    def start_with_leader_election(self):
+        """Disputa a liderança: um único processo roda a automação, os outros ficam de reserva"""
+        self.lead_manager.add_observer(self)
+        self.lease.start()
+    
+    def _healthy(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
     
     def start_automation(self):
         """Inicia o motor de automação"""
@@ -100,6 +134,12 @@ class AutomationEngine:
             return
         
         self.running = True
+        # Alterações anteriores entram pela agenda completa montada no início do loop
+        try:
+            self._changes_offset = os.path.getsize(self.changes_path)
+        except OSError:
+            self._changes_offset = 0
+        self.lead_manager.add_observer(self)
         self.thread = threading.Thread(target=self._automation_loop, daemon=True)
         self.thread.start()
         log.info("Motor de automação iniciado")
@@ -107,109 +147,232 @@ class AutomationEngine:
     def stop_automation(self):
         """Para o motor de automação"""
         self.running = False
+        with self._wakeup:
+            self._wakeup.notify_all()
         if self.thread:
             self.thread.join(timeout=5)
         log.info("Motor de automação parado")
     
     def _automation_loop(self):
-        """Loop principal da automação"""
+        """Loop principal: dorme até o próximo prazo e processa só os pares vencidos"""
+        next_resync = 0.0
+        next_rules_check = time.time() + RULES_POLL
         while self.running:
             try:
-                self._process_automation_rules()
-                # Aguardar 5 minutos antes da próxima verificação
-                time.sleep(300)  # 5 minutos
+                now = time.time()
+                if now >= next_rules_check:
+                    self.reload_rules()
+                    next_rules_check = now + RULES_POLL
+                if now >= next_resync:
+                    self._schedule_all()
+                    next_resync = now + self.resync_interval
+                
+                if self.lease.running:
+                    self._read_changes()
+                
+                for phone, rule_name in self._pop_due(now):
+                    self._run_due(phone, rule_name, now)
+                
+                with self._wakeup:
+                    if self.running:
+                        deadline = min(self._next_deadline(), next_resync, next_rules_check)
+                        if self.lease.running:
+                            deadline = min(deadline, time.time() + CHANGES_POLL)
+                        self._wakeup.wait(max(deadline - time.time(), 0))
             except Exception as e:
                 log.error(f"Erro no loop de automação: {e}")
                 time.sleep(60)  # Aguardar 1 minuto em caso de erro
     
-    def _process_automation_rules(self):
-        """Processa todas as regras de automação"""
-        all_leads = lead_manager.get_all_leads()
+    def _next_due(self, header: LeadHeader, rule: CompiledRule, lead: Optional[Dict] = None,
+                  now: Optional[float] = None, candidate: bool = False) -> Optional[float]:
+        """Quando a regra vence para o lead (epoch), ou None se o estado atual não a permite.
+        Sem o lead completo (só o cabeçalho) o intervalo entre envios não é conhecido e o
+        prazo sai mais cedo; ao vencer, o lead é relido e o prazo recalculado.
+        candidate: o cabeçalho veio do LeadIndex da regra (status e score já conferidos)."""
+        condition = rule.rule["condition"]
+        # Com now infinito só o estado conta; a inatividade vira o prazo abaixo
+        matches = rule.residual if candidate else rule.matches
+        if not matches(header, float("inf")):
+            return None
         
-        for rule in self.automation_rules:
-            try:
-                eligible_leads = self._find_eligible_leads(all_leads, rule)
-                
-                for lead in eligible_leads:
-                    if self._should_execute_rule(lead, rule):
-                        self._execute_rule_action(lead, rule)
-                        
-            except Exception as e:
-                log.error(f"Erro ao processar regra {rule['name']}: {e}")
+        due = 0.0
+        if condition.get("inactive_hours") and header.ultima_interacao_ts:
+            due = header.ultima_interacao_ts + condition["inactive_hours"] * 3600
+        # Só com o cabeçalho o agendamento não é conhecido: o prazo serve para ler o lead,
+        # e a regra só roda depois de recalculada abaixo com ele
+        if lead is not None:
+            if "hours_before_appointment" in condition:
+                appointment = appointment_ts(lead)
+                if appointment is None:
+                    return None  # sem test drive agendado nas notas, nada a lembrar
+                if appointment <= (time.time() if now is None else now):
+                    return None  # test drive já passou
+                due = max(due, appointment - condition["hours_before_appointment"] * 3600)
+            last_automation = self._get_last_automation(lead, rule.name)
+            if last_automation:
+                cooldown = QUALIFICATION_WINDOW if condition.get("no_recent_qualification") else RULE_COOLDOWN
+                due = max(due, last_automation.timestamp() + cooldown)
+            last_any = self._last_automation_ts(lead)
+            if last_any:
+                due = max(due, last_any + self.min_gap)
+        return due
     
-    def _find_eligible_leads(self, leads: List[Dict], rule: Dict) -> List[Dict]:
-        """Encontra leads elegíveis para uma regra específica"""
-        eligible = []
-        condition = rule["condition"]
-        
-        for lead in leads:
-            if self._lead_matches_condition(lead, condition):
-                eligible.append(lead)
-        
-        return eligible
+    def _schedule(self, phone: str, rule_name: str, due: Optional[float]):
+        """Troca o prazo de um par (telefone, regra); None tira o par da agenda"""
+        key = (phone, rule_name)
+        with self._wakeup:
+            if due is None:
+                self._due.pop(key, None)
+                return
+            if self._due.get(key) == due:
+                return
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, phone, rule_name))
+            if len(self._heap) > 2 * len(self._due) + 1000:
+                # Muitas entradas invalidadas: reconstrói o heap só com as vigentes
+                self._heap = [(d, p, r) for (p, r), d in self._due.items()]
+                heapq.heapify(self._heap)
+            if self._heap[0][0] == due:
+                self._wakeup.notify()  # novo prazo mais cedo que o que o loop espera
     
-    def _lead_matches_condition(self, lead: Dict, condition: Dict) -> bool:
-        """Verifica se um lead atende às condições da regra"""
-        
-        # Verificar status
-        if "status" in condition:
-            if lead.get("status") != condition["status"]:
-                return False
-        
-        if "status_not_in" in condition:
-            if lead.get("status") in condition["status_not_in"]:
-                return False
-        
-        # Verificar score mínimo
-        if "score_min" in condition:
-            if lead.get("score", 0) < condition["score_min"]:
-                return False
-        
-        # Verificar inatividade
-        if "inactive_hours" in condition:
-            last_interaction = lead.get("ultima_interacao")
-            if last_interaction:
-                try:
-                    last_time = datetime.fromisoformat(last_interaction)
-                    hours_inactive = (datetime.now() - last_time).total_seconds() / 3600
-                    if hours_inactive < condition["inactive_hours"]:
-                        return False
-                except:
-                    return False
-        
-        # Verificar máximo de follow-ups
-        if "max_follow_ups" in condition:
-            follow_up_count = self._count_follow_ups(lead)
-            if follow_up_count >= condition["max_follow_ups"]:
-                return False
-        
-        return True
+    def _schedule_lead(self, lead: Dict):
+        # Só o que as condições usam: sem varrer histórico e notas a cada gravação
+        header = LeadHeader.from_lead(lead, signals=False)
+        for rule in self.compiled_rules:
+            self._schedule(header.telefone, rule.name, self._next_due(header, rule, lead))
     
-    def _should_execute_rule(self, lead: Dict, rule: Dict) -> bool:
-        """Verifica se deve executar a regra para este lead"""
-        
-        # Verificar se já executou esta regra recentemente
-        last_automation = self._get_last_automation(lead, rule["name"])
-        if last_automation:
-            # Não executar a mesma regra mais de uma vez por dia
-            time_since_last = datetime.now() - last_automation
-            if time_since_last < timedelta(hours=24):
-                return False
-        
-        return True
+    def _schedule_all(self):
+        """Recalcula a agenda inteira a partir dos cabeçalhos (início e ressincronização)"""
+        headers = self.lead_manager.get_lead_headers()
+        # Só os candidatos do índice (status e score) passam pelo predicado de cada regra
+        index = LeadIndex(headers)
+        due = {}
+        for rule in self.compiled_rules:
+            for header in index.candidates(rule):
+                # Prazo já conhecido (com o lead completo) não é adiantado
+                when = self._next_due(header, rule, candidate=True)
+                if when is not None:
+                    key = (header.telefone, rule.name)
+                    due[key] = max(when, self._due.get(key, when))
+        expired = time.time() - IN_FLIGHT_TTL
+        self._in_flight = {phone: since for phone, since in self._in_flight.items() if since > expired}
+        with self._wakeup:
+            self._due = due
+            self._heap = [(d, p, r) for (p, r), d in due.items()]
+            heapq.heapify(self._heap)
+            self._wakeup.notify()
+        log.info(f"Agenda de automação: {len(due)} prazos para {len(headers)} leads")
+    
+    def _schedule_rules(self, rules: List[CompiledRule]):
+        """Agenda só as regras dadas (novas ou alteradas), sem mexer nos prazos das outras"""
+        index = LeadIndex(self.lead_manager.get_lead_headers())
+        due = {}
+        for rule in rules:
+            for header in index.candidates(rule):
+                when = self._next_due(header, rule, candidate=True)
+                if when is not None:
+                    due[(header.telefone, rule.name)] = when
+        with self._wakeup:
+            self._due.update(due)
+            for (phone, rule_name), when in due.items():
+                heapq.heappush(self._heap, (when, phone, rule_name))
+            self._wakeup.notify()
+        log.info(f"Agenda de automação: {len(due)} prazos para {len(rules)} regras recarregadas")
+    
+    def _next_deadline(self) -> float:
+        """Menor prazo vigente (descarta do topo as entradas invalidadas)"""
+        while self._heap:
+            due, phone, rule_name = self._heap[0]
+            if self._due.get((phone, rule_name)) == due:
+                return due
+            heapq.heappop(self._heap)
+        return float("inf")
+    
+    def _pop_due(self, now: float) -> List[tuple]:
+        """Retira da agenda os pares com prazo vencido"""
+        due_pairs = []
+        with self._wakeup:
+            while self._next_deadline() <= now:
+                _, phone, rule_name = heapq.heappop(self._heap)
+                del self._due[(phone, rule_name)]
+                due_pairs.append((phone, rule_name))
+        return due_pairs
+    
+    def _run_due(self, phone: str, rule_name: str, now: float):
+        """Relê o lead de um prazo vencido: executa a regra ou reagenda"""
+        rule = next((r for r in self.compiled_rules if r.name == rule_name), None)
+        lead = self.lead_manager.get_lead(phone)
+        if rule is None or lead is None:
+            return
+        try:
+            since = self._in_flight.get(phone)
+            if since is not None:
+                if self._last_automation_ts(lead) >= since or now >= since + IN_FLIGHT_TTL:
+                    del self._in_flight[phone]  # entregue (ou o outbox desistiu)
+                else:
+                    # Outra mensagem do lead ainda na fila: a entrega reagenda o lead
+                    self._schedule(phone, rule_name, since + IN_FLIGHT_TTL)
+                    return
+            due = self._next_due(LeadHeader.from_lead(lead, signals=False), rule, lead, now)
+            if due is None:
+                return
+            if due > now:
+                self._schedule(phone, rule_name, due)
+                return
+            # A entrega altera o lead e o observador reagenda o par
+            self._execute_rule_action(lead, rule.rule)
+        except Exception as e:
+            log.error(f"Erro ao processar regra {rule_name} para {phone}: {e}")
+    
+    def on_lead_event(self, before: Optional[Dict], lead: Dict, event_type: str, data: Dict):
+        """Observador do LeadManager: recalcula os prazos do lead alterado"""
+        if self.running:
+            self._schedule_lead(lead)
+        elif self.lease.running:
+            self._forward_change(lead["telefone"])
+    
+    def _forward_change(self, phone: str):
+        """Worker de reserva: avisa o líder de que o lead mudou"""
+        try:
+            with open(self.changes_path, "a", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(phone + "\n")
+        except OSError as e:
+            log.error(f"Erro ao repassar alteração de {phone} ao líder: {e}")
+    
+    def _read_changes(self):
+        """Líder: reagenda os leads alterados pelos outros workers desde a última leitura"""
+        try:
+            with open(self.changes_path, "rb+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(self._changes_offset)
+                data = f.read()
+                self._changes_offset = f.tell()
+                if self._changes_offset >= CHANGES_MAX_BYTES:
+                    f.truncate(0)  # tudo lido: recomeça o arquivo
+                    self._changes_offset = 0
+        except FileNotFoundError:
+            return
+        for phone in set(data.decode("utf-8").split()):
+            lead = self.lead_manager.get_lead(phone)
+            if lead is not None:
+                self._schedule_lead(lead)
     
     def _execute_rule_action(self, lead: Dict, rule: Dict):
         """Executa a ação da regra"""
         action = rule["action"]
         
         if action["type"] == "send_message":
+            # A execução da regra só é registrada no lead quando o outbox confirmar a entrega;
+            # até lá as outras regras do lead esperam, e o par volta à agenda se não houver
+            # entrega (agendado antes de enfileirar: a entrega pode chegar antes do retorno)
+            phone = lead["telefone"]
+            self._in_flight[phone] = time.time()
+            self._schedule(phone, rule["name"], self._in_flight[phone] + IN_FLIGHT_TTL)
             self._send_automated_message(lead, rule)
-        
-        # Registrar que a automação foi executada
-        self._record_automation_execution(lead, rule["name"])
     
     def _send_automated_message(self, lead: Dict, rule: Dict):
-        """Envia mensagem automatizada"""
+        """Enfileira a mensagem automatizada no outbox"""
         import random
         
         templates = rule["action"]["templates"]
@@ -224,43 +387,20 @@ class AutomationEngine:
                 message = message.replace("Oi!", f"Oi, {lead['nome_cliente']}!")
                 message = message.replace("Olá!", f"Olá, {lead['nome_cliente']}!")
         
-        # Registrar a mensagem no histórico
-        lead_manager.add_interaction(
-            phone=lead["telefone"],
-            direction="Saída",
-            message=message,
-            message_type="automacao"
-        )
-        
-        # Tentar enviar via Twilio se configurado
-        self._try_send_via_twilio(lead["telefone"], message)
-        
-        log.info(f"Mensagem automática enviada para {lead['telefone']}: {rule['name']}")
-    
-    def _try_send_via_twilio(self, phone: str, message: str):
-        """Tenta enviar mensagem via Twilio"""
-        try:
-            # Importar aqui para evitar dependência circular
-            from routes import send_via_twilio_api
-            
-            # Tentar enviar se as configurações estiverem disponíveis
-            if hasattr(current_app, 'config'):
-                success = send_via_twilio_api(phone, message)
-                if success:
-                    log.info(f"Mensagem automática enviada via Twilio para {phone}")
-                else:
-                    log.warning(f"Falha ao enviar mensagem automática via Twilio para {phone}")
-        except Exception as e:
-            log.error(f"Erro ao enviar mensagem automática via Twilio: {e}")
+        # Uma mensagem por regra, lead e dia, mesmo que a regra vença de novo antes da entrega
+        key = f"{rule['name']}:{lead['telefone']}:{datetime.now().date().isoformat()}"
+        if message_outbox.enqueue(lead["telefone"], message, key=key, direcao="Saída",
+                                  tipo_mensagem="automacao", regra=rule["name"]):
+            log.info(f"Mensagem automática enfileirada para {lead['telefone']}: {rule['name']}")
     
-    def _count_follow_ups(self, lead: Dict) -> int:
-        """Conta quantos follow-ups automáticos foram enviados"""
-        count = 0
-        for interaction in lead.get("historico", []):
-            if (interaction.get("direcao") == "Saída" and 
-                interaction.get("tipo_mensagem") == "automacao"):
-                count += 1
-        return count
+    def _last_automation_ts(self, lead: Dict) -> float:
+        """Epoch da última mensagem automática entregue ao lead, de qualquer regra (0 se nenhuma)"""
+        last = 0.0
+        for rule_name in lead.get("automations", {}):
+            executed = self._get_last_automation(lead, rule_name)
+            if executed:
+                last = max(last, executed.timestamp())
+        return last
     
     def _get_last_automation(self, lead: Dict, rule_name: str) -> Optional[datetime]:
         """Obtém a data da última execução de uma regra específica"""
@@ -275,61 +415,193 @@ class AutomationEngine:
         
         return None
     
-    def _record_automation_execution(self, lead: Dict, rule_name: str):
-        """Registra a execução de uma automação"""
-        if "automations" not in lead:
-            lead["automations"] = {}
+    def simulate(self, hours: float = 24, start: Optional[float] = None,
+                 rules: Optional[List[Dict[str, Any]]] = None, delivery_s: float = 0) -> Dict[str, Any]:
+        """Simulação sem envios: reproduz a base nas regras de `start` (padrão: agora) até
+        `hours` depois e projeta os envios por regra e por hora. Como no motor real, o
+        envio só fica na fila: as outras regras do lead esperam a entrega (`delivery_s`
+        depois), e só ela altera a cópia do lead (inatividade, follow-ups, intervalo das
+        regras). Numa mesma passada, os prazos vencidos rodam antes das entregas.
+        Nada é gravado nem enfileirado."""
+        start = time.time() if start is None else start
+        end = start + hours * 3600
+        compiled = compile_rules(rules) if rules is not None else self.compiled_rules
+        by_name = {rule.name: rule for rule in compiled}
+        phases = {}
         
-        lead["automations"][rule_name] = datetime.now().isoformat()
+        started = time.perf_counter()
+        headers = {header.telefone: header for header in self.lead_manager.get_lead_headers()}
+        phases["cabecalhos"] = time.perf_counter() - started
         
-        # Salvar o lead atualizado
-        lead_manager._atomic_write(
-            lead_manager._get_lead_file_path(lead["telefone"]),
-            lead
-        )
-    
-    def get_automation_stats(self) -> Dict[str, Any]:
-        """Retorna estatísticas das automações"""
-        all_leads = lead_manager.get_all_leads()
+        started = time.perf_counter()
+        index = LeadIndex(headers.values())
+        phases["indice"] = time.perf_counter() - started
         
-        stats = {
-            "total_automations_sent": 0,
-            "automations_by_rule": {},
-            "leads_with_automations": 0
-        }
+        # Mesma agenda que _schedule_all montaria, só que local
+        started = time.perf_counter()
+        current: Dict[tuple, float] = {}
+        stats = {rule.name: {"candidatos": 0, "prazos": 0, "envios": 0} for rule in compiled}
+        for rule in compiled:
+            for header in index.candidates(rule):
+                stats[rule.name]["candidatos"] += 1
+                when = self._next_due(header, rule, candidate=True)
+                if when is not None:
+                    current[(header.telefone, rule.name)] = when
+                    stats[rule.name]["prazos"] += 1
+        heap = [(due, phone, name) for (phone, name), due in current.items()]
+        heapq.heapify(heap)
+        phases["agenda"] = time.perf_counter() - started
         
-        for lead in all_leads:
-            automations = lead.get("automations", {})
-            if automations:
-                stats["leads_with_automations"] += 1
-                
-                for rule_name in automations:
-                    stats["automations_by_rule"][rule_name] = stats["automations_by_rule"].get(rule_name, 0) + 1
-                    stats["total_automations_sent"] += 1
+        # Reprodução no tempo: só os leads com prazo na janela são lidos (uma vez cada),
+        # e deles só o que _next_due usa além do cabeçalho
+        started = time.perf_counter()
+        leads: Dict[str, Dict[str, Any]] = {}
+        per_hour: Dict[str, int] = defaultdict(int)
+        read_time = 0.0
+        overdue = sum(1 for due in current.values() if due <= start)
+        deliveries = deque()   # (instante da entrega, telefone, regra), em ordem de envio
+        in_flight = set()
+        clock = start
+        while True:
+            pair_at = max(heap[0][0], clock) if heap else float("inf")
+            if deliveries and deliveries[0][0] < min(pair_at, end):
+                # Entrega: o que _record_delivery grava no lead, e o observador reagenda
+                clock, phone, name = deliveries.popleft()
+                in_flight.discard(phone)
+                header = headers[phone] = copy.copy(headers[phone])
+                header.ultima_interacao_ts = int(clock)
+                header.total_interacoes += 1
+                header.saidas += 1
+                header.follow_ups += 1
+                lead = leads[phone]
+                lead["automations"][name] = datetime.fromtimestamp(clock).isoformat()
+                for rule in compiled:
+                    when = self._next_due(header, rule, lead, clock)
+                    key = (phone, rule.name)
+                    if when is None:
+                        current.pop(key, None)
+                    elif current.get(key) != when:
+                        current[key] = when
+                        heapq.heappush(heap, (when, phone, rule.name))
+                continue
+            if pair_at >= end:
+                break
+            
+            due, phone, name = heapq.heappop(heap)
+            if current.get((phone, name)) != due:
+                continue
+            del current[(phone, name)]
+            clock = pair_at
+            if phone in in_flight:
+                continue  # como em _run_due: a entrega pendente reagenda o lead
+            lead = leads.get(phone)
+            if lead is None:
+                read_started = time.perf_counter()
+                full = self.lead_manager.get_lead(phone) or {}
+                read_time += time.perf_counter() - read_started
+                lead = leads[phone] = {"notas": full.get("notas", []),
+                                       "automations": dict(full.get("automations", {}))}
+            when = self._next_due(headers[phone], by_name[name], lead, clock)
+            if when is None:
+                continue
+            if when > clock:
+                current[(phone, name)] = when
+                heapq.heappush(heap, (when, phone, name))
+                continue
+            
+            stats[name]["envios"] += 1
+            per_hour[datetime.fromtimestamp(clock).strftime("%Y-%m-%dT%H:00")] += 1
+            in_flight.add(phone)
+            deliveries.append((clock + delivery_s, phone, name))
+        phases["reproducao"] = time.perf_counter() - started
+        phases["leitura_leads"] = read_time
         
-        return stats
+        total = sum(rule["envios"] for rule in stats.values())
+        return {
+            "inicio": datetime.fromtimestamp(start).isoformat(),
+            "horas": hours,
+            "entrega_s": delivery_s,
+            "leads": len(headers),
+            "leads_lidos": len(leads),
+            "regras": stats,
+            "envios": total,
+            "vencidos_no_inicio": overdue,
+            "envios_por_hora": dict(sorted(per_hour.items())),
+            "pico_por_hora": max(per_hour.values(), default=0),
+            "fases_s": {phase: round(elapsed, 4) for phase, elapsed in phases.items()}
+        }
+    
+    def get_automation_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas das automações (contadores mantidos a cada envio)"""
+        # Importar aqui para evitar dependência circular
+        from analytics_engine import analytics_engine
+        return analytics_engine.get_automation_stats()
     
     def manual_follow_up(self, phone: str, message: str) -> bool:
-        """Envia follow-up manual"""
+        """Enfileira follow-up manual (vai para o histórico quando for entregue)"""
         try:
-            # Registrar a mensagem
-            lead_manager.add_interaction(
-                phone=phone,
-                direction="Saída",
-                message=message,
-                message_type="manual"
-            )
-            
-            # Tentar enviar via Twilio
-            self._try_send_via_twilio(phone, message)
-            
-            log.info(f"Follow-up manual enviado para {phone}")
+            message_outbox.enqueue(phone, message, direcao="Saída", tipo_mensagem="manual")
+            log.info(f"Follow-up manual enfileirado para {phone}")
             return True
             
         except Exception as e:
             log.error(f"Erro ao enviar follow-up manual: {e}")
             return False
 
+def run_benchmark(total_leads: int = 10_000, hours: float = 24, repeat: int = 3):
+    """Simulação das regras padrão sobre uma base sintética, com o tempo de cada fase"""
+    import shutil
+    import tempfile
+    from bench_data import generate_leads
+    from lead_manager import LeadManager
+    
+    base = tempfile.mkdtemp(prefix="bench-automacao-")
+    try:
+        leads_dir = os.path.join(base, "leads")
+        # Início fixo: todas as repetições simulam a mesma janela
+        now = datetime.now().replace(microsecond=0)
+        generate_leads(leads_dir, total_leads, now=now)
+        engine = AutomationEngine(LeadManager(leads_dir, store_mode="arquivos"))
+        
+        started = time.perf_counter()
+        engine.lead_manager.snapshot.refresh()
+        print(f"Construção inicial dos cabeçalhos: {time.perf_counter() - started:.3f}s")
+        
+        results = [engine.simulate(hours, now.timestamp(), DEFAULT_RULES) for _ in range(repeat)]
+        result = results[-1]
+        best = {phase: min(r["fases_s"][phase] for r in results) for phase in result["fases_s"]}
+        print(f"{result['leads']} leads, {hours:g}h simuladas (melhor de {repeat}):")
+        for phase, elapsed in best.items():
+            print(f"  {phase:14s} {elapsed:.3f}s")
+        for name, rule in result["regras"].items():
+            print(f"  {name:26s} candidatos {rule['candidatos']:7d}  prazos {rule['prazos']:7d}  envios {rule['envios']:7d}")
+        print(f"Envios projetados: {result['envios']} ({result['vencidos_no_inicio']} prazos já vencidos no início, "
+              f"pico de {result['pico_por_hora']}/hora, {result['leads_lidos']} leads lidos) | repetível: "
+              f"{len({json.dumps(r['regras'], sort_keys=True) for r in results}) == 1}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
 # Instância global
 automation_engine = AutomationEngine()
 
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Motor de automação: simulação sem envios e benchmark")
+    parser.add_argument("command", choices=["simular", "bench"])
+    parser.add_argument("--horas", type=float, default=24, help="janela simulada")
+    parser.add_argument("--inicio", default="", help="simular: data/hora ISO de início (padrão: agora)")
+    parser.add_argument("--regras", default="", help="simular: arquivo de regras a testar (padrão: as em uso)")
+    parser.add_argument("--entrega", type=float, default=0, help="simular: segundos entre enfileirar e entregar")
+    parser.add_argument("--leads", type=int, default=10_000, help="bench: tamanho da base sintética")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    
+    if args.command == "bench":
+        run_benchmark(args.leads, args.horas, args.repeat)
+    else:
+        start = datetime.fromisoformat(args.inicio).timestamp() if args.inicio else None
+        rules = load_rules(args.regras) if args.regras else None
+        result = automation_engine.simulate(args.horas, start, rules, args.entrega)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
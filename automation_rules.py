@@ -0,0 +1,289 @@
+# automation_rules.py
+import os
+import sys
+import json
+import argparse
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Any, Tuple
+
+from lead_snapshot import LeadHeader
+
+try:
+    import yaml
+except ImportError:  # regras em YAML são opcionais; JSON sempre disponível
+    yaml = None
+
+# Condições avaliadas sobre o cabeçalho; as demais precisam do lead completo
+HEADER_CONDITIONS = ("status", "status_not_in", "score_min", "inactive_hours", "max_follow_ups")
+# Condições que o LeadIndex já garante para os candidatos que devolve
+INDEXED_CONDITIONS = ("status", "status_not_in", "score_min")
+# Condições que só AutomationEngine._next_due avalia, com o lead completo
+LEAD_CONDITIONS = ("hours_before_appointment", "no_recent_qualification")
+# Tipo esperado do valor de cada condição
+CONDITION_TYPES = {
+    "status": str, "status_not_in": list, "score_min": (int, float), "inactive_hours": (int, float),
+    "max_follow_ups": int, "hours_before_appointment": (int, float), "no_recent_qualification": bool
+}
+RULES_FILE = "automacao_regras.json"
+
+# Regras usadas enquanto não houver arquivo de regras em DATA_DIR
+DEFAULT_RULES = [
+    {
+        "name": "follow_up_inativo_5h",
+        "description": "Follow-up para leads inativos há 5 horas",
+        "condition": {
+            "inactive_hours": 5,
+            "status_not_in": ["Vendido", "Perdido"],
+            "max_follow_ups": 3
+        },
+        "action": {
+            "type": "send_message",
+            "templates": [
+                "Oi! Só passando para saber se você teve a chance de ver as informações que te enviei. Alguma dúvida que posso esclarecer?",
+                "Olá! Notei que conversamos mais cedo sobre os carros. Tem alguma pergunta que posso ajudar a responder?",
+                "Oi! Queria saber se você gostaria de mais detalhes sobre algum modelo específico que conversamos.",
+                "Olá! Caso tenha ficado alguma dúvida sobre nossas ofertas, estou aqui para ajudar!"
+            ]
+        }
+    },
+    {
+        "name": "lembrete_test_drive",
+        "description": "Lembrete 24h antes do test drive",
+        "condition": {
+            "status": "Agendado",
+            "hours_before_appointment": 24
+        },
+        "action": {
+            "type": "send_message",
+            "templates": [
+                "Oi! Só para confirmar seu test drive amanhã. Nosso endereço é Av. Osvaldo Reis, 1515 - Itajaí. Estamos te esperando!",
+                "Olá! Lembrete do seu test drive marcado para amanhã. Qualquer imprevisto, é só me avisar!",
+                "Oi! Confirmando seu test drive de amanhã. Vai ser ótimo te conhecer pessoalmente!"
+            ]
+        }
+    },
+    {
+        "name": "reativacao_lead_frio",
+        "description": "Reativação de leads frios (7 dias sem interação)",
+        "condition": {
+            "inactive_hours": 168,  # 7 dias
+            "status_not_in": ["Vendido", "Perdido"],
+            "score_min": 10
+        },
+        "action": {
+            "type": "send_message",
+            "templates": [
+                "Oi! Faz um tempo que não conversamos. Temos algumas ofertas especiais novas que podem te interessar. Quer dar uma olhada?",
+                "Olá! Apareceram algumas condições especiais de financiamento que talvez sejam interessantes para você. Posso te contar?",
+                "Oi! Chegaram alguns carros novos na loja que podem ser do seu perfil. Quer que eu te mande as informações?"
+            ]
+        }
+    },
+    {
+        "name": "qualificacao_lead_quente",
+        "description": "Qualificação de leads com alto score",
+        "condition": {
+            "score_min": 50,
+            "status": "Novo",
+            "no_recent_qualification": True
+        },
+        "action": {
+            "type": "send_message",
+            "templates": [
+                "Oi! Vejo que você tem bastante interesse em nossos carros. Que tal agendarmos um test drive para você conhecer melhor?",
+                "Olá! Pelo seu interesse, acredito que temos o carro ideal para você. Podemos conversar sobre as condições?",
+                "Oi! Notei seu interesse em nossos veículos. Quer que eu prepare uma proposta personalizada para você?"
+            ]
+        }
+    }
+]
+
+
+def compile_condition(condition: Dict[str, Any]) -> Callable[[LeadHeader, float], bool]:
+    """Transforma a condição (dict) em um predicado (cabeçalho, agora) -> bool.
+    Os parâmetros são resolvidos uma vez e só as verificações presentes entram,
+    das mais baratas/seletivas (status) para as que dependem do relógio."""
+    unknown = set(condition) - set(HEADER_CONDITIONS) - set(LEAD_CONDITIONS)
+    if unknown:
+        raise ValueError(f"Condição desconhecida: {', '.join(sorted(unknown))}")
+
+    checks: List[Callable[[LeadHeader, float], bool]] = []
+    if "status" in condition:
+        status = condition["status"]
+        checks.append(lambda h, now: h.status == status)
+    if condition.get("status_not_in"):
+        excluded = frozenset(condition["status_not_in"])
+        checks.append(lambda h, now: h.status not in excluded)
+    if "score_min" in condition:
+        score_min = condition["score_min"]
+        checks.append(lambda h, now: h.score >= score_min)
+    if "max_follow_ups" in condition:
+        max_follow_ups = condition["max_follow_ups"]
+        checks.append(lambda h, now: h.follow_ups < max_follow_ups)
+    if "inactive_hours" in condition:
+        inactive_s = condition["inactive_hours"] * 3600
+        # ultima_interacao_ts < 0: data inválida; 0: nunca interagiu (conta como inativo)
+        checks.append(lambda h, now: h.ultima_interacao_ts == 0 or
+                      (h.ultima_interacao_ts > 0 and now - h.ultima_interacao_ts >= inactive_s))
+
+    if not checks:
+        return lambda h, now: True
+    if len(checks) == 1:
+        return checks[0]
+    if len(checks) == 2:
+        first, second = checks
+        return lambda h, now: first(h, now) and second(h, now)
+
+    def predicate(h: LeadHeader, now: float) -> bool:
+        for check in checks:
+            if not check(h, now):
+                return False
+        return True
+    return predicate
+
+
+class CompiledRule:
+    """Regra pronta para avaliar: predicado compilado e filtros usados na seleção de candidatos"""
+    __slots__ = ("name", "rule", "matches", "residual", "statuses", "excluded", "score_min")
+
+    def __init__(self, rule: Dict[str, Any]):
+        condition = rule["condition"]
+        self.name = rule["name"]
+        self.rule = rule
+        self.matches = compile_condition(condition)
+        # Para candidatos do índice basta conferir o que ele não cobre
+        self.residual = compile_condition({k: v for k, v in condition.items() if k not in INDEXED_CONDITIONS})
+        self.statuses = [condition["status"]] if "status" in condition else None
+        self.excluded = frozenset(condition.get("status_not_in", ()))
+        self.score_min = condition.get("score_min")
+
+
+def compile_rules(rules: Iterable[Dict[str, Any]]) -> List[CompiledRule]:
+    return [CompiledRule(rule) for rule in rules]
+
+
+def validate_rules(rules: Any) -> List[Dict[str, Any]]:
+    """Confere a estrutura das regras lidas do arquivo; ValueError aponta a regra com problema"""
+    if not isinstance(rules, list):
+        raise ValueError("O arquivo de regras deve conter uma lista de regras")
+    names = set()
+    for position, rule in enumerate(rules, 1):
+        where = f"Regra {position}"
+        if not isinstance(rule, dict):
+            raise ValueError(f"{where}: não é um objeto")
+        name = rule.get("name")
+        if not isinstance(name, str) or not name:
+            raise ValueError(f"{where}: 'name' ausente")
+        where = f"Regra '{name}'"
+        if name in names:
+            raise ValueError(f"{where}: nome repetido")
+        names.add(name)
+
+        condition = rule.get("condition")
+        if not isinstance(condition, dict):
+            raise ValueError(f"{where}: 'condition' deve ser um objeto")
+        for key, value in condition.items():
+            expected = CONDITION_TYPES.get(key)
+            # bool é subclasse de int: True não vale como número
+            if expected is not None and (not isinstance(value, expected) or
+                                         (isinstance(value, bool) and expected is not bool)):
+                raise ValueError(f"{where}: valor inválido para '{key}': {value!r}")
+        try:
+            compile_condition(condition)
+        except ValueError as e:
+            raise ValueError(f"{where}: {e}")
+
+        action = rule.get("action")
+        if not isinstance(action, dict) or action.get("type") != "send_message":
+            raise ValueError(f"{where}: 'action.type' deve ser 'send_message'")
+        templates = action.get("templates")
+        if not templates or not isinstance(templates, list) or not all(isinstance(t, str) and t for t in templates):
+            raise ValueError(f"{where}: 'action.templates' deve ser uma lista de textos")
+    return rules
+
+
+def rules_path() -> str:
+    return os.getenv("AUTOMATION_RULES_FILE", os.path.join(os.getenv("DATA_DIR", "data"), RULES_FILE))
+
+
+def rules_stamp(path: str) -> Optional[Tuple[int, int]]:
+    """(mtime_ns, tamanho) do arquivo de regras; None se não existe"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_rules(path: str) -> List[Dict[str, Any]]:
+    """Lê e valida o arquivo de regras (JSON, ou YAML se a extensão for .yaml/.yml)"""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("Regras em YAML requerem pyyaml instalado")
+            rules = yaml.safe_load(f)
+        else:
+            rules = json.load(f)
+    return validate_rules(rules)
+
+
+class LeadIndex:
+    """Índice dos cabeçalhos por status, cada lista em ordem decrescente de score"""
+
+    def __init__(self, headers: Iterable[LeadHeader]):
+        by_status: Dict[str, List[LeadHeader]] = defaultdict(list)
+        for header in headers:
+            by_status[header.status].append(header)
+        self.by_status = {}
+        self._scores = {}
+        for status, group in by_status.items():
+            group.sort(key=lambda h: -h.score)
+            self.by_status[status] = group
+            self._scores[status] = [-h.score for h in group]   # crescente, para bisect
+
+    def candidates(self, rule: CompiledRule) -> Iterator[LeadHeader]:
+        """Só os cabeçalhos que passam nos filtros de status e score da regra"""
+        statuses = rule.statuses if rule.statuses is not None else self.by_status.keys()
+        for status in statuses:
+            if status in rule.excluded or status not in self.by_status:
+                continue
+            group = self.by_status[status]
+            if rule.score_min is None:
+                yield from group
+            else:
+                # Prefixo com score >= score_min
+                yield from group[:bisect_right(self._scores[status], -rule.score_min)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arquivo de regras da automação (DATA_DIR/automacao_regras.json)")
+    parser.add_argument("command", choices=["validar", "exportar"])
+    parser.add_argument("--arquivo", default=None, help="padrão: AUTOMATION_RULES_FILE ou DATA_DIR/automacao_regras.json")
+    parser.add_argument("--forcar", action="store_true", help="exportar: sobrescreve o arquivo existente")
+    args = parser.parse_args(argv)
+    path = args.arquivo or rules_path()
+
+    if args.command == "exportar":
+        if os.path.exists(path) and not args.forcar:
+            print(f"{path} já existe (use --forcar para sobrescrever)", file=sys.stderr)
+            return 1
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(DEFAULT_RULES, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        print(f"{len(DEFAULT_RULES)} regras padrão gravadas em {path}")
+        return 0
+
+    try:
+        rules = load_rules(path)
+    except (OSError, ValueError) as e:
+        print(f"{path}: {e}", file=sys.stderr)
+        return 2
+    print(f"{path}: {len(rules)} regras válidas ({', '.join(rule['name'] for rule in rules)})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# bench_data.py
+import os
+import json
+import random
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Base sintética para os benchmarks (analytics, automação): mensagens com
+# menções de veículos/intenções e datas espalhadas pelos últimos dias
+MESSAGES = [
+    "Qual o preço do Pulse?",
+    "Quero comprar a Toro, tem financiamento?",
+    "Tem financiamento pro Argo? Qual a entrada?",
+    "Posso fazer um test drive hoje?",
+    "Quanto custa o Mobi?",
+    "Obrigado, vou pensar",
+    "Quero trocar meu usado por uma Strada",
+    "Valor da Strada e preço à vista",
+    "Gostaria de conhecer o Fastback",
+    "Urgente: preciso de um carro agora",
+    "Boa tarde!"
+]
+REPLIES = [
+    "Olá! Posso te ajudar com isso.",
+    "Claro! Vou te passar as condições.",
+    "Oi! Só passando para saber se você teve a chance de ver as informações."
+]
+STATUSES = ["Novo", "Em Atendimento", "Proposta Enviada", "Agendado", "Vendido", "Perdido"]
+RULES = ["follow_up_inativo_5h", "reativacao_lead_frio", "qualificacao_lead_quente"]
+
+
+def generate_leads(leads_dir: str, count: int, seed: int = 42, days: int = 60,
+                   max_interactions: int = 12, now: Optional[datetime] = None) -> int:
+    """Grava `count` leads sintéticos (um JSON por telefone) em `leads_dir`"""
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    os.makedirs(leads_dir, exist_ok=True)
+
+    for i in range(count):
+        created = now - timedelta(minutes=rng.randint(0, 60 * 24 * days))
+        historico = []
+        moment = created
+        for _ in range(rng.randint(0, max_interactions)):
+            moment += timedelta(minutes=rng.randint(1, 600))
+            if moment > now:
+                break
+            inbound = rng.random() < 0.55
+            automated = not inbound and rng.random() < 0.3
+            historico.append({
+                "direcao": "Entrada" if inbound else "Saída",
+                "mensagem": rng.choice(MESSAGES if inbound else REPLIES),
+                "tipo_mensagem": "automacao" if automated else "texto",
+                "timestamp": moment.isoformat(),
+                "ts": int(moment.timestamp())
+            })
+
+        last = moment if historico else created
+        phone = f"+55479{i:08d}"
+        lead = {
+            "telefone": phone,
+            "nome_cliente": f"Cliente {i}" if rng.random() < 0.7 else "",
+            "email": "",
+            "status": rng.choice(STATUSES),
+            "data_criacao": created.isoformat(),
+            "data_criacao_ts": int(created.timestamp()),
+            "ultima_interacao": last.isoformat(),
+            "ultima_interacao_ts": int(last.timestamp()),
+            "vendedor_responsavel": "Felipe Fortes",
+            "notas": [],
+            "historico": historico,
+            "agendamentos": [],
+            "score": rng.randint(0, 200),
+            "tags": []
+        }
+        if rng.random() < 0.2:
+            lead["automations"] = {rng.choice(RULES): (now - timedelta(hours=rng.randint(1, 200))).isoformat()}
+
+        with open(os.path.join(leads_dir, f"{phone[1:]}.json"), "w", encoding="utf-8") as f:
+            json.dump(lead, f, ensure_ascii=False, indent=2)
+
+    return count
@@ -0,0 +1,444 @@
+# event_store.py
+import os
+import sys
+import copy
+import json
+import time
+import zlib
+import fcntl
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+from lead_snapshot import count_interaction, lead_counters, to_epoch
+
+log = logging.getLogger("fiat-whatsapp")
+
+EVENTS_FILE = "events.log"
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".jsonl"
+# Prefixo fixo de cada linha do log/snapshot: permite extrair o telefone sem
+# decodificar o JSON inteiro (usado para particionar o rebuild paralelo)
+_PHONE_PREFIX = b'{"phone": "'
+
+
+def apply_event(leads: Dict[str, Dict[str, Any]], event: Dict[str, Any]) -> None:
+    """Aplica um evento sobre a visão materializada (dict telefone -> lead)"""
+    phone = event["phone"]
+    event_type = event["type"]
+    data = event["data"]
+
+    if event_type == "lead_created":
+        leads[phone] = copy.deepcopy(data)
+        leads[phone]["revisao"] = 1
+        leads[phone]["modificado_ts"] = to_epoch(event["ts"])
+        return
+
+    lead = leads.get(phone)
+    if lead is None:
+        log.warning(f"Evento '{event_type}' para lead inexistente: {phone}")
+        return
+    lead["revisao"] = lead.get("revisao", 0) + 1
+    lead["modificado_ts"] = to_epoch(event["ts"])
+
+    if event_type == "lead_updated":
+        lead.update(data)
+    elif event_type == "interaction":
+        interaction = data["interacao"]
+        lead["contadores"] = lead_counters(lead)  # recalcula em leads anteriores aos contadores
+        count_interaction(lead["contadores"], interaction)
+        lead.setdefault("historico", []).append(dict(interaction))
+        lead["ultima_interacao"] = interaction["timestamp"]
+        if "ts" in interaction:
+            lead["ultima_interacao_ts"] = interaction["ts"]
+        lead["score"] = data["score"]
+    elif event_type == "note":
+        lead.setdefault("notas", []).append(dict(data))
+    elif event_type == "status":
+        lead["status"] = data["para"]
+        lead["ultima_interacao"] = data["timestamp"]
+        if "ts" in data:
+            lead["ultima_interacao_ts"] = data["ts"]
+            if data["para"] != data.get("de"):
+                lead["status_desde_ts"] = data["ts"]
+    elif event_type == "automation":
+        lead.setdefault("automations", {})[data["regra"]] = data["timestamp"]
+    else:
+        log.warning(f"Tipo de evento desconhecido: {event_type}")
+
+
+def _phone_from_line(line: bytes) -> Optional[str]:
+    """Extrai o telefone de uma linha do log sem decodificar o JSON"""
+    if not line.startswith(_PHONE_PREFIX):
+        return None
+    end = line.find(b'"', len(_PHONE_PREFIX))
+    if end < 0:
+        return None
+    return line[len(_PHONE_PREFIX):end].decode("utf-8")
+
+
+def _shard_of(phone: str, shards: int) -> int:
+    """Partição estável entre processos (hash() do Python é aleatório por processo)"""
+    return zlib.crc32(phone.encode("utf-8")) % shards
+
+
+class LeadEventStore:
+    """Log de eventos append-only com snapshots periódicos dos leads"""
+
+    def __init__(self, base_dir: str, snapshot_every: int = 10000):
+        self.base_dir = base_dir
+        self.log_path = os.path.join(base_dir, EVENTS_FILE)
+        self.snapshot_every = snapshot_every
+        self._leads: Dict[str, Dict[str, Any]] = {}
+        self._offset = 0
+        self._loaded = False
+        self._since_snapshot = 0
+        self._lock = threading.RLock()
+        os.makedirs(base_dir, exist_ok=True)
+
+    # ------------------------------------------------------------------
+    # Escrita
+    # ------------------------------------------------------------------
+    def append(self, phone: str, event_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Anexa um evento ao log e o aplica na visão materializada"""
+        event = {
+            "phone": phone,
+            "type": event_type,
+            "ts": datetime.now().isoformat(),
+            "data": data
+        }
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+        with self._lock:
+            self._ensure_loaded()
+            with open(self.log_path, "ab") as f:
+                # flock serializa escritores de processos diferentes (workers do gunicorn)
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self._catch_up()
+                    f.write(line)
+                    f.flush()
+                    self._offset = f.tell()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+            apply_event(self._leads, event)
+            self._since_snapshot += 1
+            if self.snapshot_every and self._since_snapshot >= self.snapshot_every:
+                self.write_snapshot()
+
+        return event
+
+    def append_many(self, events: List[Tuple[str, str, Dict[str, Any]]]) -> int:
+        """Anexa um lote de eventos (telefone, tipo, dados) com uma única escrita"""
+        now = datetime.now().isoformat()
+        batch = [{"phone": phone, "type": event_type, "ts": now, "data": data}
+                 for phone, event_type, data in events]
+        payload = b"".join((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8") for event in batch)
+
+        with self._lock:
+            with open(self.log_path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if self._loaded:
+                        self._catch_up()
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    if self._loaded:
+                        self._offset = f.tell()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+            # Sem visão carregada (ex.: migração em massa) não há o que aplicar:
+            # o próximo carregamento lê o log desde o início
+            if self._loaded:
+                for event in batch:
+                    apply_event(self._leads, event)
+
+        return len(batch)
+
+    # ------------------------------------------------------------------
+    # Leitura
+    # ------------------------------------------------------------------
+    def get_lead(self, phone: str) -> Optional[Dict[str, Any]]:
+        """Retorna uma cópia do lead materializado"""
+        with self._lock:
+            self._ensure_loaded()
+            self._catch_up()
+            lead = self._leads.get(phone)
+            return copy.deepcopy(lead) if lead is not None else None
+
+    def get_all_leads(self) -> List[Dict[str, Any]]:
+        """Retorna cópias de todos os leads materializados"""
+        with self._lock:
+            self._ensure_loaded()
+            self._catch_up()
+            return copy.deepcopy(list(self._leads.values()))
+
+    def phones(self) -> List[str]:
+        """Telefones (chaves) presentes na visão materializada"""
+        with self._lock:
+            self._ensure_loaded()
+            self._catch_up()
+            return list(self._leads)
+
+    def changes_since(self, offset: Optional[int]) -> Tuple[List[Dict[str, Any]], int]:
+        """Cópias dos leads com eventos no log a partir de `offset` (todos, se None) e o
+        offset até onde a visão está aplicada, lidos juntos sob o lock"""
+        with self._lock:
+            self._ensure_loaded()
+            self._catch_up()
+            if offset is None:
+                return copy.deepcopy(list(self._leads.values())), self._offset
+            phones = set()
+            if offset < self._offset:
+                with open(self.log_path, "rb") as f:
+                    f.seek(offset)
+                    for line in f.read(self._offset - offset).splitlines():
+                        phone = _phone_from_line(line)
+                        if phone is not None:
+                            phones.add(phone)
+            changed = [self._leads[phone] for phone in phones if phone in self._leads]
+            return copy.deepcopy(changed), self._offset
+
+    def iter_events(self, phone: Optional[str] = None):
+        """Percorre o log completo (auditoria), opcionalmente filtrando por telefone"""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if phone is not None and _phone_from_line(line) != phone:
+                    continue
+                yield json.loads(line)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._leads, self._offset = self._load_latest_snapshot()
+            self._loaded = True
+            self._catch_up()
+
+    def _catch_up(self):
+        """Aplica eventos anexados por outros processos desde o último offset"""
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return
+        if size <= self._offset:
+            return
+
+        with open(self.log_path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                # Linha incompleta: escritor ainda não terminou
+                if not line.endswith(b"\n"):
+                    break
+                self._offset += len(line)
+                try:
+                    apply_event(self._leads, json.loads(line))
+                except Exception as e:
+                    log.error(f"Evento inválido no offset {self._offset}: {e}")
+
+    # ------------------------------------------------------------------
+    # Snapshots
+    # ------------------------------------------------------------------
+    def _snapshot_files(self) -> List[Tuple[int, str]]:
+        snapshots = []
+        for filename in os.listdir(self.base_dir):
+            if filename.startswith(SNAPSHOT_PREFIX) and filename.endswith(SNAPSHOT_SUFFIX):
+                try:
+                    offset = int(filename[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)])
+                except ValueError:
+                    continue
+                snapshots.append((offset, os.path.join(self.base_dir, filename)))
+        return sorted(snapshots)
+
+    def latest_snapshot(self) -> Tuple[int, Optional[str]]:
+        """Retorna (offset, caminho) do snapshot mais recente"""
+        snapshots = self._snapshot_files()
+        return snapshots[-1] if snapshots else (0, None)
+
+    def _load_latest_snapshot(self) -> Tuple[Dict[str, Dict[str, Any]], int]:
+        offset, path = self.latest_snapshot()
+        if not path:
+            return {}, 0
+
+        leads = {}
+        with open(path, "rb") as f:
+            f.readline()  # cabeçalho
+            for line in f:
+                record = json.loads(line)
+                leads[record["phone"]] = record["lead"]
+        return leads, offset
+
+    def write_snapshot(self, keep: int = 2) -> str:
+        """Grava o estado materializado atual e remove snapshots antigos"""
+        with self._lock:
+            self._ensure_loaded()
+            self._catch_up()
+            path = os.path.join(self.base_dir, f"{SNAPSHOT_PREFIX}{self._offset:015d}{SNAPSHOT_SUFFIX}")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                header = {"offset": self._offset, "leads": len(self._leads), "created": datetime.now().isoformat()}
+                f.write(json.dumps(header) + "\n")
+                for phone, lead in self._leads.items():
+                    f.write(json.dumps({"phone": phone, "lead": lead}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, path)
+            self._since_snapshot = 0
+
+        for _, old_path in self._snapshot_files()[:-keep]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+        log.info(f"Snapshot de leads gravado: {path}")
+        return path
+
+    # ------------------------------------------------------------------
+    # Rebuild
+    # ------------------------------------------------------------------
+    def rebuild(self, leads_dir: str, workers: int = 4) -> int:
+        """Reconstrói os arquivos JSON dos leads (snapshot + cauda do log) em paralelo"""
+        offset, snapshot_path = self.latest_snapshot()
+        workers = max(1, workers)
+        jobs = [(self.log_path, snapshot_path, offset, leads_dir, shard, workers) for shard in range(workers)]
+
+        if workers == 1:
+            return _rebuild_shard(jobs[0])
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(_rebuild_shard, jobs))
+
+
+def _rebuild_shard(job: Tuple[str, Optional[str], int, str, int, int]) -> int:
+    """Materializa os leads de uma partição e grava os arquivos JSON"""
+    log_path, snapshot_path, offset, leads_dir, shard, shards = job
+    leads: Dict[str, Dict[str, Any]] = {}
+
+    if snapshot_path:
+        with open(snapshot_path, "rb") as f:
+            f.readline()
+            for line in f:
+                phone = _phone_from_line(line)
+                if phone is not None and _shard_of(phone, shards) == shard:
+                    leads[phone] = json.loads(line)["lead"]
+
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                phone = _phone_from_line(line)
+                if phone is not None and _shard_of(phone, shards) == shard:
+                    apply_event(leads, json.loads(line))
+
+    os.makedirs(leads_dir, exist_ok=True)
+    for phone, lead in leads.items():
+        path = os.path.join(leads_dir, f"{phone}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(lead, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    return len(leads)
+
+
+# ----------------------------------------------------------------------
+# Benchmark
+# ----------------------------------------------------------------------
+def _write_synthetic_log(store: LeadEventStore, total_events: int, total_leads: int):
+    """Gera um log sintético direto em disco (sem passar pelo append com flock)"""
+    now = datetime.now().isoformat()
+    messages = ["Qual o preço do Pulse?", "Quero agendar um test drive", "Tem financiamento?", "Obrigado!"]
+    with open(store.log_path, "w", encoding="utf-8") as f:
+        for i in range(total_events):
+            phone = f"55479{i % total_leads:08d}"
+            if i < total_leads:
+                event_type = "lead_created"
+                data = {"telefone": "+" + phone, "nome_cliente": "", "email": "", "status": "Novo",
+                        "data_criacao": now, "ultima_interacao": now, "vendedor_responsavel": "Felipe Fortes",
+                        "notas": [], "historico": [], "agendamentos": [], "score": 0, "tags": []}
+            elif i % 10 == 0:
+                event_type = "status"
+                data = {"de": "Novo", "para": "Em Atendimento", "timestamp": now}
+            else:
+                event_type = "interaction"
+                data = {"interacao": {"direcao": "Entrada", "mensagem": messages[i % len(messages)],
+                                      "tipo_mensagem": "texto", "timestamp": now}, "score": i % 200}
+            f.write(json.dumps({"phone": phone, "type": event_type, "ts": now, "data": data}, ensure_ascii=False) + "\n")
+
+
+def run_benchmark(total_events: int = 1_000_000, total_leads: int = 20_000, workers: int = 4):
+    """Mede o tempo de reconstrução a partir do log (serial x paralelo)"""
+    import tempfile
+    import shutil
+
+    base = tempfile.mkdtemp(prefix="bench-eventos-")
+    try:
+        store = LeadEventStore(os.path.join(base, "_eventos"), snapshot_every=0)
+        started = time.perf_counter()
+        _write_synthetic_log(store, total_events, total_leads)
+        print(f"Log sintético: {total_events} eventos / {total_leads} leads em {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        store._ensure_loaded()
+        print(f"Carga em memória (1 processo): {time.perf_counter() - started:.2f}s")
+
+        for n in sorted({1, workers}):
+            out_dir = os.path.join(base, f"leads-{n}")
+            started = time.perf_counter()
+            count = store.rebuild(out_dir, workers=n)
+            print(f"Rebuild em disco com {n} worker(s): {count} leads em {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        store.write_snapshot()
+        print(f"Snapshot: {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        LeadEventStore(store.base_dir)._ensure_loaded()
+        print(f"Carga a partir do snapshot: {time.perf_counter() - started:.2f}s")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Log de eventos dos leads")
+    parser.add_argument("--leads-dir", default="leads")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = sub.add_parser("rebuild", help="Reconstrói os arquivos JSON a partir do snapshot + log")
+    rebuild.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    sub.add_parser("snapshot", help="Grava um snapshot do estado atual")
+
+    bench = sub.add_parser("bench", help="Benchmark de reconstrução")
+    bench.add_argument("--events", type=int, default=1_000_000)
+    bench.add_argument("--leads", type=int, default=20_000)
+    bench.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    if args.command == "bench":
+        run_benchmark(args.events, args.leads, args.workers)
+        return 0
+
+    store = LeadEventStore(os.path.join(args.leads_dir, "_eventos"))
+    if args.command == "rebuild":
+        started = time.perf_counter()
+        count = store.rebuild(args.leads_dir, workers=args.workers)
+        print(f"{count} leads reconstruídos em {time.perf_counter() - started:.2f}s")
+    elif args.command == "snapshot":
+        print(store.write_snapshot())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,410 @@
+# lead_columns.py
+import os
+import sys
+import time
+import heapq
+import random
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy é opcional: sem ele as mesmas métricas saem de laços em Python
+    np = None
+
+from lead_snapshot import LeadHeader, LeadSnapshotReader, pack_header, write_records
+from lead_signals import INTENT_BITS, HIGH_INTENT_MASK, SIGNAL_BUY, SIGNAL_TEST_DRIVE
+
+log = logging.getLogger("fiat-whatsapp")
+
+COLUMNS = ("telefone", "status", "score", "data_criacao_ts", "ultima_interacao_ts",
+           "total_interacoes", "mencoes_preco", "intencoes", "sinais")
+CLOSED = ("Vendido", "Perdido")
+SCORE_RANGES = ("0-20", "21-50", "51-100", "100+")
+
+if np is not None:
+    # Mesmo layout de lead_snapshot.RECORD: o arquivo mapeado vira colunas sem parse
+    RECORD_DTYPE = np.dtype([
+        ("telefone", "S24"), ("status", "S24"), ("score", "<i4"),
+        ("data_criacao_ts", "<i8"), ("ultima_interacao_ts", "<i8"),
+        ("total_interacoes", "<u4"), ("entradas", "<u4"), ("saidas", "<u4"),
+        ("notas", "<u4"), ("follow_ups", "<u4"), ("mencoes_preco", "<u4"),
+        ("intencoes", "u1"), ("sinais", "u1"), ("agendado_ts", "<i8"), ("vendido_ts", "<i8"),
+        ("modificado_ts", "<i8"), ("mtime_ns", "<i8")
+    ])
+    SCORE_BINS = (-np.inf, 20.5, 50.5, 100.5, np.inf)
+
+
+class LeadColumns:
+    """Cabeçalhos dos leads em colunas: arrays NumPy ou, sem NumPy, listas"""
+
+    def __init__(self, columns: Dict[str, Any], vectorized: bool):
+        self.vectorized = vectorized
+        self.telefone = columns["telefone"]
+        self.score = columns["score"]
+        self.data_criacao_ts = columns["data_criacao_ts"]
+        self.ultima_interacao_ts = columns["ultima_interacao_ts"]
+        self.total_interacoes = columns["total_interacoes"]
+        self.mencoes_preco = columns["mencoes_preco"]
+        self.intencoes = columns["intencoes"]
+        self.sinais = columns["sinais"]
+
+        if vectorized:
+            # Status como códigos inteiros (índices em status_names) para bincount/máscaras
+            names, self.status = np.unique(columns["status"], return_inverse=True)
+            self.status_names = [name.decode("utf-8") for name in names]
+        else:
+            self.status = columns["status"]
+            self.status_names = sorted(set(self.status))
+
+    @classmethod
+    def from_reader(cls, reader: LeadSnapshotReader, vectorized: Optional[bool] = None) -> "LeadColumns":
+        """Colunas a partir do snapshot mapeado em memória"""
+        vectorized = np is not None if vectorized is None else vectorized
+        if not vectorized:
+            return cls.from_headers(list(reader), vectorized=False)
+
+        records = np.frombuffer(reader.buffer(), dtype=RECORD_DTYPE, count=len(reader))
+        try:
+            columns = {name: records[name].copy() for name in COLUMNS}
+        finally:
+            del records  # solta o buffer do mmap antes de o leitor ser fechado
+        return cls(columns, True)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, refresh: bool = True, vectorized: Optional[bool] = None) -> "LeadColumns":
+        """Colunas do snapshot de cabeçalhos de um LeadManager (atualizado antes, por padrão)"""
+        with snapshot.open(refresh) as reader:
+            return cls.from_reader(reader, vectorized)
+
+    @classmethod
+    def from_headers(cls, headers: List[LeadHeader], vectorized: Optional[bool] = None) -> "LeadColumns":
+        """Colunas a partir de cabeçalhos já carregados"""
+        vectorized = np is not None if vectorized is None else vectorized
+        columns = {name: [getattr(header, name) for header in headers] for name in COLUMNS}
+        if vectorized:
+            for name in ("telefone", "status"):
+                columns[name] = [value.encode("utf-8") for value in columns[name]]
+            columns = {name: np.array(values, dtype=RECORD_DTYPE[name]) for name, values in columns.items()}
+        return cls(columns, vectorized)
+
+    def __len__(self) -> int:
+        return len(self.score)
+
+    def phone(self, index: int) -> str:
+        phone = self.telefone[index]
+        return phone.decode("utf-8") if isinstance(phone, bytes) else phone
+
+    def _status_code(self, status: str) -> int:
+        return self.status_names.index(status) if status in self.status_names else -1
+
+    # ------------------------------------------------------------------
+    # Métricas
+    # ------------------------------------------------------------------
+    def metrics(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """Contagens do relatório que dependem só dos cabeçalhos"""
+        now = time.time() if now is None else now
+        start_of_today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        if self.vectorized:
+            return self._metrics_numpy(now, start_of_today)
+        return self._metrics_python(now, start_of_today)
+
+    def _metrics_numpy(self, now: float, start_of_today: float) -> Dict[str, Any]:
+        score = self.score
+        interactions = self.total_interacoes
+        created = self.data_criacao_ts
+        last = self.ultima_interacao_ts
+
+        status_counts = np.bincount(self.status, minlength=len(self.status_names))
+        score_ranges = np.histogram(score, bins=SCORE_BINS)[0]
+
+        high = (score >= 50) | (interactions >= 5)
+        medium = ~high & ((score >= 20) | (interactions >= 2))
+
+        valid = created > 0
+        days_ago = np.floor_divide(now - created, 86400)
+        recent = valid & (days_ago <= 7)
+        previous = valid & (days_ago >= 8) & (days_ago <= 14)
+        sold = self.status == self._status_code("Vendido")
+
+        return {
+            "total": len(score),
+            "status_counts": {name: int(count) for name, count in zip(self.status_names, status_counts) if count},
+            "score_total": int(score.sum(dtype=np.int64)),
+            "hot_leads": int(np.count_nonzero(score >= 50)),
+            "score_ranges": dict(zip(SCORE_RANGES, score_ranges.tolist())),
+            "engagement_levels": {
+                "Alto": int(np.count_nonzero(high)),
+                "Médio": int(np.count_nonzero(medium)),
+                "Baixo": int(len(score) - np.count_nonzero(high) - np.count_nonzero(medium))
+            },
+            "interactions": int(interactions.sum(dtype=np.int64)),
+            "leads_with_interactions": int(np.count_nonzero(interactions)),
+            "active_leads": int(np.count_nonzero((last > 0) & (now - last < 86400))),
+            "leads_by_period": {
+                "today": int(np.count_nonzero(valid & (created >= start_of_today) & (created < start_of_today + 86400))),
+                "this_week": int(np.count_nonzero(recent)),
+                "this_month": int(np.count_nonzero(valid & (days_ago <= 30)))
+            },
+            "trend": [int(np.count_nonzero(recent & sold)), int(np.count_nonzero(recent)),
+                      int(np.count_nonzero(previous & sold)), int(np.count_nonzero(previous))],
+            "intent_counts": {intent: int(count) for intent, count in
+                              ((intent, np.count_nonzero(self.intencoes & bit)) for intent, bit in INTENT_BITS.items())
+                              if count}
+        }
+
+    def _metrics_python(self, now: float, start_of_today: float) -> Dict[str, Any]:
+        status_counts: Dict[str, int] = {}
+        score_ranges = dict.fromkeys(SCORE_RANGES, 0)
+        engagement = {"Alto": 0, "Médio": 0, "Baixo": 0}
+        periods = {"today": 0, "this_week": 0, "this_month": 0}
+        intent_counts = dict.fromkeys(INTENT_BITS, 0)
+        trend = [0, 0, 0, 0]
+        score_total = hot = interactions_total = with_interactions = active = 0
+
+        for status, score, created, last, interactions, intents in zip(
+                self.status, self.score, self.data_criacao_ts, self.ultima_interacao_ts,
+                self.total_interacoes, self.intencoes):
+            status_counts[status] = status_counts.get(status, 0) + 1
+            score_total += score
+            hot += score >= 50
+            if score <= 20:
+                score_ranges["0-20"] += 1
+            elif score <= 50:
+                score_ranges["21-50"] += 1
+            elif score <= 100:
+                score_ranges["51-100"] += 1
+            else:
+                score_ranges["100+"] += 1
+
+            if score >= 50 or interactions >= 5:
+                engagement["Alto"] += 1
+            elif score >= 20 or interactions >= 2:
+                engagement["Médio"] += 1
+            else:
+                engagement["Baixo"] += 1
+            interactions_total += interactions
+            with_interactions += interactions > 0
+
+            if last > 0 and now - last < 86400:
+                active += 1
+            if created > 0:
+                if start_of_today <= created < start_of_today + 86400:
+                    periods["today"] += 1
+                days_ago = (now - created) // 86400
+                if days_ago <= 7:
+                    periods["this_week"] += 1
+                    trend[1] += 1
+                    trend[0] += status == "Vendido"
+                elif 8 <= days_ago <= 14:
+                    trend[3] += 1
+                    trend[2] += status == "Vendido"
+                if days_ago <= 30:
+                    periods["this_month"] += 1
+
+            for intent, bit in INTENT_BITS.items():
+                if intents & bit:
+                    intent_counts[intent] += 1
+
+        return {
+            "total": len(self.score),
+            "status_counts": {name: status_counts[name] for name in self.status_names},
+            "score_total": score_total,
+            "hot_leads": hot,
+            "score_ranges": score_ranges,
+            "engagement_levels": engagement,
+            "interactions": interactions_total,
+            "leads_with_interactions": with_interactions,
+            "active_leads": active,
+            "leads_by_period": periods,
+            "trend": trend,
+            "intent_counts": {intent: count for intent, count in intent_counts.items() if count}
+        }
+
+    # ------------------------------------------------------------------
+    # Seleção dos top N (oportunidades e alta intenção)
+    # ------------------------------------------------------------------
+    def _top(self, mask, size: int) -> List[int]:
+        """Índices dos `size` maiores scores da máscara (empate: menor índice primeiro)"""
+        index = np.flatnonzero(mask)
+        scores = self.score[index]
+        if len(index) > size:
+            # Corte pelo size-ésimo maior score (O(n)); só os empatados no corte são ordenados
+            threshold = np.partition(scores, len(scores) - size)[len(scores) - size]
+            keep = scores >= threshold
+            index, scores = index[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")[:size]
+        return index[order].tolist()
+
+    def high_intent(self, size: int = 10) -> List[str]:
+        """Telefones dos leads de alta intenção (compra, urgência, financiamento) com maior score"""
+        if self.vectorized:
+            mask = ((self.intencoes & HIGH_INTENT_MASK) > 0) & (self.telefone != b"")
+            return [self.phone(i) for i in self._top(mask, size)]
+
+        candidates = (i for i in range(len(self)) if self.telefone[i] and self.intencoes[i] & HIGH_INTENT_MASK)
+        return [self.phone(i) for i in heapq.nlargest(size, candidates, key=self.score.__getitem__)]
+
+    def opportunities(self, now: Optional[float] = None, size: int = 10) -> Dict[str, List[Tuple[str, str]]]:
+        """(telefone, motivo) dos `size` maiores scores de cada categoria de oportunidade"""
+        now = time.time() if now is None else now
+        if self.vectorized:
+            selected = self._opportunities_numpy(now, size)
+        else:
+            selected = self._opportunities_python(now, size)
+
+        result = {}
+        for category, indexes in selected.items():
+            result[category] = [(self.phone(i), self._reason(category, i, now)) for i in indexes]
+        return result
+
+    def _opportunities_numpy(self, now: float, size: int) -> Dict[str, List[int]]:
+        score = self.score
+        status = self.status
+        last = self.ultima_interacao_ts
+        closed = np.isin(status, [self._status_code(name) for name in CLOSED])
+        not_scheduled = ~np.isin(status, [self._status_code(name) for name in ("Agendado",) + CLOSED])
+
+        masks = {
+            "ready_to_buy": (score >= 70) & ((self.sinais & SIGNAL_BUY) > 0) & ~closed,
+            "need_follow_up": (last > 0) & ((now - last) / 3600 > 48) & (score >= 30) & ~closed,
+            "price_sensitive": (self.mencoes_preco >= 2) & ~closed,
+            "test_drive_ready": ((self.sinais & SIGNAL_TEST_DRIVE) > 0) & not_scheduled,
+            "lost_opportunities": (status == self._status_code("Perdido")) & (score >= 50)
+        }
+        return {category: self._top(mask, size) for category, mask in masks.items()}
+
+    def _opportunities_python(self, now: float, size: int) -> Dict[str, List[int]]:
+        candidates = {category: [] for category in
+                      ("ready_to_buy", "need_follow_up", "price_sensitive", "test_drive_ready", "lost_opportunities")}
+        for i, (status, score, last, price_mentions, signals) in enumerate(zip(
+                self.status, self.score, self.ultima_interacao_ts, self.mencoes_preco, self.sinais)):
+            is_open = status not in CLOSED
+            if score >= 70 and signals & SIGNAL_BUY and is_open:
+                candidates["ready_to_buy"].append(i)
+            if last > 0 and (now - last) / 3600 > 48 and score >= 30 and is_open:
+                candidates["need_follow_up"].append(i)
+            if price_mentions >= 2 and is_open:
+                candidates["price_sensitive"].append(i)
+            if signals & SIGNAL_TEST_DRIVE and status not in ("Agendado",) + CLOSED:
+                candidates["test_drive_ready"].append(i)
+            if status == "Perdido" and score >= 50:
+                candidates["lost_opportunities"].append(i)
+
+        return {category: heapq.nlargest(size, indexes, key=self.score.__getitem__)
+                for category, indexes in candidates.items()}
+
+    def _reason(self, category: str, i: int, now: float) -> str:
+        if category == "ready_to_buy":
+            return "Alta intenção de compra"
+        if category == "need_follow_up":
+            return f"Inativo há {int((now - int(self.ultima_interacao_ts[i])) / 3600)}h"
+        if category == "price_sensitive":
+            return f"{int(self.mencoes_preco[i])} menções de preço"
+        if category == "test_drive_ready":
+            return "Interesse em test drive"
+        return f"Lead quente perdido (score: {int(self.score[i])})"
+
+
+def _synthetic_headers(count: int, seed: int = 42, days: int = 60) -> List[LeadHeader]:
+    """Cabeçalhos sintéticos (sem gerar os JSON), para medir só as métricas"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    statuses = ["Novo", "Em Atendimento", "Proposta Enviada", "Agendado", "Vendido", "Perdido"]
+    headers = []
+    for i in range(count):
+        created = now - rng.randint(0, 86400 * days)
+        interactions = rng.randint(0, 12)
+        headers.append(LeadHeader(
+            f"+55479{i:08d}", rng.choice(statuses), rng.randint(0, 200), created,
+            min(now, created + rng.randint(0, 86400 * 5)) if interactions else created,
+            interactions, interactions // 2, interactions - interactions // 2, 0, 0,
+            rng.choice((0, 0, 1, 2, 3)), rng.getrandbits(len(INTENT_BITS)), rng.getrandbits(2)
+        ))
+    return headers
+
+
+def run_benchmark(total_leads: int = 100_000, repeat: int = 3):
+    """Compara colunas NumPy e o fallback em Python sobre um snapshot sintético"""
+    import shutil
+    import tempfile
+
+    base = tempfile.mkdtemp(prefix="bench-columns-")
+    try:
+        path = os.path.join(base, "_headers.bin")
+        write_records(path, [pack_header(header) for header in _synthetic_headers(total_leads)])
+        now = time.time()
+
+        backends = [("python", False)] + ([("numpy", True)] if np is not None else [])
+        timings, results = {}, {}
+        for name, vectorized in backends:
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                with LeadSnapshotReader(path) as reader:
+                    columns = LeadColumns.from_reader(reader, vectorized)
+                results[name] = (columns.metrics(now), columns.opportunities(now), columns.high_intent())
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            print(f"{name}: {best * 1000:.1f}ms ({total_leads} leads, melhor de {repeat})")
+
+        if np is None:
+            print("NumPy não instalado: só o fallback em Python foi medido")
+        else:
+            same = results["python"] == results["numpy"]
+            print(f"Speedup: {timings['python'] / timings['numpy']:.1f}x | resultados idênticos: {same}")
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def check_aggregates() -> int:
+    """Confere os agregados do analytics contra as contagens recalculadas do snapshot"""
+    from lead_manager import lead_manager
+    from analytics_aggregates import AnalyticsAggregates
+
+    aggregates = AnalyticsAggregates(lead_manager.leads_dir).load()
+    if aggregates is None:
+        print("Agregados ainda não construídos")
+        return 1
+
+    metrics = LeadColumns.from_snapshot(lead_manager.snapshot).metrics()
+    pairs = {
+        "leads": (aggregates["leads"], metrics["total"]),
+        "status": (aggregates["status"], metrics["status_counts"]),
+        "score_total": (aggregates["score_total"], metrics["score_total"]),
+        "leads_quentes": (aggregates["leads_quentes"], metrics["hot_leads"]),
+        "faixas_score": (aggregates["faixas_score"], metrics["score_ranges"]),
+        "engajamento": (aggregates["engajamento"], metrics["engagement_levels"]),
+        "interacoes": (aggregates["interacoes"], metrics["interactions"]),
+        "leads_com_interacoes": (aggregates["leads_com_interacoes"], metrics["leads_with_interactions"]),
+        "intencoes": (aggregates["intencoes"], metrics["intent_counts"])
+    }
+    divergent = [name for name, (stored, computed) in pairs.items() if stored != computed]
+    for name in divergent:
+        print(f"{name}: agregados={pairs[name][0]} snapshot={pairs[name][1]}")
+    if divergent:
+        print("Divergência encontrada: rode python analytics_engine.py rebuild-aggregates")
+        return 1
+    print(f"Agregados conferem com o snapshot ({metrics['total']} leads)")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Métricas colunares dos cabeçalhos dos leads")
+    parser.add_argument("command", choices=["bench", "check"])
+    parser.add_argument("--leads", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    if args.command == "bench":
+        run_benchmark(args.leads, args.repeat)
+        return 0
+    return check_aggregates()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+# lead_export.py
+import io
+import os
+import sys
+import csv
+import time
+import zlib
+import argparse
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from lead_snapshot import record_epoch, to_epoch
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # formato colunar é opcional; CSV sempre disponível
+    pa = None
+    pq = None
+
+log = logging.getLogger("fiat-whatsapp")
+
+# Colunas de cada conjunto exportado
+DATASETS = {
+    "leads": ("telefone", "status", "score", "data_criacao_ts", "ultima_interacao_ts",
+              "total_interacoes", "entradas", "saidas", "notas", "follow_ups",
+              "agendado_ts", "vendido_ts", "modificado_ts"),
+    "interacoes": ("telefone", "ts", "timestamp", "direcao", "tipo_mensagem", "mensagem")
+}
+INT_COLUMNS = {"score", "data_criacao_ts", "ultima_interacao_ts", "total_interacoes", "entradas",
+               "saidas", "notas", "follow_ups", "agendado_ts", "vendido_ts", "modificado_ts", "ts"}
+ROWS_PER_CHUNK = 1000
+
+
+def parse_since(value: Optional[str]) -> int:
+    """Início da exportação incremental: epoch ou data/hora ISO (vazio = tudo)"""
+    if not value:
+        return 0
+    if value.isdigit():
+        return int(value)
+    ts = to_epoch(value)
+    if ts < 0:
+        raise ValueError(f"Data inválida: {value}")
+    return ts
+
+
+def iter_lead_rows(manager, since: int = 0) -> Iterator[Tuple]:
+    """Cabeçalhos dos leads alterados desde `since`, direto do snapshot (mmap). Vale a
+    última gravação do lead (modificado_ts): notas e cadastro também mudam as colunas"""
+    with manager.snapshot.open() as reader:
+        for header in reader:
+            if header.modificado_ts >= since:
+                yield tuple(getattr(header, column) for column in DATASETS["leads"])
+
+
+def iter_interaction_rows(manager, since: int = 0) -> Iterator[Tuple]:
+    """Interações desde `since`; só os leads com mensagem no período são lidos, um por vez.
+    Cada um é lido inteiro (histórico completo) para filtrar as mensagens novas: o custo
+    acompanha o tamanho das conversas ativas, não só o das mensagens exportadas"""
+    with manager.snapshot.open() as reader:
+        for header in reader:
+            if header.ultima_interacao_ts < since:
+                continue
+            lead = manager.get_lead(header.telefone)
+            if lead is None:
+                continue
+            for interaction in lead.get("historico", []):
+                ts = record_epoch(interaction, "timestamp", "ts")
+                if ts >= since:
+                    yield (header.telefone, ts, interaction.get("timestamp", ""), interaction.get("direcao", ""),
+                           interaction.get("tipo_mensagem", ""), interaction.get("mensagem", ""))
+
+
+def iter_rows(manager, dataset: str, since: int = 0) -> Iterator[Tuple]:
+    if dataset == "leads":
+        return iter_lead_rows(manager, since)
+    if dataset == "interacoes":
+        return iter_interaction_rows(manager, since)
+    raise ValueError(f"Conjunto desconhecido: {dataset}")
+
+
+def csv_gzip_chunks(columns: Iterable[str], rows: Iterable[Tuple], rows_per_chunk: int = ROWS_PER_CHUNK) -> Iterator[bytes]:
+    """CSV compactado em gzip, em blocos de `rows_per_chunk` linhas (memória constante)"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # cabeçalho gzip
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= rows_per_chunk:
+            chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+            if chunk:
+                yield chunk
+    yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+
+class _Drain:
+    """Destino de escrita que acumula bytes até serem retirados (streaming do Parquet)"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(columns: Iterable[str], rows: Iterable[Tuple], rows_per_chunk: int = ROWS_PER_CHUNK * 10) -> Iterator[bytes]:
+    """Parquet (compressão gzip) em row groups de `rows_per_chunk` linhas; requer pyarrow"""
+    if pa is None:
+        raise RuntimeError("Formato parquet requer pyarrow instalado")
+    columns = list(columns)
+    schema = pa.schema([(column, pa.int64() if column in INT_COLUMNS else pa.string()) for column in columns])
+    sink = _Drain()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="gzip")
+    try:
+        batch: List[Tuple] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= rows_per_chunk:
+                writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema))
+                batch = []
+                yield sink.take()
+        if batch:
+            writer.write_table(pa.Table.from_pylist([dict(zip(columns, r)) for r in batch], schema))
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def export_stream(manager, dataset: str, since: int = 0, fmt: str = "csv") -> Tuple[Iterator[bytes], Dict[str, Any]]:
+    """Gerador de bytes da exportação e metadados (nome do arquivo, cursor da próxima)"""
+    if dataset not in DATASETS:
+        raise ValueError(f"Conjunto desconhecido: {dataset}")
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"Formato inválido: {fmt}")
+    if fmt == "parquet" and pa is None:
+        raise ValueError("Formato parquet indisponível (pyarrow não instalado)")
+
+    # Cursor: quem exportar de novo a partir daqui recebe só o que mudou depois
+    # (registros do último segundo podem se repetir; use telefone + ts para deduplicar)
+    cursor = int(time.time())
+    columns = DATASETS[dataset]
+    rows = iter_rows(manager, dataset, since)
+    if fmt == "csv":
+        chunks = csv_gzip_chunks(columns, rows)
+        filename = f"{dataset}.csv.gz"
+    else:
+        chunks = parquet_chunks(columns, rows)
+        filename = f"{dataset}.parquet"
+    return chunks, {"filename": filename, "cursor": cursor}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exportação de leads e interações (CSV gzip ou Parquet)")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("--desde", default="", help="epoch ou data ISO (exportação incremental)")
+    parser.add_argument("--formato", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--saida", default="", help="arquivo de saída (padrão: nome do conjunto)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    from lead_manager import lead_manager
+    try:
+        chunks, meta = export_stream(lead_manager, args.dataset, parse_since(args.desde), args.formato)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    path = args.saida or meta["filename"]
+    started = time.perf_counter()
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+    print(f"{path}: {size} bytes em {time.perf_counter() - started:.2f}s "
+          f"(próxima exportação incremental: --desde {meta['cursor']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,24 +4,101 @@ import json
 import logging
 import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from flask import current_app
+from event_store import LeadEventStore
+from lead_snapshot import (LeadSnapshot, LeadHeader, STATUS_NOTE, record_epoch, to_epoch,
+                           empty_counters, count_interaction, history_counters, lead_counters)
 
 log = logging.getLogger("fiat-whatsapp")
 _lock = threading.Lock()
 
+def _now() -> Tuple[str, int]:
+    """Momento atual em ISO (legível) e em epoch (comparações e ordenação)"""
+    now = datetime.now()
+    return now.isoformat(), int(now.timestamp())
+
+def new_lead_document(phone: str, now: str, now_ts: int, **kwargs) -> Dict[str, Any]:
+    """Documento inicial de um lead (também usado para normalizar leads migrados)"""
+    return {
+        "telefone": phone,
+        "nome_cliente": kwargs.get("nome_cliente", ""),
+        "email": kwargs.get("email", ""),
+        "status": kwargs.get("status", "Novo"),
+        "data_criacao": now,
+        "data_criacao_ts": now_ts,
+        "status_desde_ts": now_ts,
+        "ultima_interacao": now,
+        "ultima_interacao_ts": now_ts,
+        "vendedor_responsavel": kwargs.get("vendedor_responsavel", "Felipe Fortes"),
+        "notas": [],
+        "historico": [],
+        "contadores": empty_counters(),
+        "agendamentos": [],
+        "score": 0,
+        "tags": []
+    }
+
+def lead_state(lead: Dict[str, Any]) -> Dict[str, Any]:
+    """Resumo do lead (sem percorrer o histórico) repassado aos observadores"""
+    counters = lead_counters(lead)
+    return {
+        "status": lead.get("status", "Novo"),
+        "score": lead.get("score", 0),
+        "interacoes": len(lead.get("historico", [])),
+        "data_criacao_ts": record_epoch(lead, "data_criacao"),
+        "automacoes": sorted(lead.get("automations", {})),
+        "envios_automacao": sum(counters["por_regra"].values()),
+        "intencoes": counters["intencoes"]
+    }
+
+def status_entered_ts(lead: Dict[str, Any]) -> int:
+    """Epoch em que o lead entrou no status atual (leads antigos: última nota de status)"""
+    if lead.get("status_desde_ts"):
+        return lead["status_desde_ts"]
+    for note in reversed(lead.get("notas", [])):
+        match = STATUS_NOTE.match(note.get("texto", ""))
+        if match and note.get("autor") == "Sistema" and match.group(1) != match.group(2):
+            return to_epoch(note.get("timestamp"))
+    return record_epoch(lead, "data_criacao")
+
 class LeadManager:
     """Gerenciador de leads com histórico unificado usando arquivos JSON"""
     
-    def __init__(self, leads_dir: str = "leads"):
+    def __init__(self, leads_dir: str = "leads", store_mode: Optional[str] = None):
         self.leads_dir = leads_dir
         os.makedirs(leads_dir, exist_ok=True)
+        
+        # "arquivos" (padrão): um JSON por telefone reescrito a cada alteração
+        # "eventos": log append-only + snapshots; os JSON viram visões reconstruídas
+        self.store_mode = store_mode or os.getenv("LEAD_STORE", "arquivos")
+        self.event_store = None
+        if self.store_mode == "eventos":
+            self.event_store = LeadEventStore(
+                os.path.join(leads_dir, "_eventos"),
+                snapshot_every=int(os.getenv("LEAD_SNAPSHOT_EVERY", "10000"))
+            )
+        
+        # Snapshot binário dos cabeçalhos, para leituras em massa sem histórico
+        self.snapshot = LeadSnapshot(self)
+        
+        # Notificados a cada alteração gravada (ex.: agregados do analytics)
+        self.observers: List[Any] = []
+        # Gravações feitas por este processo (parte da marca de mudança do snapshot)
+        self.writes = 0
+    
+    def add_observer(self, observer):
+        """Registra um observador com on_lead_event(antes, lead, tipo, dados)"""
+        if observer not in self.observers:
+            self.observers.append(observer)
+    
+    def _clean_phone(self, phone: str) -> str:
+        """Remove caracteres especiais e espaços do telefone"""
+        return phone.replace("+", "").replace("-", "").replace(" ", "").replace("(", "").replace(")", "")
     
     def _get_lead_file_path(self, phone: str) -> str:
         """Retorna o caminho do arquivo JSON para um telefone"""
-        # Remove caracteres especiais e espaços do telefone
-        clean_phone = phone.replace("+", "").replace("-", "").replace(" ", "").replace("(", "").replace(")", "")
-        return os.path.join(self.leads_dir, f"{clean_phone}.json")
+        return os.path.join(self.leads_dir, f"{self._clean_phone(phone)}.json")
     
     def _atomic_write(self, path: str, data: dict):
         """Escreve dados de forma atômica para evitar corrupção"""
@@ -31,8 +108,33 @@ class LeadManager:
                 json.dump(data, f, ensure_ascii=False, indent=2)
             os.replace(tmp_path, path)
     
+    def _save(self, phone: str, lead: Dict[str, Any], event_type: str, data: Dict[str, Any],
+              before: Optional[Dict[str, Any]] = None):
+        """Persiste a alteração: reescreve o JSON do lead ou anexa o evento ao log"""
+        # Revisão: cresce a cada gravação (o log de eventos conta igual ao aplicar);
+        # as reconstruções do analytics a usam para saber o que já leram do lead
+        lead["revisao"] = lead.get("revisao", 0) + 1
+        if self.event_store is not None:
+            event = self.event_store.append(self._clean_phone(phone), event_type, data)
+            lead["modificado_ts"] = to_epoch(event["ts"])  # o mesmo que apply_event grava
+        else:
+            # Qualquer gravação (notas inclusive) conta para a exportação incremental
+            lead["modificado_ts"] = _now()[1]
+            self._atomic_write(self._get_lead_file_path(phone), lead)
+        self.writes += 1
+        
+        # before: lead_state() antes da alteração (None na criação do lead)
+        for observer in self.observers:
+            try:
+                observer.on_lead_event(before, lead, event_type, data)
+            except Exception as e:
+                log.error(f"Erro ao notificar {type(observer).__name__} ({event_type} {phone}): {e}")
+    
     def get_lead(self, phone: str) -> Optional[Dict[str, Any]]:
         """Recupera dados de um lead pelo telefone"""
+        if self.event_store is not None:
+            return self.event_store.get_lead(self._clean_phone(phone))
+        
         file_path = self._get_lead_file_path(phone)
         if not os.path.exists(file_path):
             return None
@@ -47,55 +149,55 @@ class LeadManager:
     def create_or_update_lead(self, phone: str, **kwargs) -> Dict[str, Any]:
         """Cria ou atualiza um lead"""
         lead = self.get_lead(phone)
-        now = datetime.now().isoformat()
+        now, now_ts = _now()
         
         if lead is None:
             # Criar novo lead
-            lead = {
-                "telefone": phone,
-                "nome_cliente": kwargs.get("nome_cliente", ""),
-                "email": kwargs.get("email", ""),
-                "status": kwargs.get("status", "Novo"),
-                "data_criacao": now,
-                "ultima_interacao": now,
-                "vendedor_responsavel": kwargs.get("vendedor_responsavel", "Felipe Fortes"),
-                "notas": [],
-                "historico": [],
-                "agendamentos": [],
-                "score": 0,
-                "tags": []
-            }
+            lead = new_lead_document(phone, now, now_ts, **kwargs)
             log.info(f"Novo lead criado: {phone}")
+            self._save(phone, lead, "lead_created", lead)
         else:
             # Atualizar lead existente
-            lead["ultima_interacao"] = now
+            before = lead_state(lead)
+            changes = {"ultima_interacao": now, "ultima_interacao_ts": now_ts}
             for key, value in kwargs.items():
                 if key in lead and value is not None:
-                    lead[key] = value
+                    changes[key] = value
+            lead.update(changes)
+            self._save(phone, lead, "lead_updated", changes, before)
         
-        self._atomic_write(self._get_lead_file_path(phone), lead)
         return lead
     
-    def add_interaction(self, phone: str, direction: str, message: str, message_type: str = "texto") -> Dict[str, Any]:
-        """Adiciona uma interação ao histórico do lead"""
+    def add_interaction(self, phone: str, direction: str, message: str, message_type: str = "texto",
+                        rule_name: Optional[str] = None) -> Dict[str, Any]:
+        """Adiciona uma interação ao histórico do lead (rule_name: regra que gerou o envio)"""
         lead = self.get_lead(phone)
         if lead is None:
             lead = self.create_or_update_lead(phone)
         
+        before = lead_state(lead)
+        now, now_ts = _now()
         interaction = {
             "direcao": direction,  # "Entrada" ou "Saída"
             "mensagem": message,
             "tipo_mensagem": message_type,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now,
+            "ts": now_ts
         }
+        if rule_name:
+            interaction["regra"] = rule_name
         
+        # Leads anteriores aos contadores: recalcula uma vez (o histórico ainda sem a nova interação)
+        lead["contadores"] = lead_counters(lead)
+        count_interaction(lead["contadores"], interaction)
         lead["historico"].append(interaction)
-        lead["ultima_interacao"] = interaction["timestamp"]
+        lead["ultima_interacao"] = now
+        lead["ultima_interacao_ts"] = now_ts
         
         # Atualizar score baseado na interação
         self._update_lead_score(lead, direction, message)
         
-        self._atomic_write(self._get_lead_file_path(phone), lead)
+        self._save(phone, lead, "interaction", {"interacao": interaction, "score": lead["score"]}, before)
         return lead
     
     def _update_lead_score(self, lead: Dict[str, Any], direction: str, message: str):
@@ -135,6 +237,7 @@ class LeadManager:
         if lead is None:
             lead = self.create_or_update_lead(phone)
         
+        before = lead_state(lead)
         note_entry = {
             "texto": note,
             "autor": author,
@@ -142,7 +245,7 @@ class LeadManager:
         }
         
         lead["notas"].append(note_entry)
-        self._atomic_write(self._get_lead_file_path(phone), lead)
+        self._save(phone, lead, "note", note_entry, before)
         return lead
     
     def update_status(self, phone: str, new_status: str) -> Dict[str, Any]:
@@ -152,21 +255,54 @@ class LeadManager:
             return None
         
         old_status = lead.get("status", "Novo")
+        entered_ts = status_entered_ts(lead)
+        
+        # Adicionar nota automática sobre mudança de status (e seguir a partir
+        # do lead já com a nota, para não sobrescrevê-la na gravação abaixo)
+        lead = self.add_note(phone, f"Status alterado de '{old_status}' para '{new_status}'", "Sistema")
+        
+        before = lead_state(lead)
+        now, now_ts = _now()
         lead["status"] = new_status
-        lead["ultima_interacao"] = datetime.now().isoformat()
+        lead["ultima_interacao"] = now
+        lead["ultima_interacao_ts"] = now_ts
         
-        # Adicionar nota automática sobre mudança de status
-        self.add_note(phone, f"Status alterado de '{old_status}' para '{new_status}'", "Sistema")
+        # Transição com o tempo que o lead passou no status anterior (funil real)
+        transition = {"de": old_status, "para": new_status, "timestamp": now, "ts": now_ts}
+        if new_status != old_status:
+            lead["status_desde_ts"] = now_ts
+            if entered_ts > 0:
+                transition["permanencia_s"] = max(now_ts - entered_ts, 0)
+        self._save(phone, lead, "status", transition, before)
+        return lead
+    
+    def record_automation(self, phone: str, rule_name: str) -> Optional[Dict[str, Any]]:
+        """Registra a execução de uma regra de automação no lead"""
+        lead = self.get_lead(phone)
+        if lead is None:
+            return None
         
-        self._atomic_write(self._get_lead_file_path(phone), lead)
+        before = lead_state(lead)
+        now = datetime.now().isoformat()
+        lead.setdefault("automations", {})[rule_name] = now
+        self._save(phone, lead, "automation", {"regra": rule_name, "timestamp": now}, before)
         return lead
     
     def get_all_leads(self) -> List[Dict[str, Any]]:
         """Retorna todos os leads"""
-        leads = []
+        if self.event_store is not None:
+            return self.event_store.get_all_leads()
+        
+        return list(self.iter_leads())
+    
+    def iter_leads(self):
+        """Percorre os leads um a um, sem manter a base inteira em memória"""
+        if self.event_store is not None:
+            yield from self.event_store.get_all_leads()
+            return
         
         if not os.path.exists(self.leads_dir):
-            return leads
+            return
         
         for filename in os.listdir(self.leads_dir):
             if filename.endswith(".json"):
@@ -177,9 +313,11 @@ class LeadManager:
                 
                 lead = self.get_lead(phone)
                 if lead:
-                    leads.append(lead)
-        
-        return leads
+                    yield lead
+    
+    def get_lead_headers(self, refresh: bool = True) -> List[LeadHeader]:
+        """Retorna só os cabeçalhos (sem histórico) de todos os leads"""
+        return self.snapshot.load(refresh)
     
     def get_leads_by_status(self, status: str) -> List[Dict[str, Any]]:
         """Retorna leads filtrados por status"""
@@ -197,17 +335,54 @@ class LeadManager:
         all_leads = self.get_all_leads()
         cutoff_time = datetime.now() - timedelta(hours=hours)
         
+        cutoff_ts = cutoff_time.timestamp()
+        
         inactive_leads = []
         for lead in all_leads:
-            try:
-                last_interaction = datetime.fromisoformat(lead.get("ultima_interacao", ""))
-                if last_interaction < cutoff_time and lead.get("status") not in ["Vendido", "Perdido"]:
-                    inactive_leads.append(lead)
-            except:
-                continue
+            last_interaction = record_epoch(lead, "ultima_interacao")
+            if 0 < last_interaction < cutoff_ts and lead.get("status") not in ["Vendido", "Perdido"]:
+                inactive_leads.append(lead)
         
         return inactive_leads
     
+    def backfill_epoch_fields(self) -> int:
+        """Migração única: grava os campos *_ts em leads e interações antigos"""
+        migrated = 0
+        for lead in self.get_all_leads():
+            changes = {}
+            for field in ("data_criacao", "ultima_interacao"):
+                if f"{field}_ts" not in lead:
+                    changes[f"{field}_ts"] = to_epoch(lead.get(field))
+            
+            historico = lead.get("historico", [])
+            missing = [interaction for interaction in historico if "ts" not in interaction]
+            for interaction in missing:
+                interaction["ts"] = to_epoch(interaction.get("timestamp"))
+            if missing:
+                changes["historico"] = historico
+            
+            if changes:
+                before = lead_state(lead)
+                lead.update(changes)
+                self._save(lead["telefone"], lead, "lead_updated", changes, before)
+                migrated += 1
+        
+        return migrated
+    
+    def backfill_counters(self) -> int:
+        """Migração única: grava os contadores de mensagens dos leads anteriores a eles"""
+        migrated = 0
+        for lead in self.iter_leads():
+            if "contadores" in lead:
+                continue
+            before = lead_state(lead)
+            changes = {"contadores": history_counters(lead)}
+            lead.update(changes)
+            self._save(lead["telefone"], lead, "lead_updated", changes, before)
+            migrated += 1
+        
+        return migrated
+    
     def get_conversation_context(self, phone: str, max_messages: int = 10) -> str:
         """Retorna o contexto da conversa para a IA"""
         lead = self.get_lead(phone)
@@ -227,3 +402,16 @@ class LeadManager:
 # Instância global do gerenciador
 lead_manager = LeadManager()
 
+if __name__ == "__main__":
+    import sys
+    
+    if sys.argv[1:] not in (["backfill-epochs"], ["backfill-counters"]):
+        print("Uso: python lead_manager.py backfill-epochs|backfill-counters")
+        sys.exit(2)
+    
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+    if sys.argv[1] == "backfill-epochs":
+        print(f"{lead_manager.backfill_epoch_fields()} leads migrados")
+    else:
+        print(f"{lead_manager.backfill_counters()} leads migrados")
+
@@ -0,0 +1,79 @@
+# lead_signals.py
+from typing import Dict, List, Any, Tuple
+
+# Palavras-chave das análises de mensagens dos clientes (direção "Entrada")
+VEHICLE_KEYWORDS = {
+    "pulse": ["pulse"],
+    "toro": ["toro"],
+    "strada": ["strada"],
+    "argo": ["argo"],
+    "cronos": ["cronos"],
+    "fastback": ["fastback"],
+    "mobi": ["mobi"],
+    "fiorino": ["fiorino"],
+    "ducato": ["ducato"]
+}
+
+INTENT_KEYWORDS = {
+    "compra": ["comprar", "adquirir", "levar", "fechar negócio", "finalizar"],
+    "financiamento": ["financiar", "financiamento", "parcelar", "entrada", "prestação"],
+    "test_drive": ["test drive", "teste", "dirigir", "experimentar", "conhecer"],
+    "preco": ["preço", "preco", "valor", "custa", "quanto"],
+    "troca": ["trocar", "troca", "dar entrada", "usado"],
+    "urgencia": ["urgente", "rápido", "hoje", "agora", "logo"]
+}
+
+# Intenções que classificam o lead como de alta intenção de compra
+HIGH_INTENTS = ("compra", "urgencia", "financiamento")
+
+# Termos das oportunidades de venda
+PRICE_TERMS = ("preço", "preco", "valor")
+BUY_TERMS = ("comprar", "financiar", "fechar")
+TEST_DRIVE_TERMS = ("test", "dirigir", "conhecer")
+
+# Bits das intenções (ordem fixa: o valor é gravado no snapshot de cabeçalhos)
+INTENT_BITS = {intent: 1 << i for i, intent in enumerate(INTENT_KEYWORDS)}
+HIGH_INTENT_MASK = sum(INTENT_BITS[intent] for intent in HIGH_INTENTS)
+
+SIGNAL_BUY = 1
+SIGNAL_TEST_DRIVE = 2
+
+
+def vehicles_in(message: str) -> List[str]:
+    """Veículos mencionados em uma mensagem já em minúsculas"""
+    return [vehicle for vehicle, keywords in VEHICLE_KEYWORDS.items()
+            if any(keyword in message for keyword in keywords)]
+
+
+def intent_mask(message: str) -> int:
+    """Bits das intenções presentes em uma mensagem já em minúsculas"""
+    mask = 0
+    for intent, keywords in INTENT_KEYWORDS.items():
+        if any(keyword in message for keyword in keywords):
+            mask |= INTENT_BITS[intent]
+    return mask
+
+
+def intents_of(mask: int) -> List[str]:
+    """Nomes das intenções de uma máscara de bits"""
+    return [intent for intent, bit in INTENT_BITS.items() if mask & bit]
+
+
+def message_signals(historico: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    """Sinais das mensagens do cliente: (máscara de intenções, sinais, menções de preço)"""
+    return signals_of([interaction.get("mensagem", "").lower() for interaction in historico
+                       if interaction.get("direcao") == "Entrada"])
+
+
+def signals_of(messages: List[str]) -> Tuple[int, int, int]:
+    """Mesmo que message_signals, para mensagens recebidas já em minúsculas"""
+    intents = signals = price_mentions = 0
+    for message in messages:
+        intents |= intent_mask(message)
+        if any(term in message for term in BUY_TERMS):
+            signals |= SIGNAL_BUY
+        if any(term in message for term in TEST_DRIVE_TERMS):
+            signals |= SIGNAL_TEST_DRIVE
+        for term in PRICE_TERMS:
+            price_mentions += message.count(term)
+    return intents, signals, price_mentions
@@ -0,0 +1,476 @@
+# lead_snapshot.py
+import os
+import re
+import sys
+import mmap
+import json
+import fcntl
+import time
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Tuple
+from lead_signals import message_signals, intent_mask
+
+log = logging.getLogger("fiat-whatsapp")
+
+SNAPSHOT_FILE = "_headers.bin"
+MAGIC = b"LEADSNP1"
+
+# Cabeçalho: magic, versão, quantidade de registros, epoch da compactação
+HEADER = struct.Struct("<8sIIq")
+# Registro de largura fixa (126 bytes):
+# telefone, status, score, data_criacao, ultima_interacao, interações,
+# entradas, saídas, notas, follow-ups automáticos, menções de preço,
+# máscara de intenções, sinais (lead_signals), primeira vez em Agendado
+# (ou além) e em Vendido, última gravação do lead, mtime_ns do arquivo de origem
+RECORD = struct.Struct("<24s24siqqIIIIIIBBqqqq")
+VERSION = 4
+
+# Nota automática gravada por LeadManager.update_status
+STATUS_NOTE = re.compile(r"^Status alterado de '(.*)' para '(.*)'$")
+
+# Marcos do funil guardados no cabeçalho (coortes)
+SCHEDULED_STATUSES = ("Agendado", "Vendido")
+SOLD_STATUSES = ("Vendido",)
+# mtime mais novo que isto (relógio do disco de baixa resolução) não prova que o arquivo
+# não mudou de novo no mesmo tique: a entrada é relida na próxima atualização
+RACY_NS = 2_000_000_000
+
+
+def to_epoch(value: Any) -> int:
+    """Converte timestamp ISO em epoch (0 se ausente, -1 se inválido)"""
+    if not value:
+        return 0
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return -1
+
+
+def record_epoch(record: Dict[str, Any], field: str, ts_field: Optional[str] = None) -> int:
+    """Epoch gravado no registro (campo *_ts) ou convertido do ISO em registros antigos"""
+    ts = record.get(ts_field or f"{field}_ts")
+    return ts if ts is not None else to_epoch(record.get(field))
+
+
+def empty_counters() -> Dict[str, Any]:
+    """Contadores de mensagens de um lead sem histórico"""
+    return {"entrada": 0, "saida": 0, "automacao": 0, "manual": 0, "por_regra": {}, "intencoes": 0}
+
+
+def count_interaction(counters: Dict[str, Any], interaction: Dict[str, Any]):
+    """Soma uma interação aos contadores do lead (O(1))"""
+    direction = interaction.get("direcao", "")
+    if direction == "Entrada":
+        counters["entrada"] += 1
+        # Máscara das intenções já vistas: os agregados contam leads distintos sem reler o histórico
+        counters["intencoes"] = counters.get("intencoes", 0) | intent_mask(interaction.get("mensagem", "").lower())
+    elif direction.startswith("Saída"):
+        counters["saida"] += 1
+        message_type = interaction.get("tipo_mensagem")
+        if message_type in ("automacao", "manual"):
+            counters[message_type] += 1
+    rule_name = interaction.get("regra")
+    if rule_name:
+        counters["por_regra"][rule_name] = counters["por_regra"].get(rule_name, 0) + 1
+
+
+def history_counters(lead: Dict[str, Any]) -> Dict[str, Any]:
+    """Recalcula os contadores percorrendo o histórico (backfill de leads antigos)"""
+    counters = empty_counters()
+    for interaction in lead.get("historico", []):
+        count_interaction(counters, interaction)
+    # Envios anteriores não marcavam a regra na interação: conta ao menos a última execução
+    for rule_name in lead.get("automations", {}):
+        counters["por_regra"].setdefault(rule_name, 1)
+    return counters
+
+
+def lead_counters(lead: Dict[str, Any]) -> Dict[str, Any]:
+    """Contadores mantidos no lead (recalculados só se o lead for anterior a eles)"""
+    counters = lead.get("contadores")
+    if counters is None:
+        return history_counters(lead)
+    if "intencoes" not in counters:
+        # Contadores anteriores à máscara de intenções: completa uma vez (gravada no próximo save)
+        counters["intencoes"] = history_counters(lead)["intencoes"]
+    return counters
+
+
+def status_reached_ts(lead: Dict[str, Any], statuses: Tuple[str, ...]) -> int:
+    """Epoch em que o lead entrou pela primeira vez em um dos status (0 se nunca entrou)"""
+    first_note = True
+    for note in lead.get("notas", []):
+        match = STATUS_NOTE.match(note.get("texto", ""))
+        if not match or note.get("autor") != "Sistema" or match.group(1) == match.group(2):
+            continue
+        if first_note and match.group(1) in statuses:
+            return record_epoch(lead, "data_criacao")  # já foi criado nesse status
+        first_note = False
+        if match.group(2) in statuses:
+            return to_epoch(note.get("timestamp"))
+    if lead.get("status") in statuses:
+        return lead.get("status_desde_ts") or record_epoch(lead, "data_criacao")
+    return 0
+
+
+def modified_ts(lead: Dict[str, Any]) -> int:
+    """Epoch da última gravação do lead (leads antigos, sem o campo: última interação)"""
+    return lead.get("modificado_ts") or record_epoch(lead, "ultima_interacao")
+
+
+class LeadHeader:
+    """Cabeçalho compacto de um lead (sem histórico), com timestamps em epoch"""
+    __slots__ = ("telefone", "status", "score", "data_criacao_ts", "ultima_interacao_ts",
+                 "total_interacoes", "entradas", "saidas", "notas", "follow_ups",
+                 "mencoes_preco", "intencoes", "sinais", "agendado_ts", "vendido_ts", "modificado_ts")
+
+    def __init__(self, telefone: str, status: str, score: int, data_criacao_ts: int,
+                 ultima_interacao_ts: int, total_interacoes: int = 0, entradas: int = 0,
+                 saidas: int = 0, notas: int = 0, follow_ups: int = 0,
+                 mencoes_preco: int = 0, intencoes: int = 0, sinais: int = 0,
+                 agendado_ts: int = 0, vendido_ts: int = 0, modificado_ts: int = 0):
+        self.telefone = telefone
+        self.status = status
+        self.score = score
+        self.data_criacao_ts = data_criacao_ts          # 0 = ausente, -1 = inválido
+        self.ultima_interacao_ts = ultima_interacao_ts
+        self.total_interacoes = total_interacoes
+        self.entradas = entradas
+        self.saidas = saidas
+        self.notas = notas
+        self.follow_ups = follow_ups
+        # Derivados das mensagens do cliente, calculados uma vez na compactação
+        self.mencoes_preco = mencoes_preco
+        self.intencoes = intencoes
+        self.sinais = sinais
+        # Marcos do funil (0 = nunca chegou), para as coortes semanais
+        self.agendado_ts = agendado_ts
+        self.vendido_ts = vendido_ts
+        # Última gravação de qualquer campo (notas inclusive), para a exportação incremental
+        self.modificado_ts = modificado_ts
+
+    @classmethod
+    def from_lead(cls, lead: Dict[str, Any], signals: bool = True) -> "LeadHeader":
+        """Extrai o cabeçalho de um documento de lead completo.
+        signals=False: só contadores, status, score e campos *_ts (O(1), sem varrer histórico
+        e notas); sinais, menções de preço e marcos do funil ficam zerados."""
+        counters = lead_counters(lead)
+        historico = lead.get("historico", [])
+        if not signals:
+            return cls(
+                lead.get("telefone", ""),
+                lead.get("status", "Novo"),
+                int(lead.get("score", 0)),
+                record_epoch(lead, "data_criacao"),
+                record_epoch(lead, "ultima_interacao"),
+                len(historico),
+                counters["entrada"],
+                counters["saida"],
+                len(lead.get("notas", [])),
+                counters["automacao"],
+                intencoes=counters["intencoes"],
+                modificado_ts=modified_ts(lead)
+            )
+        intencoes, sinais, mencoes_preco = message_signals(historico)
+
+        return cls(
+            lead.get("telefone", ""),
+            lead.get("status", "Novo"),
+            int(lead.get("score", 0)),
+            record_epoch(lead, "data_criacao"),
+            record_epoch(lead, "ultima_interacao"),
+            len(historico),
+            counters["entrada"],
+            counters["saida"],
+            len(lead.get("notas", [])),
+            counters["automacao"],
+            mencoes_preco,
+            intencoes,
+            sinais,
+            status_reached_ts(lead, SCHEDULED_STATUSES),
+            status_reached_ts(lead, SOLD_STATUSES),
+            modified_ts(lead)
+        )
+
+    def __repr__(self) -> str:
+        return f"LeadHeader({self.telefone!r}, status={self.status!r}, score={self.score})"
+
+
+def _fit(value: Any, size: int) -> bytes:
+    """Codifica texto em UTF-8 truncando sem quebrar caracteres"""
+    encoded = str(value or "").encode("utf-8")
+    if len(encoded) <= size:
+        return encoded
+    return encoded[:size].decode("utf-8", errors="ignore").encode("utf-8")
+
+
+def pack_header(header: LeadHeader, mtime_ns: int = 0) -> bytes:
+    """Serializa um cabeçalho no formato de largura fixa"""
+    return RECORD.pack(
+        _fit(header.telefone, 24),
+        _fit(header.status, 24),
+        header.score,
+        header.data_criacao_ts,
+        header.ultima_interacao_ts,
+        header.total_interacoes,
+        header.entradas,
+        header.saidas,
+        header.notas,
+        header.follow_ups,
+        min(header.mencoes_preco, 0xFFFFFFFF),
+        header.intencoes,
+        header.sinais,
+        header.agendado_ts,
+        header.vendido_ts,
+        header.modificado_ts,
+        mtime_ns
+    )
+
+
+def _unpack(fields: Tuple) -> LeadHeader:
+    return LeadHeader(
+        fields[0].rstrip(b"\0").decode("utf-8"),
+        fields[1].rstrip(b"\0").decode("utf-8"),
+        *fields[2:16]
+    )
+
+
+def write_records(path: str, records: List[bytes]):
+    """Grava um snapshot completo (registros já empacotados) de forma atômica.
+    O temporário tem nome único: dois processos gravando juntos não se atropelam"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), int(time.time())))
+            f.writelines(records)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class LeadSnapshotReader:
+    """Leitura do snapshot via mmap, sem copiar o arquivo para a memória"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = None
+        try:
+            # Arquivo vazio (mmap recusa) ou truncado (unpack_from) também é inválido
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, built_at = HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC or version != VERSION or len(self._mm) < HEADER.size + count * RECORD.size:
+                raise ValueError(f"Snapshot de leads inválido: {path}")
+        except BaseException:
+            self.close()  # sem vazar o descritor aberto acima
+            raise
+        self.count = count
+        self.built_at = built_at
+        self._view = memoryview(self._mm)[HEADER.size:HEADER.size + count * RECORD.size]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for fields in RECORD.iter_unpack(self._view):
+            yield _unpack(fields)
+    
+    def buffer(self) -> memoryview:
+        """Bytes dos registros (sem o cabeçalho), para leitura colunar"""
+        return self._view
+
+    def raw_entries(self):
+        """Percorre (telefone, mtime_ns, bytes do registro) para o refresh incremental"""
+        for i in range(self.count):
+            start = i * RECORD.size
+            chunk = self._view[start:start + RECORD.size]
+            fields = RECORD.unpack(chunk)
+            yield fields[0].rstrip(b"\0").decode("utf-8"), fields[16], chunk.tobytes()
+
+    def close(self):
+        view = getattr(self, "_view", None)
+        if view is not None:
+            view.release()
+            self._view = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LeadSnapshot:
+    """Compactação periódica dos cabeçalhos dos leads em um arquivo binário"""
+
+    def __init__(self, manager, path: Optional[str] = None):
+        self.manager = manager
+        self.path = path or os.path.join(self.manager.leads_dir, SNAPSHOT_FILE)
+        self.lock_path = self.path + ".lock"
+        self._lock = threading.Lock()
+        # Marca de mudança vista na última atualização (ver _change_token)
+        self._token: Optional[Tuple[int, ...]] = None
+        self._count = 0
+        # Modo eventos: registros por telefone e offset do log já refletido neles
+        self._event_records: Dict[str, bytes] = {}
+        self._event_offset: Optional[int] = None
+
+    def _change_token(self) -> Optional[Tuple[int, ...]]:
+        """Muda sempre que um lead é gravado: o tamanho do log de eventos (só cresce) ou o
+        mtime do diretório (toda escrita é tmp + os.replace nele) mais as gravações deste
+        processo. None (sempre compacta) enquanto o mtime for recente demais para valer:
+        outro processo pode ter gravado no mesmo tique"""
+        try:
+            if self.manager.event_store is not None:
+                st = os.stat(self.manager.event_store.log_path)
+                return st.st_size, st.st_mtime_ns
+            mtime_ns = os.stat(self.manager.leads_dir).st_mtime_ns
+        except OSError:
+            return None
+        if time.time_ns() - mtime_ns < RACY_NS:
+            return None
+        return mtime_ns, self.manager.writes
+
+    def _load_previous(self) -> Dict[str, Tuple[int, bytes]]:
+        """Registros do snapshot atual indexados pelo nome do arquivo de origem"""
+        previous = {}
+        if not os.path.exists(self.path):
+            return previous
+        try:
+            with LeadSnapshotReader(self.path) as reader:
+                for phone, mtime_ns, packed in reader.raw_entries():
+                    clean_phone = self.manager._clean_phone(phone)
+                    previous[f"{clean_phone}.json"] = (mtime_ns, packed)
+        except Exception as e:
+            log.warning(f"Snapshot de leads ignorado, reconstruindo do zero: {e}")
+        return previous
+
+    def refresh(self, force: bool = False) -> Dict[str, int]:
+        """Atualiza o snapshot relendo só os arquivos alterados desde a última compactação.
+        Sem nenhuma gravação de lead desde a anterior, custa um stat (caminho quente)"""
+        with self._lock:
+            # Marca lida antes da varredura: uma gravação concorrente força a próxima
+            token = self._change_token()
+            if not force and token is not None and token == self._token and os.path.exists(self.path):
+                return {"reused": self._count, "parsed": 0}
+            with open(self.lock_path, "a") as lock_file:
+                # flock: workers do gunicorn não compactam o mesmo arquivo ao mesmo tempo
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    stats = self._compact()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._token = token
+            return stats
+
+    def _compact(self) -> Dict[str, int]:
+        """Regrava o snapshot (chamado com o flock) e devolve relidos/reaproveitados"""
+        records: List[bytes] = []
+        stats = {"reused": 0, "parsed": 0}
+
+        if self.manager.event_store is not None:
+            # No modo eventos os leads já estão materializados em memória: só os que
+            # receberam eventos desde o último offset são reempacotados
+            leads, offset = self.manager.event_store.changes_since(self._event_offset)
+            if self._event_offset is None:
+                self._event_records = {}
+            for lead in leads:
+                self._event_records[lead.get("telefone", "")] = pack_header(LeadHeader.from_lead(lead))
+            self._event_offset = offset
+            stats["parsed"] = len(leads)
+            stats["reused"] = len(self._event_records) - len(leads)
+            records = list(self._event_records.values())
+        else:
+            previous = self._load_previous()
+            racy = time.time_ns() - RACY_NS
+            with os.scandir(self.manager.leads_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".json"):
+                        continue
+                    mtime_ns = entry.stat().st_mtime_ns
+                    cached = previous.get(entry.name)
+                    if cached and cached[0] == mtime_ns and mtime_ns:
+                        records.append(cached[1])
+                        stats["reused"] += 1
+                        continue
+                    try:
+                        with open(entry.path, "r", encoding="utf-8") as f:
+                            lead = json.load(f)
+                    except Exception as e:
+                        log.error(f"Erro ao ler lead {entry.name}: {e}")
+                        continue
+                    # Gravado há pouco: mtime 0 faz a próxima atualização reler o arquivo
+                    records.append(pack_header(LeadHeader.from_lead(lead), mtime_ns if mtime_ns < racy else 0))
+                    stats["parsed"] += 1
+            if not stats["parsed"] and stats["reused"] == len(previous) and os.path.exists(self.path):
+                # Nada mudou (só o próprio snapshot mexeu no diretório): não regrava,
+                # senão o mtime do diretório muda de novo e a próxima chamada varre outra vez
+                self._count = len(records)
+                return stats
+
+        write_records(self.path, records)
+        self._count = len(records)
+        return stats
+
+    def replace(self, records: List[bytes]):
+        """Grava registros empacotados por fora (ex.: recálculo paralelo dos leads)"""
+        with self._lock:
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    write_records(self.path, records)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._token = None
+            self._event_offset = None
+            self._count = len(records)
+
+    def open(self, refresh: bool = True) -> LeadSnapshotReader:
+        """Abre o snapshot para leitura (atualizando-o antes, por padrão)"""
+        if refresh or not os.path.exists(self.path):
+            self.refresh()
+        return LeadSnapshotReader(self.path)
+
+    def load(self, refresh: bool = True) -> List[LeadHeader]:
+        """Retorna todos os cabeçalhos do snapshot"""
+        with self.open(refresh) as reader:
+            return list(reader)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot binário dos cabeçalhos dos leads")
+    parser.add_argument("command", choices=["build", "info"])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    from lead_manager import lead_manager
+    lead_snapshot = lead_manager.snapshot
+
+    if args.command == "build":
+        started = time.perf_counter()
+        stats = lead_snapshot.refresh()
+        print(f"Snapshot atualizado em {time.perf_counter() - started:.2f}s: "
+              f"{stats['parsed']} relidos, {stats['reused']} reaproveitados")
+    else:
+        with lead_snapshot.open(refresh=False) as reader:
+            built = datetime.fromtimestamp(reader.built_at).isoformat()
+            print(f"{len(reader)} leads, compactado em {built} ({os.path.getsize(lead_snapshot.path)} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
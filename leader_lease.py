@@ -0,0 +1,143 @@
+# leader_lease.py
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Optional, Any
+
+log = logging.getLogger("fiat-whatsapp")
+
+LOCK_SUFFIX = ".lock"
+LEASE_SUFFIX = ".lease"
+
+
+def data_dir() -> str:
+    return os.getenv("DATA_DIR", "data")
+
+
+class LeaderLease:
+    """Eleição de um líder entre processos (workers do gunicorn) por flock em DATA_DIR.
+    O lock cai junto com o processo; os demais ficam de reserva e assumem no próximo
+    heartbeat. O arquivo .lease só informa quem lidera e quando deu sinal de vida."""
+
+    def __init__(self, name: str, on_elected: Callable[[], None], on_demoted: Callable[[], None] = None,
+                 healthy: Callable[[], bool] = None, base_dir: str = None, heartbeat: float = None):
+        self.name = name
+        self.base_dir = base_dir or data_dir()
+        self.lock_path = os.path.join(self.base_dir, name + LOCK_SUFFIX)
+        self.lease_path = os.path.join(self.base_dir, name + LEASE_SUFFIX)
+        self.heartbeat = heartbeat or float(os.getenv("LEADER_HEARTBEAT_SECONDS", "10"))
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        # Líder que não está saudável (ex.: thread do agendador morreu) devolve o lock
+        self.healthy = healthy or (lambda: True)
+        self.is_leader = False
+        self.running = False
+        self.since: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            while self.running:
+                if not self.is_leader:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        self._elected()
+                    except BlockingIOError:
+                        pass  # outro processo lidera; tenta de novo no próximo heartbeat
+                elif not self.healthy():
+                    log.error(f"Líder '{self.name}' sem saúde (pid {os.getpid()}): devolvendo a liderança")
+                    self._demoted(lock_file)
+                else:
+                    self._write_lease()
+                self._stop.wait(self.heartbeat)
+            if self.is_leader:
+                self._demoted(lock_file)
+
+    def _elected(self):
+        self.is_leader = True
+        self.since = datetime.now().isoformat()
+        self._write_lease()
+        log.info(f"Processo {os.getpid()} assumiu a liderança de '{self.name}'")
+        try:
+            self.on_elected()
+        except Exception as e:
+            log.error(f"Erro ao assumir a liderança de '{self.name}': {e}")
+
+    def _demoted(self, lock_file):
+        if self.on_demoted:
+            try:
+                self.on_demoted()
+            except Exception as e:
+                log.error(f"Erro ao deixar a liderança de '{self.name}': {e}")
+        self.is_leader = False
+        self.since = None
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        log.info(f"Processo {os.getpid()} deixou a liderança de '{self.name}'")
+
+    def _write_lease(self):
+        lease = {"pid": os.getpid(), "host": socket.gethostname(), "desde": self.since,
+                 "heartbeat": time.time(), "intervalo": self.heartbeat}
+        tmp_path = f"{self.lease_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(lease, f)
+            os.replace(tmp_path, self.lease_path)
+        except OSError as e:
+            log.warning(f"Heartbeat de '{self.name}' não gravado: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        """Quem lidera (segundo o último heartbeat) e o papel deste processo"""
+        return {"nome": self.name, "lider": self.is_leader, "pid": os.getpid(), **read_lease(self.lease_path)}
+
+
+def read_lease(lease_path: str) -> Dict[str, Any]:
+    """Último heartbeat gravado; 'ativo' é falso se passou de 3 intervalos sem sinal"""
+    try:
+        with open(lease_path, "r", encoding="utf-8") as f:
+            lease = json.load(f)
+    except (OSError, ValueError):
+        return {"ativo": False}
+    age = time.time() - lease.get("heartbeat", 0)
+    return {
+        "lider_pid": lease.get("pid"),
+        "lider_host": lease.get("host"),
+        "lider_desde": lease.get("desde"),
+        "heartbeat_ha_s": round(age, 1),
+        "ativo": age < 3 * lease.get("intervalo", 10)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Líderes eleitos entre os workers (arquivos em DATA_DIR)")
+    parser.add_argument("name", nargs="?", default="automacao")
+    args = parser.parse_args(argv)
+    print(json.dumps({"nome": args.name, **read_lease(os.path.join(data_dir(), args.name + LEASE_SUFFIX))},
+                     ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
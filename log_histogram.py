@@ -0,0 +1,65 @@
+# log_histogram.py
+import math
+from typing import Dict, Optional
+
+# Baldes logarítmicos: 4 por potência de 2 (erro relativo de ~19% nos quantis).
+# O histograma é um dict {balde: contagem} que vai direto para o JSON e se soma
+# balde a balde, então períodos e vendedores podem ser combinados sem as amostras
+PER_OCTAVE = 4
+
+
+def bucket_of(value: float) -> str:
+    """Balde de um valor (>= 0); valores abaixo de 1 caem no balde "0" """
+    if value < 1:
+        return "0"
+    return str(int(math.log2(value) * PER_OCTAVE) + 1)
+
+
+def bucket_bounds(bucket: str):
+    """Limites [inferior, superior) de um balde"""
+    index = int(bucket)
+    if index == 0:
+        return 0.0, 1.0
+    return 2 ** ((index - 1) / PER_OCTAVE), 2 ** (index / PER_OCTAVE)
+
+
+def _midpoint(bucket: str) -> float:
+    """Ponto médio geométrico do balde (o balde "0" fica com 0,5)"""
+    low, high = bucket_bounds(bucket)
+    return math.sqrt(low * high) if low > 0 else high / 2
+
+
+def add(histogram: Dict[str, int], value: float, amount: int = 1):
+    bucket = bucket_of(value)
+    histogram[bucket] = histogram.get(bucket, 0) + amount
+
+
+def merge(total: Dict[str, int], histogram: Dict[str, int]):
+    """Soma um histograma em outro"""
+    for bucket, count in histogram.items():
+        total[bucket] = total.get(bucket, 0) + count
+
+
+def count(histogram: Dict[str, int]) -> int:
+    return sum(histogram.values())
+
+
+def quantile(histogram: Dict[str, int], q: float) -> Optional[float]:
+    """Quantil aproximado (ponto médio geométrico do balde); None sem amostras"""
+    total = count(histogram)
+    if total == 0:
+        return None
+    seen = 0
+    for bucket in sorted(histogram, key=int):
+        seen += histogram[bucket]
+        if seen >= q * total:
+            break
+    return _midpoint(bucket)
+
+
+def mean(histogram: Dict[str, int]) -> Optional[float]:
+    """Média aproximada pelos pontos médios dos baldes; None sem amostras"""
+    total = count(histogram)
+    if total == 0:
+        return None
+    return sum(_midpoint(bucket) * n for bucket, n in histogram.items()) / total
@@ -0,0 +1,381 @@
+# message_outbox.py
+import os
+import sys
+import json
+import time
+import fcntl
+import heapq
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Any
+
+from lead_manager import lead_manager
+from rate_limiter import RateLimiter, twilio_limiter
+
+log = logging.getLogger("fiat-whatsapp")
+
+OUTBOX_FILE = "outbox.log"
+DEAD_LETTER_FILE = "mortas.jsonl"
+DRAIN_LOCK_FILE = "drain.lock"
+
+# Chaves de mensagens já enviadas continuam valendo por este tempo após a compactação
+IDEMPOTENCY_WINDOW = 2 * 86400
+COMPACT_AFTER = 1000     # mensagens encerradas desde a última compactação
+POLL_INTERVAL = 2.0      # leitura do log para pegar o que outros processos enfileiraram
+MAX_DELAY = 3600
+
+
+class PermanentSendError(Exception):
+    """Falha que não adianta repetir (ex.: Twilio não configurado): vai direto para as mortas"""
+
+
+def message_key(phone: str, body: str) -> str:
+    """Chave de idempotência padrão: mesmo destino e texto no mesmo minuto"""
+    minute = int(time.time() // 60)
+    return hashlib.sha1(f"{phone}|{body}|{minute}".encode("utf-8")).hexdigest()
+
+
+class MessageOutbox:
+    """Fila persistente de mensagens de saída (log append-only) com reenvio e backoff"""
+
+    def __init__(self, base_dir: str = None, limiter: RateLimiter = None):
+        self.base_dir = base_dir or os.getenv("OUTBOX_DIR", os.path.join("data", "outbox"))
+        self.log_path = os.path.join(self.base_dir, OUTBOX_FILE)
+        self.dead_path = os.path.join(self.base_dir, DEAD_LETTER_FILE)
+        self.workers = int(os.getenv("OUTBOX_WORKERS", "4"))
+        self.max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+        self.base_delay = float(os.getenv("OUTBOX_BASE_DELAY", "30"))
+        # Fichas pegas antes de chamar o sender: ele não deve limitar de novo
+        self.limiter = limiter or twilio_limiter
+        self.delivered = 0
+        self.failed = 0
+
+        self._messages: Dict[str, Dict[str, Any]] = {}
+        self._heap: List[tuple] = []        # (próxima tentativa, id)
+        self._in_flight = set()
+        self._offset = 0
+        self._inode = None
+        self._settled = 0
+        self._lock = threading.RLock()
+        self._ready = threading.Condition(self._lock)
+        self.sender: Optional[Callable[[str, str], bool]] = None
+        self.running = False
+        self.draining = False
+        self._threads: List[threading.Thread] = []
+
+    # ---------- log ----------
+
+    @contextmanager
+    def _locked(self):
+        """Exclusão mútua entre threads e entre processos (workers do gunicorn)"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with self._lock, open(os.path.join(self.base_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _catch_up(self):
+        """Aplica as linhas novas do log (de outros processos); recarrega se foi compactado"""
+        try:
+            inode = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self._inode:
+            self._messages, self._heap, self._offset, self._inode = {}, [], 0, inode
+        with open(self.log_path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # linha ainda sendo escrita
+                self._offset += len(line)
+                try:
+                    self._apply(json.loads(line))
+                except Exception as e:
+                    log.warning(f"Linha inválida no outbox ignorada: {e}")
+
+    def _write(self, *records: Dict[str, Any]):
+        """Anexa registros ao log e os aplica em memória (chamado com o lock)"""
+        self._catch_up()
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._catch_up()
+
+    def _append(self, *records: Dict[str, Any]):
+        with self._locked():
+            self._write(*records)
+
+    def _apply(self, record: Dict[str, Any]):
+        op = record.get("op")
+        entry = self._messages.get(record.get("id"))
+        if op == "enfileirada":
+            entry = {k: v for k, v in record.items() if k != "op"}
+            entry.setdefault("estado", "pendente")
+            self._messages[entry["id"]] = entry
+            if entry["estado"] == "pendente":
+                heapq.heappush(self._heap, (entry["proxima"], entry["id"]))
+                self._ready.notify()
+        elif entry is None:
+            return
+        elif op == "falha":
+            entry.update(tentativas=record["tentativas"], proxima=record["proxima"], erro=record["erro"])
+            heapq.heappush(self._heap, (entry["proxima"], entry["id"]))
+        elif op in ("enviada", "morta"):
+            entry.update(estado=op, encerrada_em=record["ts"], erro=record.get("erro", entry.get("erro")),
+                         tentativas=record.get("tentativas", entry["tentativas"]))
+            self._settled += 1
+        elif op == "reenfileirada":
+            entry.update(estado="pendente", tentativas=0, proxima=record["ts"], erro=None)
+            heapq.heappush(self._heap, (entry["proxima"], entry["id"]))
+            self._ready.notify()
+
+    def _compact(self):
+        """Regrava o log só com as pendentes e as chaves encerradas ainda na janela de idempotência"""
+        cutoff = time.time() - IDEMPOTENCY_WINDOW
+        with self._locked():
+            self._catch_up()
+            kept = [entry for entry in self._messages.values()
+                    if entry["estado"] == "pendente" or entry.get("encerrada_em", 0) >= cutoff]
+            tmp_path = self.log_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in kept:
+                    f.write(json.dumps({"op": "enfileirada", **entry}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.log_path)
+            self._messages = {entry["id"]: entry for entry in kept}
+            self._offset = os.path.getsize(self.log_path)
+            self._inode = os.stat(self.log_path).st_ino
+            self._settled = 0
+        log.info(f"Outbox compactado: {len(kept)} mensagens mantidas")
+
+    # ---------- fila ----------
+
+    def enqueue(self, phone: str, body: str, key: str = None, **meta) -> Optional[str]:
+        """Enfileira uma mensagem; retorna o id, ou None se a chave já foi enfileirada.
+        meta: direcao, tipo_mensagem e regra gravados no lead quando a entrega der certo"""
+        key = key or message_key(phone, body)
+        with self._locked():
+            self._catch_up()
+            if key in self._messages:
+                log.info(f"Mensagem duplicada ignorada no outbox: {key}")
+                return None
+            now = time.time()
+            self._write({"op": "enfileirada", "id": key, "telefone": phone, "mensagem": body,
+                         "meta": meta, "criada_em": now, "tentativas": 0, "proxima": now})
+        return key
+
+    def requeue_dead(self, key: str = None) -> int:
+        """Devolve mensagens mortas à fila (uma pelo id, ou todas)"""
+        with self._locked():
+            self._catch_up()
+            keys = [k for k, entry in self._messages.items()
+                    if entry["estado"] == "morta" and (key is None or k == key)]
+            if keys:
+                now = time.time()
+                self._write(*({"op": "reenfileirada", "id": k, "ts": now} for k in keys))
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Profundidade da fila por estado"""
+        with self._locked():
+            self._catch_up()
+            counts = {"pendente": 0, "enviada": 0, "morta": 0}
+            retrying = 0
+            oldest = None
+            for entry in self._messages.values():
+                counts[entry["estado"]] += 1
+                if entry["estado"] == "pendente":
+                    retrying += entry["tentativas"] > 0
+                    oldest = min(oldest or entry["criada_em"], entry["criada_em"])
+            return {
+                "pendentes": counts["pendente"],
+                "em_reenvio": retrying,
+                "em_envio": len(self._in_flight),
+                "enviadas_recentes": counts["enviada"],
+                "mortas": counts["morta"],
+                "pendente_mais_antiga_s": round(time.time() - oldest, 1) if oldest else 0,
+                "drenando": self.draining,
+                "workers": self.workers if self.draining else 0,
+                "entregues_neste_processo": self.delivered,
+                "falhas_neste_processo": self.failed
+            }
+
+    def dead_letters(self) -> List[Dict[str, Any]]:
+        with self._locked():
+            self._catch_up()
+            return [entry for entry in self._messages.values() if entry["estado"] == "morta"]
+
+    # ---------- entrega ----------
+
+    def start(self, sender: Callable[[str, str], bool]):
+        """Inicia a drenagem; só o processo com o lock de drenagem envia, os outros só enfileiram"""
+        self.sender = sender
+        if self.running:
+            return
+        self.running = True
+        thread = threading.Thread(target=self._supervise, daemon=True)
+        thread.start()
+        self._threads = [thread]
+
+    def stop(self):
+        self.running = False
+        with self._ready:
+            self._ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _supervise(self):
+        """Disputa o lock de drenagem; com ele, lê o log periodicamente e compacta"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, DRAIN_LOCK_FILE), "a") as drain_lock:
+            while self.running and not self.draining:
+                try:
+                    fcntl.flock(drain_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.draining = True
+                except BlockingIOError:
+                    time.sleep(30)  # outro processo drena; assume se ele cair
+            if not self.running:
+                return
+
+            log.info(f"Outbox: drenando com {self.workers} workers ({self.log_path})")
+            for _ in range(self.workers):
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self._threads.append(worker)
+            while self.running:
+                try:
+                    with self._locked():
+                        self._catch_up()
+                        self._ready.notify_all()
+                    if self._settled >= COMPACT_AFTER:
+                        self._compact()
+                except Exception as e:
+                    log.error(f"Erro no outbox: {e}")
+                time.sleep(POLL_INTERVAL)
+
+    def _next_ready(self) -> Optional[Dict[str, Any]]:
+        """Próxima mensagem vencida (chamado com o lock); descarta entradas antigas do heap"""
+        while self._heap:
+            due, key = self._heap[0]
+            entry = self._messages.get(key)
+            if entry is None or entry["estado"] != "pendente" or entry["proxima"] != due or key in self._in_flight:
+                heapq.heappop(self._heap)
+                continue
+            if due > time.time():
+                return None
+            heapq.heappop(self._heap)
+            self._in_flight.add(key)
+            return entry
+        return None
+
+    def _wait_time(self) -> float:
+        if not self._heap:
+            return POLL_INTERVAL
+        return min(max(self._heap[0][0] - time.time(), 0.01), POLL_INTERVAL)
+
+    def _work(self):
+        while self.running:
+            with self._ready:
+                # Limite global: espera sem mexer na fila (a ordem de chegada se mantém)
+                wait = self.limiter.global_wait()
+                if wait > 0:
+                    self._ready.wait(wait)
+                    continue
+                entry = self._next_ready()
+                if entry is None:
+                    self._ready.wait(self._wait_time())
+                    continue
+                wait = self.limiter.try_acquire(entry["telefone"])
+                if wait > 0:
+                    # Sem ficha do destino: volta para a fila sem contar tentativa
+                    entry["proxima"] = time.time() + wait
+                    heapq.heappush(self._heap, (entry["proxima"], entry["id"]))
+                    self._in_flight.discard(entry["id"])
+                    continue
+            try:
+                self._deliver(entry)
+            except Exception as e:
+                log.error(f"Erro ao entregar {entry['id']}: {e}")
+            finally:
+                with self._lock:
+                    self._in_flight.discard(entry["id"])
+
+    def _deliver(self, entry: Dict[str, Any]):
+        error = None
+        permanent = False
+        try:
+            if not self.sender(entry["telefone"], entry["mensagem"]):
+                error = "envio recusado"
+        except PermanentSendError as e:
+            error, permanent = str(e), True
+        except Exception as e:
+            error = str(e) or type(e).__name__
+
+        now = time.time()
+        if error is None:
+            self.delivered += 1
+            # Entrega confirmada antes de tocar no lead: uma queda aqui não reenvia a mensagem
+            self._append({"op": "enviada", "id": entry["id"], "ts": now})
+            self._record_delivery(entry)
+            return
+
+        self.failed += 1
+        attempts = entry["tentativas"] + 1
+        if permanent or attempts >= self.max_attempts:
+            self._append({"op": "morta", "id": entry["id"], "ts": now, "erro": error, "tentativas": attempts})
+            with open(self.dead_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({**entry, "tentativas": attempts, "erro": error,
+                                    "morta_em": datetime.now().isoformat()}, ensure_ascii=False) + "\n")
+            log.error(f"Mensagem para {entry['telefone']} desistida após {attempts} tentativas: {error}")
+            return
+        # Backoff exponencial com jitter para não sincronizar reenvios
+        delay = min(self.base_delay * 2 ** (attempts - 1), MAX_DELAY) * random.uniform(0.8, 1.2)
+        self._append({"op": "falha", "id": entry["id"], "tentativas": attempts,
+                      "proxima": now + delay, "erro": error})
+        log.warning(f"Falha ao enviar para {entry['telefone']} (tentativa {attempts}): {error}; "
+                    f"nova tentativa em {delay:.0f}s")
+
+    def _record_delivery(self, entry: Dict[str, Any]):
+        """Grava no lead só o que foi entregue (histórico e, se for automação, a regra)"""
+        meta = entry.get("meta", {})
+        try:
+            lead_manager.add_interaction(entry["telefone"], meta.get("direcao", "Saída"),
+                                         entry["mensagem"], meta.get("tipo_mensagem", "texto"), meta.get("regra"))
+            if meta.get("regra"):
+                lead_manager.record_automation(entry["telefone"], meta["regra"])
+        except Exception as e:
+            log.error(f"Mensagem {entry['id']} entregue, mas não registrada no lead: {e}")
+
+
+# Instância global
+message_outbox = MessageOutbox()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fila persistente de mensagens de saída")
+    parser.add_argument("command", choices=["status", "mortas", "reenviar"])
+    parser.add_argument("--id", default=None, help="reenviar: só esta mensagem (padrão: todas as mortas)")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        print(json.dumps(message_outbox.stats(), ensure_ascii=False, indent=2))
+    elif args.command == "mortas":
+        for entry in message_outbox.dead_letters():
+            print(f"{entry['id']}  {entry['telefone']}  {entry['tentativas']} tentativas  {entry.get('erro')}")
+    else:
+        print(f"{message_outbox.requeue_dead(args.id)} mensagens devolvidas à fila")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+# migrate_leads.py
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from typing import Dict, List, Optional, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+from event_store import LeadEventStore
+from lead_manager import new_lead_document, status_entered_ts
+from lead_snapshot import record_epoch, to_epoch, history_counters
+
+log = logging.getLogger("fiat-whatsapp")
+
+CHECKPOINT_FILE = "_migracao.jsonl"
+
+
+def checksum(lead: Dict[str, Any]) -> str:
+    """SHA-256 da forma canônica do documento (chaves ordenadas, sem espaços)"""
+    canonical = json.dumps(lead, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def normalize_lead(raw: Any, phone_key: str) -> Dict[str, Any]:
+    """Valida o documento e completa campos ausentes com os padrões do LeadManager"""
+    if not isinstance(raw, dict):
+        raise ValueError("documento não é um objeto JSON")
+
+    created = raw.get("data_criacao") or raw.get("ultima_interacao") or ""
+    lead = new_lead_document(str(raw.get("telefone") or "+" + phone_key), created, to_epoch(created))
+    lead.update(raw)
+    lead["telefone"] = str(lead["telefone"] or "+" + phone_key)
+    lead["status"] = str(lead.get("status") or "Novo")
+
+    for key in ("notas", "historico", "agendamentos", "tags"):
+        if not isinstance(lead.get(key), list):
+            lead[key] = []
+
+    historico = []
+    for interaction in lead["historico"]:
+        if not isinstance(interaction, dict) or "mensagem" not in interaction:
+            continue
+        interaction = dict(interaction)
+        interaction["mensagem"] = str(interaction["mensagem"] or "")
+        interaction.setdefault("direcao", "Entrada")
+        interaction.setdefault("tipo_mensagem", "texto")
+        interaction.setdefault("timestamp", "")
+        interaction["ts"] = record_epoch(interaction, "timestamp", "ts")
+        historico.append(interaction)
+    lead["historico"] = historico
+    lead["contadores"] = history_counters(lead)
+
+    try:
+        lead["score"] = max(0, min(int(lead.get("score") or 0), 200))
+    except (TypeError, ValueError):
+        lead["score"] = 0
+
+    if not lead.get("ultima_interacao"):
+        lead["ultima_interacao"] = historico[-1]["timestamp"] if historico else lead["data_criacao"]
+    lead["data_criacao_ts"] = record_epoch(lead, "data_criacao")
+    lead["ultima_interacao_ts"] = record_epoch(lead, "ultima_interacao")
+    if not raw.get("status_desde_ts"):
+        # Sem o campo, vale a última nota de mudança de status (ou a criação)
+        lead.pop("status_desde_ts", None)
+        lead["status_desde_ts"] = status_entered_ts(lead)
+    return lead
+
+
+def _load_and_normalize(path: str) -> Tuple[str, str, Optional[Dict[str, Any]], Optional[str], Optional[str]]:
+    """Executado nos workers: lê, valida e normaliza um arquivo de lead"""
+    name = os.path.basename(path)
+    phone_key = name[:-len(".json")]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lead = normalize_lead(json.load(f), phone_key)
+        return name, phone_key, lead, checksum(lead), None
+    except Exception as e:
+        return name, phone_key, None, None, str(e)
+
+
+class EventStoreTarget:
+    """Destino: log de eventos (LEAD_STORE=eventos), um evento lead_created por lead"""
+
+    def __init__(self, dest_dir: str):
+        self.base_dir = os.path.join(dest_dir, "_eventos")
+        self.store = LeadEventStore(self.base_dir, snapshot_every=0)
+
+    def insert_batch(self, records: List[Tuple[str, Dict[str, Any]]]):
+        self.store.append_many([(phone_key, "lead_created", lead) for phone_key, lead in records])
+
+    def reader(self) -> LeadEventStore:
+        return LeadEventStore(self.base_dir, snapshot_every=0)
+
+    def keys(self, reader: LeadEventStore) -> List[str]:
+        return reader.phones()
+
+    def get(self, reader: LeadEventStore, phone_key: str) -> Optional[Dict[str, Any]]:
+        return reader.get_lead(phone_key)
+
+    def existing_data(self) -> Optional[str]:
+        """Log já com eventos: migrar de novo sem checkpoint reanexaria lead_created
+        por cima dos eventos posteriores, então a migração recusa"""
+        path = self.store.log_path
+        return path if os.path.exists(path) and os.path.getsize(path) > 0 else None
+
+
+class FilesTarget:
+    """Destino: outro diretório de arquivos JSON, já normalizados"""
+
+    def __init__(self, dest_dir: str):
+        self.dest_dir = dest_dir
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def insert_batch(self, records: List[Tuple[str, Dict[str, Any]]]):
+        for phone_key, lead in records:
+            path = os.path.join(self.dest_dir, f"{phone_key}.json")
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(lead, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+
+    def reader(self) -> str:
+        return self.dest_dir
+
+    def keys(self, reader: str) -> List[str]:
+        return [name[:-len(".json")] for name in os.listdir(reader) if name.endswith(".json")]
+
+    def get(self, reader: str, phone_key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(reader, f"{phone_key}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def existing_data(self) -> Optional[str]:
+        return None  # regravar um arquivo é idempotente
+
+
+TARGETS = {
+    "eventos": EventStoreTarget,
+    "arquivos": FilesTarget
+}
+
+
+def _load_checkpoint(path: str) -> Dict[str, Dict[str, str]]:
+    """Arquivos já migrados (nome -> telefone e checksum) para retomar a migração"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # linha truncada por interrupção
+            done[entry["arquivo"]] = entry
+    return done
+
+
+def migrate(source_dir: str, target, checkpoint_path: str, workers: int = 4, batch_size: int = 500) -> Dict[str, Any]:
+    """Migra os arquivos pendentes em lotes, registrando o progresso no checkpoint"""
+    done = _load_checkpoint(checkpoint_path)
+    names = sorted(name for name in os.listdir(source_dir) if name.endswith(".json"))
+    pending = [os.path.join(source_dir, name) for name in names if name not in done]
+    stats = {"source": len(names), "skipped": len(names) - len(pending), "migrated": 0, "errors": []}
+    log.info(f"Migração: {len(pending)} pendentes, {stats['skipped']} já migrados")
+
+    started = time.perf_counter()
+    batch: List[Tuple[str, str, Dict[str, Any], str]] = []
+
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        def flush():
+            if not batch:
+                return
+            target.insert_batch([(phone_key, lead) for _, phone_key, lead, _ in batch])
+            # Checkpoint só depois do lote gravado: numa interrupção entre os dois,
+            # o lote é reenviado na retomada (lead_created/arquivo são idempotentes)
+            for name, phone_key, _, sha in batch:
+                checkpoint.write(json.dumps({"arquivo": name, "phone": phone_key, "sha256": sha}) + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            stats["migrated"] += len(batch)
+            elapsed = time.perf_counter() - started
+            log.info(f"{stats['migrated']}/{len(pending)} leads ({stats['migrated'] / elapsed:.0f} leads/s)")
+            batch.clear()
+
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            results = pool.map(_load_and_normalize, pending, chunksize=64)
+        else:
+            pool = None
+            results = map(_load_and_normalize, pending)
+
+        try:
+            for name, phone_key, lead, sha, error in results:
+                if error:
+                    log.warning(f"Lead ignorado ({name}): {error}")
+                    stats["errors"].append({"arquivo": name, "erro": error})
+                    continue
+                batch.append((name, phone_key, lead, sha))
+                if len(batch) >= batch_size:
+                    flush()
+            flush()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 2)
+    stats["leads_per_second"] = round(stats["migrated"] / elapsed, 1) if elapsed > 0 else 0
+    return stats
+
+
+def verify(target, checkpoint_path: str) -> Dict[str, Any]:
+    """Confere contagem e checksum de cada lead migrado, relendo do destino"""
+    done = _load_checkpoint(checkpoint_path)
+    reader = target.reader()
+    target_keys = set(target.keys(reader))
+
+    missing, mismatched = [], []
+    for entry in done.values():
+        if entry["phone"] not in target_keys:
+            missing.append(entry["arquivo"])
+            continue
+        lead = target.get(reader, entry["phone"])
+        if lead is None or checksum(lead) != entry["sha256"]:
+            mismatched.append(entry["arquivo"])
+
+    return {
+        "checkpoint": len(done),
+        "target": len(target_keys),
+        "missing": missing,
+        "mismatched": mismatched,
+        "ok": not missing and not mismatched
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migra leads/*.json para outro backend de armazenamento")
+    parser.add_argument("--source", default="leads", help="diretório com um JSON por telefone")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="eventos")
+    parser.add_argument("--dest", help="diretório de destino (eventos: <dest>/_eventos)")
+    parser.add_argument("--in-place", action="store_true",
+                        help="grava no próprio diretório de origem (eventos: <origem>/_eventos)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--restart", action="store_true", help="ignora o checkpoint e migra tudo de novo")
+    parser.add_argument("--verify-only", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    if args.in_place:
+        if args.dest and os.path.abspath(args.dest) != os.path.abspath(args.source):
+            parser.error("--in-place grava na origem; não informe um --dest diferente")
+        args.dest = args.source
+    elif not args.dest:
+        parser.error("informe --dest (ou --in-place para gravar na própria origem)")
+    elif os.path.abspath(args.dest) == os.path.abspath(args.source):
+        parser.error("--dest igual a --source: use --in-place se é isso mesmo")
+
+    target = TARGETS[args.target](args.dest)
+    checkpoint_path = os.path.join(args.dest, CHECKPOINT_FILE)
+    if not args.verify_only and (args.restart or not os.path.exists(checkpoint_path)):
+        existing = target.existing_data()
+        if existing:
+            parser.error(f"{existing} já tem eventos: migrar sem checkpoint (ou com --restart) "
+                         f"reanexaria lead_created por cima deles; apague-o para migrar do zero")
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if not args.verify_only:
+        stats = migrate(args.source, target, checkpoint_path, args.workers, args.batch_size)
+        print(f"Origem: {stats['source']} | migrados: {stats['migrated']} | já migrados: {stats['skipped']} | "
+              f"erros: {len(stats['errors'])} | {stats['seconds']}s ({stats['leads_per_second']} leads/s)")
+
+    result = verify(target, checkpoint_path)
+    print(f"Verificação: {result['checkpoint']} no checkpoint, {result['target']} no destino, "
+          f"{len(result['missing'])} ausentes, {len(result['mismatched'])} com checksum divergente")
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+# rate_limiter.py
+import os
+import time
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any
+
+# Destinos ociosos (balde cheio) são descartados quando o dicionário passa disto
+MAX_TRACKED_DESTINATIONS = 10_000
+
+# Balde global compartilhado entre processos: (fichas, atualizado) no diretório do outbox
+STATE_FILE = "limite_global.bin"
+STATE = struct.Struct("<dd")
+
+
+class TokenBucket:
+    """Balde de fichas: `rate` por segundo, acumulando até `capacity` (rajada)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def _refill(self, now: float):
+        # Relógio de parede (o estado global é lido por outros processos); recuo não gera fichas
+        self.tokens = min(self.capacity, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Segundos até haver uma ficha (0 se já há)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Limite de envios global e por destino. O balde global fica num arquivo sob flock,
+    compartilhado por todos os processos (workers do gunicorn) que usam o mesmo diretório;
+    os baldes por destino são do processo (só o outbox os usa, e ele drena em um processo só)"""
+
+    def __init__(self, per_second: float = None, per_destination_per_minute: float = None,
+                 base_dir: str = None):
+        per_second = per_second or float(os.getenv("TWILIO_MAX_PER_SECOND", "10"))
+        per_minute = per_destination_per_minute or float(os.getenv("TWILIO_MAX_PER_DESTINATION_PER_MINUTE", "6"))
+        self.base_dir = base_dir or os.getenv("OUTBOX_DIR", os.path.join("data", "outbox"))
+        self.state_path = os.path.join(self.base_dir, STATE_FILE)
+        self.global_bucket = TokenBucket(per_second, max(per_second, 1))
+        self.destination_rate = per_minute / 60
+        self.destination_burst = max(per_minute / 2, 1)
+        self._destinations: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.throttled = 0
+
+    def _destination(self, key: str, now: float) -> TokenBucket:
+        bucket = self._destinations.get(key)
+        if bucket is None:
+            if len(self._destinations) >= MAX_TRACKED_DESTINATIONS:
+                self._destinations = {k: b for k, b in self._destinations.items() if not b.is_full(now)}
+            bucket = self._destinations[key] = TokenBucket(self.destination_rate, self.destination_burst)
+        return bucket
+
+    @contextmanager
+    def _shared_global(self, exclusive: bool = True):
+        """Carrega o balde global do arquivo sob flock; quem pegou ficha chama _store antes de sair.
+        Aberto a cada uso: um descritor herdado pelo fork dividiria o lock entre os workers"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            raw = os.pread(fd, STATE.size, 0)
+            if len(raw) == STATE.size:
+                self.global_bucket.tokens, self.global_bucket.updated = STATE.unpack(raw)
+            else:
+                # Arquivo novo: balde cheio
+                self.global_bucket.tokens, self.global_bucket.updated = self.global_bucket.capacity, time.time()
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _store(self, fd: int):
+        os.pwrite(fd, STATE.pack(self.global_bucket.tokens, self.global_bucket.updated), 0)
+
+    def global_wait(self) -> float:
+        """Segundos até haver ficha global (sem pegá-la)"""
+        with self._lock, self._shared_global(exclusive=False):
+            return self.global_bucket.wait_time(time.time())
+
+    def try_acquire_global(self) -> float:
+        """Só a ficha global (respostas a mensagens do cliente não passam pelo balde do
+        destino); se faltar, não pega e retorna quantos segundos esperar"""
+        with self._lock, self._shared_global() as fd:
+            wait = self.global_bucket.wait_time(time.time())
+            if wait > 0:
+                self.throttled += 1
+                return wait
+            self.global_bucket.take()
+            self._store(fd)
+            self.granted += 1
+            return 0.0
+    
+    def try_acquire(self, key: str) -> float:
+        """Pega uma ficha global e uma do destino; se faltar alguma, não pega nenhuma e
+        retorna quantos segundos esperar"""
+        with self._lock, self._shared_global() as fd:
+            now = time.time()
+            destination = self._destination(key, now)
+            wait = max(self.global_bucket.wait_time(now), destination.wait_time(now))
+            if wait > 0:
+                self.throttled += 1
+                return wait
+            self.global_bucket.take()
+            self._store(fd)
+            destination.take()
+            self.granted += 1
+            return 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock, self._shared_global(exclusive=False):
+            self.global_bucket._refill(time.time())
+            return {
+                "max_por_segundo": self.global_bucket.rate,
+                "max_por_destino_por_minuto": round(self.destination_rate * 60, 2),
+                "fichas_globais": round(self.global_bucket.tokens, 2),
+                "destinos_monitorados": len(self._destinations),
+                "liberados": self.granted,
+                "limitados": self.throttled
+            }
+
+
+# Instância global (envios pelo Twilio)
+twilio_limiter = RateLimiter()
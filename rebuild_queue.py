@@ -0,0 +1,72 @@
+# rebuild_queue.py
+import os
+import json
+import logging
+from typing import Any, Dict, List
+
+log = logging.getLogger("fiat-whatsapp")
+
+MARKER_SUFFIX = ".reconstruindo"
+QUEUE_SUFFIX = ".fila.jsonl"
+
+
+class RebuildQueue:
+    """Alterações de leads que chegam enquanto agregados/rollups são reconstruídos.
+    A reconstrução lê cada lead numa revisão; depois de gravar o resultado, só as
+    alterações de revisão maior que a lida são somadas (as outras já estão nele).
+    Os métodos são chamados com o flock do dono: begin/drain com o exclusivo,
+    active/push com o compartilhado."""
+
+    def __init__(self, base_dir: str, name: str):
+        self.marker_path = os.path.join(base_dir, name + MARKER_SUFFIX)
+        self.path = os.path.join(base_dir, name + QUEUE_SUFFIX)
+
+    def begin(self):
+        """Marca a reconstrução em andamento (a partir daqui as alterações vão para a fila)"""
+        with open(self.marker_path, "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+        open(self.path, "w").close()
+
+    def active(self) -> bool:
+        """Reconstrução em andamento; a de um processo que morreu no meio não conta"""
+        try:
+            with open(self.marker_path, "r", encoding="utf-8") as f:
+                pid = int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def push(self, lead: Dict[str, Any], payload: Any):
+        """Guarda a alteração com a revisão do lead que a produziu"""
+        entry = {"telefone": lead.get("telefone", ""), "revisao": lead.get("revisao", 0), "dados": payload}
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def drain(self, revisions: Dict[str, int]) -> List[Any]:
+        """Alterações posteriores à revisão lida de cada lead (leads não lidos: todas);
+        encerra a reconstrução"""
+        pending = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        continue
+                    entry = json.loads(line)
+                    if entry["revisao"] > revisions.get(entry["telefone"], 0):
+                        pending.append(entry["dados"])
+        except FileNotFoundError:
+            pass
+        for path in (self.path, self.marker_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if pending:
+            log.info(f"{len(pending)} alterações feitas durante a reconstrução reaplicadas")
+        return pending
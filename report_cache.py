@@ -0,0 +1,97 @@
+# report_cache.py
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from analytics_engine import analytics_engine
+
+log = logging.getLogger("fiat-whatsapp")
+
+
+class CachedReport:
+    """Relatório já serializado, com ETag e momento da geração"""
+    __slots__ = ("data", "body", "etag", "generated_at")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.body = json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.generated_at = time.time()
+
+    def age(self) -> float:
+        return time.time() - self.generated_at
+
+
+class ReportCache:
+    """Cache do relatório com TTL e stale-while-revalidate"""
+
+    def __init__(self, build: Callable[[], Dict[str, Any]], ttl: float = 60, stale: float = 300):
+        self.build = build
+        self.ttl = ttl
+        self.stale = stale
+        self._report: Optional[CachedReport] = None
+        self._build_lock = threading.Lock()    # uma geração por vez
+        self._refreshing = False
+        self._state_lock = threading.Lock()
+
+    def get(self) -> CachedReport:
+        """Retorna o relatório do cache, disparando a revalidação quando vencido"""
+        # Até ttl: servido direto. Entre ttl e ttl + stale: a versão antiga segue
+        # sendo servida enquanto uma thread gera a nova. Depois disso (ou sem
+        # relatório algum) a requisição espera a geração
+        report = self._report
+        if report is not None:
+            age = report.age()
+            if age < self.ttl:
+                return report
+            if age < self.ttl + self.stale:
+                self._refresh_in_background()
+                return report
+
+        return self.refresh(expected=report)
+
+    def refresh(self, expected: Optional[CachedReport] = None) -> CachedReport:
+        """Gera o relatório agora (quem chegar durante a geração reaproveita o resultado)"""
+        with self._build_lock:
+            # Outra thread já trocou o relatório enquanto esperávamos o lock
+            if self._report is not None and self._report is not expected:
+                return self._report
+
+            started = time.perf_counter()
+            report = CachedReport(self.build())
+            self._report = report
+            log.info(f"Relatório de analytics gerado em {time.perf_counter() - started:.2f}s (etag {report.etag[:8]})")
+            return report
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        expected = self._report
+        threading.Thread(target=self._background_refresh, args=(expected,), daemon=True).start()
+
+    def _background_refresh(self, expected: Optional[CachedReport]):
+        try:
+            self.refresh(expected)
+        except Exception as e:
+            log.error(f"Erro ao atualizar relatório de analytics em segundo plano: {e}")
+        finally:
+            with self._state_lock:
+                self._refreshing = False
+
+    def invalidate(self):
+        """Descarta o relatório atual (a próxima leitura gera um novo)"""
+        self._report = None
+
+
+# Instância global
+report_cache = ReportCache(
+    analytics_engine.generate_full_report,
+    ttl=float(os.getenv("ANALYTICS_CACHE_TTL", "60")),
+    stale=float(os.getenv("ANALYTICS_CACHE_STALE", "300"))
+)
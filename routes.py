@@ -3,7 +3,7 @@ import os, csv, json, logging, threading, random, re
 from datetime import datetime, timedelta
 from xml.sax.saxutils import escape as xml_escape
 
-from flask import Blueprint, current_app, request, Response, jsonify, render_template, abort
+from flask import Blueprint, current_app, request, Response, jsonify, render_template, abort, stream_with_context
 from twilio.rest import Client as TwilioClient
 
 from catalog import tentar_responder_com_catalogo
@@ -16,6 +16,10 @@ from lead_manager import lead_manager
 from ai_humanizer import ai_humanizer
 from automation_engine import automation_engine
 from analytics_engine import analytics_engine
+from report_cache import report_cache
+from lead_export import export_stream, parse_since
+from message_outbox import message_outbox, PermanentSendError
+from rate_limiter import twilio_limiter
 
 bp = Blueprint("routes", __name__)
 log = logging.getLogger("fiat-whatsapp")
@@ -34,13 +38,19 @@ def _twilio_client():
     except Exception:
         log.exception("Falha ao criar cliente Twilio"); return None
 
-def send_via_twilio_api(to_phone_e164: str, body: str) -> bool:
+def send_via_twilio_api(to_phone_e164: str, body: str, acquired: bool = False) -> bool:
+    """Envia pelo Twilio (acquired: fichas já pegas pelo chamador, ex.: o outbox)"""
     if not current_app.config.get("TWILIO_WHATSAPP_FROM"):
         return False
     
     client = _twilio_client()
     if not client: return False
     
+    # Sem esperar: quem está numa requisição não pode segurar o worker
+    if not acquired and twilio_limiter.try_acquire_global() > 0:
+        log.warning(f"Envio para {to_phone_e164} recusado: limite global de envios do Twilio")
+        return False
+    
     try:
         to_fmt = f"whatsapp:{to_phone_e164}" if not str(to_phone_e164).startswith("whatsapp:") else to_phone_e164
         msg = client.messages.create(
@@ -54,6 +64,36 @@ def send_via_twilio_api(to_phone_e164: str, body: str) -> bool:
         log.exception("Falha ao enviar WhatsApp via Twilio API")
         return False
 
+def _outbox_sender(app):
+    """Envio do outbox fora de requisições: usa o contexto da aplicação para o Twilio"""
+    def send(phone: str, body: str) -> bool:
+        with app.app_context():
+            if not (app.config.get("TWILIO_WHATSAPP_FROM") and app.config.get("TWILIO_ACCOUNT_SID")
+                    and app.config.get("TWILIO_AUTH_TOKEN")):
+                raise PermanentSendError("Twilio não configurado")
+            return send_via_twilio_api(phone, body, acquired=True)
+    return send
+
+@bp.record_once
+def _start_outbox(setup_state):
+    """Inicia a drenagem do outbox quando o blueprint é registrado"""
+    try:
+        message_outbox.start(_outbox_sender(setup_state.app))
+    except Exception as e:
+        log.error(f"Erro ao iniciar outbox: {e}")
+
+@bp.record_once
+def _start_automation(setup_state):
+    """Com AUTOMATION_ENABLED ligado, cada worker disputa a liderança da automação e só o
+    eleito roda o agendador. Desligado por padrão: a automação envia mensagens a clientes"""
+    if os.getenv("AUTOMATION_ENABLED", "false").lower() not in ("1", "true", "sim"):
+        log.info("Automação desligada (AUTOMATION_ENABLED=true para ligar)")
+        return
+    try:
+        automation_engine.start_with_leader_election()
+    except Exception as e:
+        log.error(f"Erro ao iniciar automação: {e}")
+
 @bp.route("/whatsapp", methods=["GET"])
 def whatsapp_test():
     return "Webhook WhatsApp funcionando! Use POST para enviar mensagens."
@@ -82,11 +122,14 @@ def whatsapp_webhook():
         # 2. Gerar resposta humanizada
         response_text = ai_humanizer.generate_response(from_number, user_message)
         
-        # 3. Enviar resposta
+        # 3. Enviar resposta: na hora se houver ficha global (respostas não usam o limite
+        # por destino); sem ficha, vai para o outbox em vez de segurar a requisição
         if response_text:
-            success = send_via_twilio_api(from_number, response_text)
-            if success:
-                lead_manager.add_interaction(from_number, "Saída", response_text)
+            if twilio_limiter.try_acquire_global() == 0:
+                if send_via_twilio_api(from_number, response_text, acquired=True):
+                    lead_manager.add_interaction(from_number, "Saída", response_text)
+            else:
+                message_outbox.enqueue(from_number, response_text, direcao="Saída")
         
         return Response("", status=200)
         
@@ -141,7 +184,8 @@ def update_lead_status(phone):
         new_status = data.get('status')
         
         if new_status:
-            lead_manager.update_lead_status(phone, new_status)
+            if lead_manager.update_status(phone, new_status) is None:
+                return jsonify({"error": "Lead não encontrado"}), 404
             return jsonify({"success": True})
         
         return jsonify({"error": "Status não fornecido"}), 400
@@ -158,10 +202,9 @@ def send_manual_message():
         message = data.get('message')
         
         if phone and message:
-            success = send_via_twilio_api(phone, message)
-            if success:
-                lead_manager.add_interaction(phone, "Saída Manual", message)
-                return jsonify({"success": True})
+            # Vai pelo outbox: limite de envios, reenvio e histórico só após a entrega
+            key = message_outbox.enqueue(phone, message, direcao="Saída Manual")
+            return jsonify({"success": True, "queued": key is not None, "id": key})
         
         return jsonify({"error": "Dados incompletos"}), 400
         
@@ -223,12 +266,21 @@ def criar_dados_teste():
 # ========================
 # Relatórios e Analytics
 # ========================
+def _conditional(response: Response, report) -> Response:
+    """ETag do relatório em cache: If-None-Match igual responde 304 sem corpo"""
+    response.set_etag(report.etag)
+    response.headers["Cache-Control"] = "no-cache"  # sempre revalidar com o ETag
+    return response.make_conditional(request)
+
 @bp.route("/relatorios")
 def relatorios():
     """Página de relatórios e analytics"""
     try:
-        analytics = analytics_engine.generate_report()
-        return render_template('relatorios.html', analytics=analytics)
+        report = report_cache.get()
+        if report.etag in request.if_none_match:
+            return _conditional(Response(status=304), report)
+        html = render_template('relatorios.html', analytics=report.data)
+        return _conditional(Response(html, mimetype="text/html"), report)
     except Exception as e:
         return f"Erro: {e}", 500
 
@@ -236,8 +288,115 @@ def relatorios():
 def api_analytics():
     """API para dados de analytics"""
     try:
-        analytics = analytics_engine.generate_report()
-        return jsonify(analytics)
+        report = report_cache.get()
+        return _conditional(Response(report.body, mimetype="application/json"), report)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# Limite do intervalo pedido: cada dia (ou hora) vira um balde na série dos rollups
+MAX_RANGE_DAYS = 366
+MAX_HOURLY_RANGE_DAYS = 31
+
+def _date_range(max_days: int = MAX_RANGE_DAYS):
+    """Intervalo ?inicio=&fim= (AAAA-MM-DD); padrão: últimos 30 dias"""
+    def parse(name):
+        try:
+            return datetime.strptime(request.args[name], "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError(f"Data inválida em '{name}': {request.args[name]} (use AAAA-MM-DD)")
+    end = parse("fim") if request.args.get("fim") else datetime.now().date()
+    start = parse("inicio") if request.args.get("inicio") else end - timedelta(days=29)
+    if start > end:
+        raise ValueError("Intervalo inválido: inicio depois de fim")
+    if (end - start).days + 1 > max_days:
+        raise ValueError(f"Intervalo longo demais: {(end - start).days + 1} dias (máximo {max_days})")
+    return start, end
+
+@bp.route("/api/analytics/tendencias")
+def api_analytics_tendencias():
+    """Série por dia/hora lida dos rollups"""
+    try:
+        granularity = request.args.get("granularidade", "dia")
+        if granularity not in ("dia", "hora"):
+            return jsonify({"error": "Granularidade inválida (dia ou hora)"}), 400
+        start, end = _date_range(MAX_HOURLY_RANGE_DAYS if granularity == "hora" else MAX_RANGE_DAYS)
+        return jsonify(analytics_engine.get_trends(start, end, granularity))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/api/outbox/status")
+def api_outbox_status():
+    """Profundidade da fila de envio e estado do limitador do Twilio"""
+    try:
+        return jsonify({"fila": message_outbox.stats(), "limite": twilio_limiter.stats()})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@bp.route("/api/automation/leader")
+def api_automation_leader():
+    """Qual processo roda a automação e o último heartbeat dele"""
+    try:
+        return jsonify({**automation_engine.lease.status(), "executando": automation_engine.running})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/api/analytics/query")
+def api_analytics_query():
+    """Consulta pequena: ?metrica=&agrupar=status,hora&vendedor=&status=&veiculo=&hora=&inicio=&fim="""
+    try:
+        metric = request.args.get("metrica", "")
+        group_by = [name for name in request.args.get("agrupar", "").split(",") if name]
+        filters = {name: [value for value in request.args[name].split(",") if value]
+                   for name in ("vendedor", "status", "veiculo", "hora") if request.args.get(name)}
+        hourly = "hora" in group_by or "hora" in filters
+        start, end = _date_range(MAX_HOURLY_RANGE_DAYS if hourly else MAX_RANGE_DAYS)
+        return jsonify(analytics_engine.query(metric, start, end, group_by, filters))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/api/analytics/tempo-resposta")
+def api_analytics_tempo_resposta():
+    """Percentis do tempo de resposta no intervalo, por vendedor e por dia"""
+    try:
+        start, end = _date_range()
+        return jsonify(analytics_engine.get_response_times(start, end, by_day=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@bp.route("/api/analytics/coortes")
+def api_analytics_coortes():
+    """Coortes semanais de criação de leads (?semanas=12)"""
+    try:
+        weeks = int(request.args.get("semanas", 12))
+        if not 1 <= weeks <= 104:
+            return jsonify({"error": "semanas deve estar entre 1 e 104"}), 400
+        return jsonify(analytics_engine.get_cohorts(weeks))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ========================
+# Exportação (BI)
+# ========================
+@bp.route("/api/export/<dataset>")
+def api_export(dataset):
+    """Exporta leads ou interações em streaming (?desde=epoch|ISO&formato=csv|parquet)"""
+    try:
+        chunks, meta = export_stream(lead_manager, dataset, parse_since(request.args.get("desde")),
+                                     request.args.get("formato", "csv"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    mimetype = "application/gzip" if meta["filename"].endswith(".gz") else "application/vnd.apache.parquet"
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{meta["filename"]}"'
+    response.headers["X-Export-Cursor"] = str(meta["cursor"])
+    return response
@@ -0,0 +1,112 @@
+# test_automation_engine.py
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+from bench_data import generate_leads
+from lead_manager import LeadManager
+from lead_snapshot import LeadHeader
+from automation_engine import AutomationEngine
+from automation_rules import DEFAULT_RULES
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """Motor sobre uma base sintética própria (regras padrão, sem arquivo de regras)"""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path / "data"))
+    now = datetime.now().replace(microsecond=0)
+    generate_leads(str(tmp_path / "leads"), 500, now=now)
+    engine = AutomationEngine(LeadManager(str(tmp_path / "leads"), store_mode="arquivos"))
+    engine.now = now.timestamp()
+    return engine
+
+
+def test_simulate_matches_real_pass(engine):
+    """Simulação e uma passada real no mesmo instante enfileiram as mesmas mensagens"""
+    now = engine.now
+    simulated = engine.simulate(hours=1 / 3600, start=now, rules=DEFAULT_RULES)
+
+    sent = []
+    engine._send_automated_message = lambda lead, rule: sent.append((lead["telefone"], rule["name"]))
+    engine.running = True
+    engine._schedule_all()
+    for phone, rule_name in engine._pop_due(now):
+        engine._run_due(phone, rule_name, now)
+
+    assert sent, "a base sintética deveria ter prazos vencidos"
+    assert {name: rule["envios"] for name, rule in simulated["regras"].items()} == \
+        {rule["name"]: Counter(name for _, name in sent)[rule["name"]] for rule in DEFAULT_RULES}
+    # No máximo uma mensagem automática por lead na passada
+    assert max(Counter(phone for phone, _ in sent).values()) == 1
+
+
+def test_due_times_follow_status_changes(tmp_path, monkeypatch):
+    """Os prazos da agenda acompanham as mudanças de status e o agendamento do lead"""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path / "data"))
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    engine = AutomationEngine(manager)
+    engine.running = True  # agenda pelo observador, sem a thread do loop
+    manager.add_observer(engine)
+    phone = "+5547999990010"
+
+    manager.create_or_update_lead(phone, nome="Cliente")
+    lead = manager.add_interaction(phone, "Entrada", "Oi, quero saber do Pulse")
+    assert engine._due[(phone, "follow_up_inativo_5h")] == lead["ultima_interacao_ts"] + 5 * 3600
+    assert (phone, "lembrete_test_drive") not in engine._due
+
+    manager.update_status(phone, "Vendido")
+    assert (phone, "follow_up_inativo_5h") not in engine._due
+
+    appointment = (datetime.now() + timedelta(days=3)).replace(second=0, microsecond=0)
+    manager.add_note(phone, f"Test drive agendado para {appointment:%d/%m/%Y} às {appointment:%H:%M}")
+    lead = manager.update_status(phone, "Agendado")
+    assert engine._due[(phone, "lembrete_test_drive")] == appointment.timestamp() - 24 * 3600
+    assert engine._due[(phone, "follow_up_inativo_5h")] == lead["ultima_interacao_ts"] + 5 * 3600
+
+
+def test_scheduling_header_matches_full_header(engine):
+    """O cabeçalho O(1) do observador tem os mesmos campos que as condições usam"""
+    fields = ("telefone", "status", "score", "ultima_interacao_ts", "follow_ups", "intencoes")
+    for lead in engine.lead_manager.get_all_leads():
+        full, cheap = LeadHeader.from_lead(lead), LeadHeader.from_lead(lead, signals=False)
+        assert [getattr(cheap, f) for f in fields] == [getattr(full, f) for f in fields]
+
+
+def test_appointment_reminder_needs_an_appointment(tmp_path, monkeypatch):
+    """Agendado sem nota de test drive: o prazo só com o cabeçalho não vira lembrete"""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path / "data"))
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    engine = AutomationEngine(manager)
+    phone = "+5547999990011"
+    manager.create_or_update_lead(phone, nome="Cliente")
+    manager.update_status(phone, "Agendado")
+
+    sent = []
+    engine._send_automated_message = lambda lead, rule: sent.append(rule["name"])
+    engine.running = True
+    engine._schedule_all()
+    assert (phone, "lembrete_test_drive") in engine._due
+    now = time.time()
+    for pair in engine._pop_due(now):
+        engine._run_due(*pair, now)
+    assert "lembrete_test_drive" not in sent
+    assert (phone, "lembrete_test_drive") not in engine._due
+
+
+def test_no_recent_qualification_holds_for_a_week(tmp_path, monkeypatch):
+    """Regra com no_recent_qualification não volta ao lead antes de 7 dias"""
+    monkeypatch.setenv("DATA_DIR", str(tmp_path / "data"))
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    engine = AutomationEngine(manager)
+    engine.running = True
+    manager.add_observer(engine)
+    phone = "+5547999990012"
+    manager.create_or_update_lead(phone, nome="Cliente")
+    manager.create_or_update_lead(phone, score=60)
+    assert engine._due[(phone, "qualificacao_lead_quente")] == 0
+
+    lead = manager.record_automation(phone, "qualificacao_lead_quente")
+    sent = datetime.fromisoformat(lead["automations"]["qualificacao_lead_quente"]).timestamp()
+    assert engine._due[(phone, "qualificacao_lead_quente")] == sent + 7 * 24 * 3600
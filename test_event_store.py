@@ -0,0 +1,65 @@
+# test_event_store.py
+import os
+import json
+
+import pytest
+
+from event_store import LeadEventStore
+from lead_manager import LeadManager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    """Base em modo eventos com snapshot no meio do log e eventos depois dele"""
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="eventos")
+    phones = [f"+55479999{i:05d}" for i in range(40)]
+    for i, phone in enumerate(phones):
+        manager.create_or_update_lead(phone, nome=f"Cliente {i}")
+        manager.add_interaction(phone, "Entrada", "Quero saber o preço do Pulse à vista")
+        manager.add_interaction(phone, "Saída", "Olá! Já te passo os valores.")
+    manager.event_store.write_snapshot()
+
+    for i, phone in enumerate(phones):
+        if i % 2:
+            manager.add_interaction(phone, "Entrada", "Posso agendar um test drive do Toro?")
+            manager.update_status(phone, "Agendado")
+            manager.add_note(phone, "Test drive agendado para 25/10/2026 às 10:00", author="Vendedor")
+        if i % 3 == 0:
+            manager.record_automation(phone, "follow_up_inativo_5h")
+            manager.update_status(phone, "Perdido")
+    manager.create_or_update_lead("+5547988887777", nome="Depois do snapshot")
+    return manager
+
+
+def by_phone(leads):
+    return {lead["telefone"]: lead for lead in leads}
+
+
+def load_dir(path):
+    leads = []
+    for filename in os.listdir(path):
+        with open(os.path.join(path, filename), encoding="utf-8") as f:
+            leads.append(json.load(f))
+    return leads
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_rebuild_matches_live_state(manager, tmp_path, workers):
+    live = by_phone(manager.get_all_leads())
+    out = str(tmp_path / f"rebuild_{workers}")
+
+    assert manager.event_store.rebuild(out, workers=workers) == len(live) == 41
+    assert by_phone(load_dir(out)) == live
+
+
+def test_fresh_store_replays_to_live_state(manager):
+    live = by_phone(manager.get_all_leads())
+    assert manager.event_store.latest_snapshot()[1] is not None
+    fresh = LeadEventStore(manager.event_store.base_dir)
+
+    assert by_phone(fresh.get_all_leads()) == live
+    lead = live["+5547999900001"]
+    assert lead["status"] == "Agendado"
+    assert [i["direcao"] for i in lead["historico"]] == ["Entrada", "Saída", "Entrada"]
+    assert live["+5547999900003"]["status"] == "Perdido"
+    assert "follow_up_inativo_5h" in live["+5547999900003"]["automations"]
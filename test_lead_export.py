@@ -0,0 +1,20 @@
+# test_lead_export.py
+import time
+
+from lead_export import DATASETS, iter_lead_rows
+from lead_manager import LeadManager
+
+
+def test_incremental_export_sees_note_only_changes(tmp_path):
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    for phone in ("+5547999990001", "+5547999990002"):
+        manager.create_or_update_lead(phone, nome="Cliente")
+    since = int(time.time()) + 1
+    # Só a nota muda: a última interação fica antes do corte
+    lead = manager.get_lead("+5547999990002")
+    time.sleep(max(0.0, since - time.time()))
+    manager.add_note("+5547999990002", "Cliente pediu retorno amanhã", author="Vendedor")
+
+    rows = [dict(zip(DATASETS["leads"], row)) for row in iter_lead_rows(manager, since)]
+    assert [(row["telefone"], row["notas"]) for row in rows] == [("+5547999990002", 1)]
+    assert rows[0]["ultima_interacao_ts"] == lead["ultima_interacao_ts"] < since <= rows[0]["modificado_ts"]
@@ -0,0 +1,65 @@
+# test_lead_snapshot.py
+import gc
+import os
+import time
+import struct
+import warnings
+
+import pytest
+
+from lead_manager import LeadManager
+from lead_snapshot import LeadHeader, LeadSnapshotReader
+
+
+def headers(manager, refresh=True):
+    return sorted((h.telefone, h.status, h.total_interacoes) for h in manager.snapshot.load(refresh))
+
+
+def expected(manager):
+    return sorted((h.telefone, h.status, h.total_interacoes)
+                  for h in map(LeadHeader.from_lead, manager.get_all_leads()))
+
+
+def test_refresh_sees_writes_in_the_same_mtime_tick(tmp_path):
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    manager.create_or_update_lead("+5547999990001", nome="Cliente")
+    # Disco de baixa resolução: a segunda gravação deixa o mesmo mtime (antigo) no diretório
+    old = time.time() - 60
+    os.utime(manager.leads_dir, (old, old))
+    assert headers(manager) == expected(manager)
+
+    manager.update_status("+5547999990001", "Agendado")
+    os.utime(manager.leads_dir, (old, old))
+    assert headers(manager) == expected(manager)
+    assert headers(manager)[0][1] == "Agendado"
+
+
+def test_event_mode_repacks_only_changed_leads(tmp_path):
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="eventos")
+    phones = [f"+55479999{i:05d}" for i in range(50)]
+    for phone in phones:
+        manager.create_or_update_lead(phone, nome="Cliente")
+    assert manager.snapshot.refresh() == {"reused": 0, "parsed": 50}
+
+    manager.add_interaction(phones[3], "Entrada", "Quero um test drive")
+    manager.update_status(phones[7], "Vendido")
+    assert manager.snapshot.refresh() == {"reused": 48, "parsed": 2}
+    assert manager.snapshot.refresh() == {"reused": 50, "parsed": 0}
+    assert headers(manager, refresh=False) == expected(manager)
+
+
+def test_reader_closes_the_file_of_an_invalid_snapshot(tmp_path):
+    manager = LeadManager(str(tmp_path / "leads"), store_mode="arquivos")
+    manager.create_or_update_lead("+5547999990001", nome="Cliente")
+    for content in (b"", b"LEADSNP1\x03"):
+        with open(manager.snapshot.path, "wb") as f:
+            f.write(content)
+        # Arquivo não fechado só seria fechado pelo coletor, com ResourceWarning
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            with pytest.raises((ValueError, struct.error)):
+                LeadSnapshotReader(manager.snapshot.path)
+            gc.collect()
+        assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+    # Arquivo vazio ou truncado: a atualização reconstrói o snapshot
+    assert headers(manager) == expected(manager)
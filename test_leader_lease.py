@@ -0,0 +1,45 @@
+# test_leader_lease.py
+import os
+import time
+
+from leader_lease import LeaderLease, read_lease
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_standby_takes_over_when_leader_stops(tmp_path):
+    events = []
+
+    def lease(tag):
+        return LeaderLease("automacao", base_dir=str(tmp_path), heartbeat=0.05,
+                           on_elected=lambda: events.append((tag, "eleito")),
+                           on_demoted=lambda: events.append((tag, "deposto")))
+
+    first, second = lease("a"), lease("b")
+    first.start()
+    assert wait_for(lambda: first.is_leader)
+    second.start()
+    time.sleep(0.2)  # vários heartbeats: o lock continua com o primeiro
+    assert not second.is_leader
+    assert read_lease(first.lease_path)["ativo"]
+
+    first.stop()
+    assert not first.is_leader
+    assert wait_for(lambda: second.is_leader)
+    assert events == [("a", "eleito"), ("a", "deposto"), ("b", "eleito")]
+    assert second.status()["lider_pid"] == os.getpid()
+
+    # Líder sem saúde devolve o lock e o outro volta a assumir
+    first.start()
+    second.healthy = lambda: False
+    assert wait_for(lambda: first.is_leader)
+    assert ("b", "deposto") in events
+    first.stop()
+    second.stop()
@@ -0,0 +1,98 @@
+# test_message_outbox.py
+import json
+
+import pytest
+
+import message_outbox
+from lead_manager import LeadManager
+from message_outbox import MessageOutbox, PermanentSendError
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    """Outbox num diretório próprio, sem backoff, registrando as entregas numa base temporária"""
+    monkeypatch.setenv("OUTBOX_MAX_ATTEMPTS", "2")
+    monkeypatch.setattr(message_outbox, "lead_manager", LeadManager(str(tmp_path / "leads"), store_mode="arquivos"))
+    outbox = MessageOutbox(str(tmp_path / "outbox"))
+    outbox.base_delay = 0
+    return outbox
+
+
+def drain_once(outbox, sender):
+    """Uma tentativa de entrega de cada mensagem vencida, como os workers fariam"""
+    outbox.sender = sender
+    taken = []
+    with outbox._lock:
+        while (entry := outbox._next_ready()) is not None:
+            taken.append(entry)
+    for entry in taken:
+        outbox._deliver(entry)
+        with outbox._lock:
+            outbox._in_flight.discard(entry["id"])
+
+
+def test_enqueue_is_idempotent_across_instances(outbox):
+    key = outbox.enqueue("+5547999990001", "Olá!")
+    assert key is not None
+    assert outbox.enqueue("+5547999990001", "Olá!") is None
+    assert outbox.enqueue("+5547999990002", "Outra", key="regra:+5547999990002:2026-10-19")
+    # Outro processo (instância) lendo o mesmo log também recusa as chaves
+    other = MessageOutbox(outbox.base_dir)
+    assert other.enqueue("+5547999990001", "Olá!", key=key) is None
+    assert other.enqueue("+5547999990002", "Outra", key="regra:+5547999990002:2026-10-19") is None
+    assert other.stats()["pendentes"] == 2
+
+
+def test_failures_retry_then_dead_letter_and_requeue(outbox):
+    phone = "+5547999990003"
+    key = outbox.enqueue(phone, "Oi, tudo bem?", direcao="Saída", tipo_mensagem="automacao",
+                         regra="follow_up_inativo_5h")
+    drain_once(outbox, lambda phone, body: False)
+    entry = outbox._messages[key]
+    assert (entry["estado"], entry["tentativas"]) == ("pendente", 1)
+
+    drain_once(outbox, lambda phone, body: False)
+    assert outbox._messages[key]["estado"] == "morta"
+    assert outbox.stats()["mortas"] == 1
+    with open(outbox.dead_path, encoding="utf-8") as f:
+        dead = [json.loads(line) for line in f]
+    assert [(d["id"], d["tentativas"]) for d in dead] == [(key, 2)]
+
+    # Reenfileirada, a entrega conta do zero e grava no lead só quando dá certo
+    assert outbox.requeue_dead(key) == 1
+    drain_once(outbox, lambda phone, body: True)
+    assert outbox._messages[key]["estado"] == "enviada"
+    lead = message_outbox.lead_manager.get_lead(phone)
+    assert lead["historico"][-1]["mensagem"] == "Oi, tudo bem?"
+    assert "follow_up_inativo_5h" in lead["automations"]
+
+
+def test_permanent_error_skips_retries(outbox):
+    key = outbox.enqueue("+5547999990004", "Oi!")
+
+    def sender(phone, body):
+        raise PermanentSendError("Twilio não configurado")
+
+    drain_once(outbox, sender)
+    assert (outbox._messages[key]["estado"], outbox._messages[key]["tentativas"]) == ("morta", 1)
+
+
+def test_compaction_with_second_reader(outbox, monkeypatch):
+    sent = outbox.enqueue("+5547999990005", "Primeira")
+    drain_once(outbox, lambda phone, body: True)
+    pending = outbox.enqueue("+5547999990006", "Segunda")
+    reader = MessageOutbox(outbox.base_dir)
+    assert reader.stats()["pendentes"] == 1
+
+    # Na janela de idempotência a chave enviada sobrevive à compactação
+    outbox._compact()
+    assert reader.enqueue("+5547999990005", "Primeira", key=sent) is None
+    late = reader.enqueue("+5547999990007", "Terceira")
+    assert outbox.stats()["pendentes"] == 2  # o compactador lê o que o outro anexou depois
+
+    # Fora da janela só as pendentes ficam; o leitor percebe o log novo e recarrega
+    monkeypatch.setattr(message_outbox, "IDEMPOTENCY_WINDOW", -1)
+    outbox._compact()
+    reader._catch_up()
+    assert set(reader._messages) == set(outbox._messages) == {pending, late}
+    assert reader.stats()["enviadas_recentes"] == 0
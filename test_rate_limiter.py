@@ -0,0 +1,39 @@
+# test_rate_limiter.py
+import multiprocessing
+
+from rate_limiter import RateLimiter
+
+
+def drain_global(base_dir, results):
+    limiter = RateLimiter(per_second=0.01, base_dir=base_dir)
+    results.put([limiter.try_acquire_global() for _ in range(2)])
+
+
+def test_global_bucket_is_shared_across_processes(tmp_path):
+    base_dir = str(tmp_path / "outbox")
+    # Rajada de 1 ficha que leva 100s para repor: quem chegar depois fica sem
+    results = multiprocessing.get_context("fork").Queue()
+    child = multiprocessing.get_context("fork").Process(target=drain_global, args=(base_dir, results))
+    child.start()
+    child.join(10)
+    assert child.exitcode == 0
+    granted, refused = results.get(timeout=1)
+    assert granted == 0 and refused > 0
+
+    # Este processo, com instâncias próprias, vê o balde que o outro esvaziou
+    first = RateLimiter(per_second=0.01, base_dir=base_dir)
+    second = RateLimiter(per_second=0.01, base_dir=base_dir)
+    assert first.global_wait() > 0
+    assert first.try_acquire_global() > 0
+    assert second.try_acquire("+5547999990001") > 0
+    assert second.stats()["fichas_globais"] < 1
+
+
+def test_destination_bucket_needs_both_tokens(tmp_path):
+    limiter = RateLimiter(per_second=100, per_destination_per_minute=2, base_dir=str(tmp_path))
+    phone = "+5547999990002"
+    assert limiter.try_acquire(phone) == 0
+    assert limiter.try_acquire(phone) > 0   # rajada do destino: metade do limite, 1 ficha
+    assert limiter.try_acquire("+5547999990003") == 0
+    # Recusa não consome a ficha global: 100 de capacidade, 2 pegas
+    assert limiter.stats()["fichas_globais"] >= 97
@@ -0,0 +1,41 @@
+# test_routes.py
+from datetime import date
+
+import pytest
+from flask import Flask
+
+import routes
+from routes import bp, _date_range, MAX_HOURLY_RANGE_DAYS, MAX_RANGE_DAYS
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """Só o blueprint, sem drenar o outbox nem ligar a automação ao registrar"""
+    monkeypatch.setattr(routes.message_outbox, "start", lambda sender: None)
+    monkeypatch.delenv("AUTOMATION_ENABLED", raising=False)
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+
+@pytest.mark.parametrize("url", [
+    "/api/analytics/tendencias?inicio=1900-01-01&fim=2026-10-19",
+    "/api/analytics/tendencias?inicio=2026-08-01&fim=2026-10-19&granularidade=hora",
+    "/api/analytics/query?metrica=tempo_resposta&agrupar=hora&inicio=2026-08-01&fim=2026-10-19",
+    "/api/analytics/query?metrica=tempo_resposta&hora=9&inicio=2026-08-01&fim=2026-10-19",
+    "/api/analytics/tempo-resposta?inicio=2020-01-01&fim=2026-10-19",
+])
+def test_long_ranges_are_rejected(app, url):
+    response = app.test_client().get(url)
+    assert response.status_code == 400
+    assert "Intervalo longo demais" in response.get_json()["error"]
+
+
+def test_range_limits_are_inclusive(app):
+    with app.test_request_context("/?inicio=2026-09-19&fim=2026-10-19"):
+        assert _date_range(MAX_HOURLY_RANGE_DAYS) == (date(2026, 9, 19), date(2026, 10, 19))
+    with app.test_request_context("/?inicio=2025-10-19&fim=2026-10-19"):
+        assert _date_range(MAX_RANGE_DAYS) == (date(2025, 10, 19), date(2026, 10, 19))
+    with app.test_request_context("/?inicio=2025-10-18&fim=2026-10-19"):
+        with pytest.raises(ValueError):
+            _date_range(MAX_RANGE_DAYS)